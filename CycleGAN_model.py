@@ -23,6 +23,7 @@ import os
 #from ImageRegistrationGANs.helpers import dense_image_warp_3D, numerical_gradient_3D
 #from ImageRegistrationGANs.data_loader import DataLoader
 from data_loader import DataLoader   #To run on the cluster
+from prefetch import BatchPrefetcher
 
 __author__ = 'elmalakis'
 
@@ -198,7 +199,9 @@ class CycleGAN_model64():
         fake = np.zeros((self.batch_sz,) + self.disc_patch)
 
         for epoch in range(epochs):
-            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(self.data_loader.load_batch()):
+            # crop sampling and augmentation of the next batches run while the model trains on this one
+            prefetcher = BatchPrefetcher(self.data_loader.load_batch, queue_depth=4)
+            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(prefetcher):
 
                 # ----------------------
                 #  Train Discriminators
@@ -256,6 +259,8 @@ class CycleGAN_model64():
                 if batch_i % sample_interval == 0 and epoch != 0 and epoch % 5 == 0:
                     self.sample_images(epoch, batch_i)
 
+            print(prefetcher.report())
+
 
     def get_weight_grad(self, model, inputs, outputs):
         """ Gets gradient of model for given inputs and outputs for all weights"""
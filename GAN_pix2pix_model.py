@@ -22,14 +22,24 @@ import os
 #from ImageRegistrationGANs.helpers import dense_image_warp_3D, numerical_gradient_3D
 #from ImageRegistrationGANs.data_loader import DataLoader
 from data_loader import DataLoader   #To run on the cluster
-from helpers import dense_image_warp_3D, numerical_gradient_3D, make_parallel #To run on the cluster'
+from prefetch import BatchPrefetcher
+from shared_batches import SharedBatchRing
+from train_step import GANTrainStep
+from tiled_inference import predict_tiled
+from helpers import dense_image_warp_3D_lean, make_parallel #To run on the cluster'
 
 __author__ = 'elmalakis'
 
 
 class GAN_pix2pix():
 
-    def __init__(self):
+    def __init__(self, concat_d_batches=False, sum_d_losses=False):
+        """
+        :param concat_d_batches: bool - run the discriminator once on the real and warped batches concatenated, its
+                                 batch normalizations then take their statistics over both batches, so the training
+                                 of the discriminator changes. Needs sum_d_losses (see GANTrainStep)
+        :param sum_d_losses: bool - train the discriminator with one step on the sum of its real and fake losses
+        """
 
         K.set_image_data_format('channels_last')  # set format
         self.DEBUG = 1
@@ -40,6 +50,7 @@ class GAN_pix2pix():
         self.img_vols = 256
         self.channels = 1
         self.batch_sz = 1 # for testing locally to avoid memory allocation
+        self.sample_batch_sz = 1 # number of tiles per predict call in sample_images
 
         self.crop_size = (self.img_rows, self.img_cols, self.img_vols)
 
@@ -100,6 +111,12 @@ class GAN_pix2pix():
                               loss_weights=[50, 50],
                               optimizer=optimizer)
 
+        # one call per iteration computes the warped image with a single forward pass of the generator and the warp,
+        # then trains the discriminator and the generator with their train_on_batch calls, or the discriminator with
+        # one step on the sum of its losses (sum_d_losses, concat_d_batches)
+        self.train_step = GANTrainStep(self.combined, self.discriminator, warped=warped_S, condition=img_T,
+                                       concat_d_batches=concat_d_batches, sum_d_losses=sum_d_losses)
+
 
         if self.DEBUG:
             log_path = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/logs_ganpix2pixwithgolden/'
@@ -198,7 +215,7 @@ class GAN_pix2pix():
         phi = Input(shape=self.output_shape_g, name='input_phi_transform')     # 128x128x128
 
         #img_S_cropped = Cropping3D(cropping=40)(img_S)  # 68x68x68
-        warped_S = Lambda(dense_image_warp_3D, output_shape=self.img_shape)([img_S, phi])
+        warped_S = Lambda(dense_image_warp_3D_lean, output_shape=self.img_shape)([img_S, phi])
 
         return Model([img_S, phi], warped_S,  name='transformation_layer')
 
@@ -206,7 +223,7 @@ class GAN_pix2pix():
     """
     Training
     """
-    def train(self, epochs, batch_size=1, sample_interval=50):
+    def train(self, epochs, batch_size=1, sample_interval=50, batch_workers=0):
         DEBUG =1
         path = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/'
         os.makedirs(path+'generated_pix2pixwithgolden/' , exist_ok=True)
@@ -217,31 +234,30 @@ class GAN_pix2pix():
         valid = np.ones((self.batch_sz,) + self.output_shape_d)
         fake = np.zeros((self.batch_sz,) + self.output_shape_d)
 
+        # crop sampling and augmentation of the next batches run while the model trains on this one, the workers
+        # are started again for every epoch but the shared volumes and batch buffers are set up once
+        if batch_workers:
+            # worker processes fill a ring of shared batch buffers, the loop gets views of them
+            prefetcher = SharedBatchRing(self.data_loader, n_workers=batch_workers)
+        else:
+            prefetcher = BatchPrefetcher(self.data_loader.load_batch, queue_depth=4)
+
         start_time = datetime.datetime.now()
         for epoch in range(epochs):
-            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(self.data_loader.load_batch()):
-                # ---------------------
-                #  Train Discriminator
-                # ---------------------
+            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(prefetcher):
                 # Condition on B and generate a translate
-                phi = self.generator.predict([batch_img, batch_img_template])
-                transform = self.transformation.predict([batch_img, phi])
                 # Create a ref image by perturbing th subject image with the template image
                 perturbation_factor_alpha = 0.1 if epoch > epochs/2 else 0.2
                 batch_ref = perturbation_factor_alpha * batch_img + (1- perturbation_factor_alpha) * batch_img_template
 
-                # Train the discriminators (original images = real / generated = Fake)
-                d_loss_real = self.discriminator.train_on_batch([batch_ref, batch_img_template], valid)
-                d_loss_fake = self.discriminator.train_on_batch([transform, batch_img_template], fake)
-                d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
-
-                # -----------------
-                #  Train Generator
-                # -----------------
+                # Labels of the discriminator (original images = real / generated = Fake)
+                real_labels = valid
+                fake_labels = fake
 
-                # Train the generator
-
-                g_loss = self.combined.train_on_batch([batch_img, batch_img_template], [valid, batch_ref]) # The original implemntation has batch_img in the output
+                # the discriminator (real and warped batch) and then the generator, on one forward pass of the generator
+                d_loss_real, d_loss_fake, g_loss = self.train_step([batch_img, batch_img_template], batch_ref,
+                                                                   real_labels, fake_labels, [valid, batch_ref])  # The original implemntation has batch_img in the output
+                d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
                 #g_loss = self.combined.train_on_batch([batch_img, batch_img_template], [valid, batch_img_golden])  # The original implemntation has batch_img in the output
                 elapsed_time = datetime.datetime.now() - start_time
 
@@ -264,6 +280,9 @@ class GAN_pix2pix():
                 if batch_i % sample_interval == 0 and epoch != 0 and epoch % 5 == 0:
                     self.sample_images(epoch, batch_i)
 
+            print(prefetcher.report())
+        prefetcher.close()
+
 
     def write_log(self, callback, names, logs, batch_no):
         #https://github.com/eriklindernoren/Keras-GAN/issues/52
@@ -283,37 +302,10 @@ class GAN_pix2pix():
         idx, imgs_S = self.data_loader.load_data(is_validation=True)
         imgs_T = self.data_loader.img_template
 
-        predict_img = np.zeros(imgs_S.shape, dtype=imgs_S.dtype)
-
-        input_sz = self.crop_size
-        step = (32, 32, 32)
-
-        gap = (int((input_sz[0] - step[0]) / 2), int((input_sz[1] - step[1]) / 2), int((input_sz[2] - step[2]) / 2))
-        start_time = datetime.datetime.now()
-
-        for row in range(0, imgs_S.shape[0] - input_sz[0], step[0]):
-            for col in range(0, imgs_S.shape[1] - input_sz[1], step[1]):
-                for vol in range(0, imgs_S.shape[2] - input_sz[2], step[2]):
-
-                    patch_sub_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_S.dtype)
-                    patch_templ_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_T.dtype)
-
-                    patch_sub_img[0, :, :, :, 0] = imgs_S[row:row + input_sz[0],
-                                                         col:col + input_sz[1],
-                                                         vol:vol + input_sz[2]]
-                    patch_templ_img[0, :, :, :, 0] = imgs_T[row:row + input_sz[0],
-                                                       col:col + input_sz[1],
-                                                       vol:vol + input_sz[2]]
-
-                    patch_predict_phi = self.generator.predict([patch_sub_img, patch_templ_img])
-                    patch_predict_warped = self.transformation.predict([patch_sub_img, patch_predict_phi])
-
-                    predict_img[row :row + input_sz[0],
-                                col :col + input_sz[1],
-                                vol :vol + input_sz[2]] = patch_predict_warped[0, :, :, :, 0]
-
-        elapsed_time = datetime.datetime.now() - start_time
-        print(" --- Prediction time: %s" % (elapsed_time))
+        # the warped patches are written at the origin of the tiles, not at the center
+        predict_img, _ = predict_tiled(self.generator, self.transformation, imgs_S, imgs_T,
+                                       input_sz=self.crop_size, step=(32, 32, 32), output_offset=(0, 0, 0),
+                                       batch_sz=self.sample_batch_sz)
 
         nrrd.write(path+"generated_pix2pixwithgolden/%d_%d_%d" % (epoch, batch_i, idx), predict_img)
 
@@ -22,14 +22,25 @@ import os
 #from ImageRegistrationGANs.helpers import dense_image_warp_3D, numerical_gradient_3D
 #from ImageRegistrationGANs.data_loader import DataLoader
 from data_loader import DataLoader   #To run on the cluster
-from helpers import dense_image_warp_3D, numerical_gradient_3D, make_parallel #To run on the cluster'
+from prefetch import BatchPrefetcher
+from shared_batches import SharedBatchRing
+from train_step import GANTrainStep
+from tiled_inference import predict_tiled
+from helpers import dense_image_warp_3D_lean, make_parallel #To run on the cluster'
+from regularizers import flow_regularizer
 
 __author__ = 'elmalakis'
 
 
 class GAN_pix2pix():
 
-    def __init__(self):
+    def __init__(self, concat_d_batches=False, sum_d_losses=False):
+        """
+        :param concat_d_batches: bool - run the discriminator once on the real and warped batches concatenated, its
+                                 batch normalizations then take their statistics over both batches, so the training
+                                 of the discriminator changes. Needs sum_d_losses (see GANTrainStep)
+        :param sum_d_losses: bool - train the discriminator with one step on the sum of its real and fake losses
+        """
 
         K.set_image_data_format('channels_last')  # set format
         self.DEBUG = 1
@@ -40,6 +51,7 @@ class GAN_pix2pix():
         self.img_vols = 256
         self.channels = 1
         self.batch_sz = 1
+        self.sample_batch_sz = 1 # number of tiles per predict call in sample_images
 
         self.crop_size = (self.img_rows, self.img_cols, self.img_vols)
         self.img_shape = self.crop_size + (self.channels,)
@@ -86,13 +98,16 @@ class GAN_pix2pix():
 
         # Generate the deformable funtion
         phi = self.generator([img_S, img_T])
+        # The warp and the discriminator only see the center of the crops
+        img_S_center = Cropping3D(cropping=64, name='crop_center_S')(img_S) # 128
+        img_T_center = Cropping3D(cropping=64, name='crop_center_T')(img_T) # 128
         # Transform S
-        warped_S = self.transformation([img_S, phi])
+        warped_S = self.transformation([img_S_center, phi])
         # For the combined model we will only train the generator
         self.discriminator.trainable = False
 
         # Discriminators determines validity of translated images / condition pairs
-        validity = self.discriminator([warped_S, img_T])
+        validity = self.discriminator([warped_S, img_T_center])
 
         self.combined = Model(inputs=[img_S, img_T], outputs=[validity, warped_S])
         self.combined.summary()
@@ -105,6 +120,12 @@ class GAN_pix2pix():
                               loss_weights=[1, 100],
                               optimizer=optimizer)
 
+        # one call per iteration computes the warped image with a single forward pass of the generator and the warp,
+        # then trains the discriminator and the generator with their train_on_batch calls, or the discriminator with
+        # one step on the sum of its losses (sum_d_losses, concat_d_batches)
+        self.train_step = GANTrainStep(self.combined, self.discriminator, warped=warped_S, condition=img_T_center,
+                                       concat_d_batches=concat_d_batches, sum_d_losses=sum_d_losses)
+
 
         if self.DEBUG:
             log_path = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/logs_ganpix2pix_remod_golden_smooth/'
@@ -115,6 +136,7 @@ class GAN_pix2pix():
 
         self.data_loader = DataLoader(batch_sz=self.batch_sz,
                                       crop_size=self.crop_size,
+                                      center_size=self.input_shape_d[:3],
                                       dataset_name='fly',
                                       min_max=False,
                                       restricted_mask=False,
@@ -186,11 +208,9 @@ class GAN_pix2pix():
             return d
 
         img_S = Input(shape=self.input_shape_d) #128 S
-        img_T = Input(shape=self.img_shape) #256 T
-
-        img_T_cropped = Cropping3D(cropping=64)(img_T)  # 128
+        img_T = Input(shape=self.input_shape_d) #128 center of T
 
-        combined_imgs = Concatenate(axis=-1)([img_S, img_T_cropped])
+        combined_imgs = Concatenate(axis=-1)([img_S, img_T])
         #combined_imgs = Add()([img_S, img_T])
 
         d1 = d_layer(combined_imgs, self.df, bn=False)
@@ -205,12 +225,10 @@ class GAN_pix2pix():
 
     def build_transformation(self):
 
-        img_S = Input(shape=self.img_shape, name='input_img_S_transform')      # 256
+        img_S = Input(shape=self.input_shape_d, name='input_img_S_transform')  # 128 center of S
         phi = Input(shape=self.output_shape_g, name='input_phi_transform')     # 128
 
-        img_S_cropped = Cropping3D(cropping=64)(img_S)  # 128
-
-        warped_S = Lambda(dense_image_warp_3D, output_shape=(128, 128, 128, 1))([img_S_cropped, phi])
+        warped_S = Lambda(dense_image_warp_3D_lean, output_shape=(128, 128, 128, 1))([img_S, phi])
 
         return Model([img_S, phi], warped_S,  name='transformation_layer')
 
@@ -225,14 +243,8 @@ class GAN_pix2pix():
         # mean square error loss
         mse_loss = K.mean(K.square(y_pred - y_true), axis=-1)
 
-        # compute the numerical gradient of phi
-        gradients = numerical_gradient_3D(phi)
-        # #if self.DEBUG: gradients = K.print_tensor(gradients, message='gradients are:')
-        #
-        # compute the euclidean norm by squaring ...
-        gradients_sqr = K.square(gradients)
-        #   ... summing over the rows ...
-        gradients_sqr_sum = K.sum(gradients_sqr, axis=np.arange(1, len(gradients_sqr.shape)))
+        # squares of the numerical gradient of phi summed over the voxels, one conv3d pass (see regularizers)
+        gradients_sqr_sum = flow_regularizer(phi, gradient_weight=0., summed_gradient_weight=1.)
         # #   ... and sqrt
         #gradient_l2_norm = K.sqrt(gradients_sqr_sum)
         # # compute lambda * (1 - ||grad||)^2 still for each single sample
@@ -244,74 +256,50 @@ class GAN_pix2pix():
     """
     Training
     """
-    def train(self, epochs, batch_size=1, sample_interval=50):
+    def train(self, epochs, batch_size=1, sample_interval=50, batch_workers=0):
         DEBUG =1
         path = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/'
         os.makedirs(path+'generated_pix2pix_remod_smooth/' , exist_ok=True)
-        output_sz = 128
-        input_sz = 256
-        gap = int((input_sz - output_sz)/2)
         # Adversarial loss ground truths
         valid = np.ones((self.batch_sz,) + self.output_shape_d)
         fake = np.zeros((self.batch_sz,) + self.output_shape_d)
         validsoft = np.random.uniform(low=0.7, high=1.2, size=(self.batch_sz,) + self.output_shape_d)
         fakesoft = np.random.uniform(low=0.0, high=0.3, size=(self.batch_sz,) + self.output_shape_d)
 
+        # crop sampling and augmentation of the next batches run while the model trains on this one, the workers
+        # are started again for every epoch but the shared volumes and batch buffers are set up once
+        if batch_workers:
+            # worker processes fill a ring of shared batch buffers, the loop gets views of them
+            prefetcher = SharedBatchRing(self.data_loader, n_workers=batch_workers)
+        else:
+            prefetcher = BatchPrefetcher(self.data_loader.load_batch, queue_depth=4)
+
         start_time = datetime.datetime.now()
         for epoch in range(epochs):
-            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(self.data_loader.load_batch()):
-                # ---------------------
-                #  Train Discriminator
-                # ---------------------
+            for batch_i, (batch_img, batch_img_template, batch_img_golden,
+                          batch_img_center, batch_img_template_center, batch_img_golden_center) in enumerate(prefetcher):
                 # Condition on template and generate a transform
-                phi = self.generator.predict([batch_img, batch_img_template])
-                transform = self.transformation.predict([batch_img, phi])
-
-                # Create a ref image by perturbing th subject image with the template image
-                perturbation_factor_alpha = 0.1 if epoch > epochs/2 else 0.2
-                batch_ref = perturbation_factor_alpha * batch_img + (1- perturbation_factor_alpha) * batch_img_template
-
-                batch_img_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels),
-                                         dtype=batch_img.dtype)
-                batch_ref_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels),
-                                         dtype=batch_ref.dtype)
-                batch_temp_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels),
-                                          dtype=batch_img_template.dtype)
-                batch_golden_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels),
-                                            dtype=batch_img_golden.dtype)
-
-                # take only (24,24,24) from the (64,64,64) size
-                batch_img_sub[:, :, :, :, :] = batch_img[:, 0 + gap:0 + gap + output_sz,
-                                               0 + gap:0 + gap + output_sz,
-                                               0 + gap:0 + gap + output_sz, :]
-                batch_ref_sub[:, :, :, :, :] = batch_ref[:, 0 + gap:0 + gap + output_sz,
-                                               0 + gap:0 + gap + output_sz,
-                                               0 + gap:0 + gap + output_sz, :]
-                batch_golden_sub[:, :, :, :, :] = batch_img_golden[:, 0 + gap:0 + gap + output_sz,
-                                                  0 + gap:0 + gap + output_sz,
-                                                  0 + gap:0 + gap + output_sz, :]
-                batch_temp_sub[:, :, :, :, :] = batch_img_template[:, 0 + gap:0 + gap + output_sz,
-                                                0 + gap:0 + gap + output_sz,
-                                                0 + gap:0 + gap + output_sz, :]
+
+                # the discriminator and the warp only see the center of the crops, the loader yields views of it
+                batch_golden_sub = batch_img_golden_center
 
                 # use noisy targets to get the GAN out of any local minima (mode collapse)
                 noisy_prob = 1 - np.sqrt(
                     1 - np.random.random())  # peak near low values and falling off towards high values
                 if noisy_prob < 0.85:  # occasionally flip labels to introduce noisy labels
-                    d_loss_real = self.discriminator.train_on_batch([batch_golden_sub, batch_img_template], valid)
-                    d_loss_fake = self.discriminator.train_on_batch([transform, batch_img_template], fake)
+                    real_labels = valid
+                    fake_labels = fake
                 else:
-                    d_loss_real = self.discriminator.train_on_batch([batch_golden_sub, batch_img_template], fake)
-                    d_loss_fake = self.discriminator.train_on_batch([transform, batch_img_template], valid)
+                    real_labels = fake
+                    fake_labels = valid
 
                 # d_loss_real = self.discriminator.train_on_batch([batch_img_golden, batch_img_template], valid)
                 # d_loss_fake = self.discriminator.train_on_batch([transform, batch_img_template], fake)
-                d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
 
-                # -----------------
-                #  Train Generator
-                # -----------------
-                g_loss = self.combined.train_on_batch([batch_img, batch_img_template], [valid, batch_golden_sub])
+                # the discriminator (real and warped batch) and then the generator, on one forward pass of the generator
+                d_loss_real, d_loss_fake, g_loss = self.train_step([batch_img, batch_img_template], batch_golden_sub,
+                                                                   real_labels, fake_labels, [valid, batch_golden_sub])
+                d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
 
                 elapsed_time = datetime.datetime.now() - start_time
 
@@ -333,6 +321,9 @@ class GAN_pix2pix():
                 if batch_i % sample_interval == 0 and epoch != 0 and epoch % 5 == 0:
                     self.sample_images(epoch, batch_i)
 
+            print(prefetcher.report())
+        prefetcher.close()
+
 
     def write_log(self, callback, names, logs, batch_no):
         #https://github.com/eriklindernoren/Keras-GAN/issues/52
@@ -352,43 +343,9 @@ class GAN_pix2pix():
         idx, imgs_S = self.data_loader.load_data(is_validation=True)
         imgs_T = self.data_loader.img_template
 
-        predict_img = np.zeros(imgs_S.shape, dtype=imgs_S.dtype)
-        predict_phi = np.zeros(imgs_S.shape + (3,), dtype=imgs_S.dtype)
-
-        input_sz = self.crop_size
-        output_sz = (self.output_size, self.output_size, self.output_size)
-        step = (24, 24, 24)
-
-        gap = (int((input_sz[0] - output_sz[0]) / 2), int((input_sz[1] - output_sz[1]) / 2), int((input_sz[2] - output_sz[2]) / 2))
-        start_time = datetime.datetime.now()
-
-        for row in range(0, imgs_S.shape[0] - input_sz[0], step[0]):
-            for col in range(0, imgs_S.shape[1] - input_sz[1], step[1]):
-                for vol in range(0, imgs_S.shape[2] - input_sz[2], step[2]):
-
-                    patch_sub_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_S.dtype)
-                    patch_templ_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_T.dtype)
-
-                    patch_sub_img[0, :, :, :, 0] = imgs_S[row:row + input_sz[0],
-                                                         col:col + input_sz[1],
-                                                         vol:vol + input_sz[2]]
-                    patch_templ_img[0, :, :, :, 0] = imgs_T[row:row + input_sz[0],
-                                                       col:col + input_sz[1],
-                                                       vol:vol + input_sz[2]]
-
-                    patch_predict_phi = self.generator.predict([patch_sub_img, patch_templ_img])
-                    patch_predict_warped = self.transformation.predict([patch_sub_img, patch_predict_phi])
-
-                    predict_img[row + gap[0]:row + gap[0] + output_sz[0],
-                                col + gap[1]:col + gap[1] + output_sz[1],
-                                vol + gap[2]:vol + gap[2] + output_sz[2]] = patch_predict_warped[0, :, :, :, 0]
-
-                    predict_phi[row + gap[0]:row + gap[0] + output_sz[0],
-                               col + gap[1]:col + gap[1] + output_sz[1],
-                               vol + gap[2]:vol + gap[2] + output_sz[2],:] = patch_predict_phi[0, :, :, :, :]
-
-        elapsed_time = datetime.datetime.now() - start_time
-        print(" --- Prediction time: %s" % (elapsed_time))
+        predict_img, predict_phi = predict_tiled(self.generator, self.transformation, imgs_S, imgs_T,
+                                                 input_sz=self.crop_size, step=(24, 24, 24),
+                                                 batch_sz=self.sample_batch_sz, with_phi=True)
 
         nrrd.write(path+"generated_pix2pix_remod_golden_smooth/%d_%d_%d" % (epoch, batch_i, idx), predict_img)
         self.data_loader._write_nifti(path + "generated_pix2pix_remod_golden_smooth/phi%d_%d_%d" % (epoch, batch_i, idx), predict_phi)
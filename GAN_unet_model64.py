@@ -27,7 +27,12 @@ import os
 
 
 from data_loader import DataLoader   #To run on the cluster'
-from helpers import dense_image_warp_3D, numerical_gradient_3D #To run on the cluster'
+from prefetch import BatchPrefetcher
+from shared_batches import SharedBatchRing
+from train_step import GANTrainStep
+from tiled_inference import predict_tiled
+from helpers import dense_image_warp_3D_lean #To run on the cluster'
+from regularizers import flow_regularizer
 
 
 __author__ = 'elmalakis'
@@ -35,7 +40,13 @@ __author__ = 'elmalakis'
 
 class GANUnetModel64():
 
-    def __init__(self):
+    def __init__(self, concat_d_batches=False, sum_d_losses=False):
+        """
+        :param concat_d_batches: bool - run the discriminator once on the real and warped batches concatenated, its
+                                 batch normalizations then take their statistics over both batches, so the training
+                                 of the discriminator changes. Needs sum_d_losses (see GANTrainStep)
+        :param sum_d_losses: bool - train the discriminator with one step on the sum of its real and fake losses
+        """
 
         K.set_image_data_format('channels_last')  # set format
         K.set_image_dim_ordering('tf')
@@ -52,11 +63,15 @@ class GANUnetModel64():
         self.output_shape_d_v2 = (2, 2, 2) + (self.channels,)
 
         self.batch_sz = 1 # for testing locally to avoid memory allocation
+        self.sample_batch_sz = 8 # number of tiles per predict call in sample_images
 
         # Number of filters in the first layer of G and D
         self.gf = 64
         self.df = 64
 
+        # Crop the skip connections before the gap filling convolutions instead of after (see gap_filling)
+        self.crop_gap_inputs = False
+
         # Train the discriminator faster than the generator
         optimizerD = Adam(0.001, decay=0.05) # in the paper the learning rate is 0.001 and weight decay is 0.5
         self.decay = 0.5
@@ -85,8 +100,12 @@ class GANUnetModel64():
         # By conditioning on T generate a warped transformation function of S
         phi = self.generator([img_S, img_T])
 
+        # The warp and the discriminator only see the center of the crops
+        img_S_center = Cropping3D(cropping=20, name='crop_center_S')(img_S) # 24x24x24
+        img_T_center = Cropping3D(cropping=20, name='crop_center_T')(img_T) # 24x24x24
+
         # Transform S
-        warped_S = self.transformation([img_S, phi])
+        warped_S = self.transformation([img_S_center, phi])
 
         # Use Python partial to provide loss function with additional deformable field argument
         partial_gp_loss = partial(self.gradient_penalty_loss, phi=phi)
@@ -96,12 +115,18 @@ class GANUnetModel64():
         self.discriminator.trainable = False
 
         # Discriminators determines validity of translated images / condition pairs
-        validity = self.discriminator([warped_S, img_T])
+        validity = self.discriminator([warped_S, img_T_center])
 
         self.combined = Model(inputs=[img_S, img_T], outputs=validity)
         self.combined.summary()
         self.combined.compile(loss = partial_gp_loss, optimizer=optimizerG)
 
+        # one call per iteration computes the warped image with a single forward pass of the generator and the warp,
+        # then trains the discriminator and the generator with their train_on_batch calls, or the discriminator with
+        # one step on the sum of its losses (sum_d_losses, concat_d_batches)
+        self.train_step = GANTrainStep(self.combined, self.discriminator, warped=warped_S, condition=img_T_center,
+                                       concat_d_batches=concat_d_batches, sum_d_losses=sum_d_losses)
+
         if self.DEBUG:
             log_path = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/logs_ganunet/'
             os.makedirs(log_path, exist_ok=True)
@@ -109,6 +134,7 @@ class GANUnetModel64():
             self.callback.set_model(self.combined)
 
         self.data_loader = DataLoader(batch_sz=self.batch_sz,
+                                      center_size=self.crop_size_d,
                                       dataset_name='fly',
                                       use_golden=True)
 
@@ -171,6 +197,27 @@ class GANUnetModel64():
             return layer
 
 
+        def gap_filling(input_tensor,
+                        n_filters,
+                        n_convs,
+                        cropping,
+                        name=''):
+            """
+            Gap filling of a skip connection: n_convs valid convolutions, cropped to the size of the upsampled tensor.
+            With crop_gap_inputs the skip connection is cropped before the convolutions, only the region the cropped
+            output depends on is convolved. The output is the same in inference mode, in training mode the batch
+            normalizations of the gap convolutions take their statistics over the cropped region only.
+            """
+            layer = input_tensor
+            if self.crop_gap_inputs:
+                layer = Cropping3D(cropping, name=name + '_crop')(layer)
+            for i in range(1, n_convs + 1):
+                layer = conv3d(input_tensor=layer, n_filters=n_filters, padding='valid', name=name + '_' + str(i))
+            if not self.crop_gap_inputs:
+                layer = Cropping3D(cropping)(layer)
+            return layer
+
+
         input_shape = self.input_shape_g
         img_S = Input(shape=input_shape, name='input_img_S')                                            # 64x64x64
         img_T = Input(shape=input_shape, name='input_img_T')                                            # 64x64x64
@@ -194,20 +241,14 @@ class GANUnetModel64():
 
         # upsampling with gap filling
         up2 = deconv3d(input_tensor=center, n_filters = 2*self.gf, padding='same', name='up2')          # 18x18x18
-        gap2 = conv3d(input_tensor=down2, n_filters=2*self.gf, padding='valid', name='gap2_1')          # 24x24x24
-        gap2 = conv3d(input_tensor=gap2, n_filters=2*self.gf, padding='valid', name='gap2_2')           # 22x22x22
-        up2 = concatenate([Cropping3D(2)(gap2), up2], name='up2concat')                                 # 18x18x18
+        gap2 = gap_filling(input_tensor=down2, n_filters=2*self.gf, n_convs=2, cropping=2, name='gap2')  # 26 -> 22 -> 18
+        up2 = concatenate([gap2, up2], name='up2concat')                                                # 18x18x18
         up2 = conv3d(input_tensor=up2, n_filters=2*self.gf, padding='valid', name='up2conv_1')          # 16x16x16
         up2 = conv3d(input_tensor=up2, n_filters=2*self.gf, padding='valid', name='up2conv_2')          # 14x14x14
 
         up1 = deconv3d(input_tensor=up2, n_filters=self.gf, padding='same', name='up1')                 # 28x28x28
-        gap1 = conv3d(input_tensor=down1, n_filters=self.gf, padding='valid', name='gap1_1')            # 58x58x58
-        gap1 = conv3d(input_tensor=gap1, n_filters=self.gf, padding='valid', name='gap1_2')             # 56x56x56
-        gap1 = conv3d(input_tensor=gap1, n_filters=self.gf, padding='valid', name='gap1_3')             # 54x54x54
-        gap1 = conv3d(input_tensor=gap1, n_filters=self.gf, padding='valid', name='gap1_4')             # 52x52x52
-        gap1 = conv3d(input_tensor=gap1, n_filters=self.gf, padding='valid', name='gap1_5')             # 50x50x50
-        gap1 = conv3d(input_tensor=gap1, n_filters=self.gf, padding='valid', name='gap1_6')             # 48x48x48
-        up1 = concatenate([Cropping3D(10)(gap1), up1], name='up1concat')                                # 28x28x28
+        gap1 = gap_filling(input_tensor=down1, n_filters=self.gf, n_convs=6, cropping=10, name='gap1')   # 60 -> 48 -> 28
+        up1 = concatenate([gap1, up1], name='up1concat')                                                # 28x28x28
         up1 = conv3d(input_tensor=up1, n_filters=self.gf, padding='valid', name='up1conv_1')            # 26x26x26
         up1 = conv3d(input_tensor=up1, n_filters=self.gf, padding='valid', name='up1conv_2')            # 24x24x24
 
@@ -231,13 +272,11 @@ class GANUnetModel64():
             return d
 
         img_A = Input(shape=self.input_shape_d, name='input_img_A')             # 24x24x24 warped_img or reference
-        img_T = Input(shape=self.input_shape_g, name='input_img_T')             # 64x64x64 template
-
-        img_T_cropped = Cropping3D(cropping=20)(img_T)  # 24x24x24
+        img_T = Input(shape=self.input_shape_d, name='input_img_T')             # 24x24x24 center of the template
 
         # Concatenate image and conditioning image by channels to produce input
-        #combined_imgs = Concatenate(axis=-1, name='combine_imgs_d')([img_A, img_T_cropped])
-        combined_imgs = Add(name='combine_imgs_d')([img_A, img_T_cropped])
+        #combined_imgs = Concatenate(axis=-1, name='combine_imgs_d')([img_A, img_T])
+        combined_imgs = Add(name='combine_imgs_d')([img_A, img_T])
 
         d1 = d_layer(combined_imgs, self.df, bn=False, name='d1')               # 24x24x24
         d2 = d_layer(d1, self.df*2, name='d2')                                  # 24x24x24
@@ -278,13 +317,11 @@ class GANUnetModel64():
             return d
 
         img_A =  Input(shape=self.input_shape_d, name='input_img_A')             # 24x24x24 warped_img or reference
-        img_T = Input(shape=self.input_shape_g, name='input_img_T')             # 64x64x64 template
-
-        img_T_cropped = Cropping3D(cropping=20)(img_T)  # 24x24x24
+        img_T = Input(shape=self.input_shape_d, name='input_img_T')             # 24x24x24 center of the template
 
         # Concatenate image and conditioning image by channels to produce input
-        #combined_imgs = Concatenate(axis=-1)([img_A, img_T_cropped])
-        combined_imgs = Add(name='combine_imgs_d')([img_A, img_T_cropped])
+        #combined_imgs = Concatenate(axis=-1)([img_A, img_T])
+        combined_imgs = Add(name='combine_imgs_d')([img_A, img_T])
         d1 = d_layer(combined_imgs, self.df, bn=False, name='d1')
         d2 = d_layer(d1, self.df*2, name='d2')
         d3 = d_layer(d2, self.df*4, name='d3')
@@ -303,11 +340,10 @@ class GANUnetModel64():
     Deformable Transformation Layer    
     """
     def build_transformation(self):
-        img_S = Input(shape=self.input_shape_g, name='input_img_S_transform')  # 64x64x64
+        img_S = Input(shape=self.input_shape_d, name='input_img_S_transform')  # 24x24x24 center of the subject
         phi = Input(shape=self.output_shape_g, name='input_phi_transform')     # 24x24x24
 
-        img_S_cropped = Cropping3D(cropping=20)(img_S)  # 24x24x24
-        warped_S = Lambda(dense_image_warp_3D, output_shape=(24,24,24,1))([img_S_cropped, phi])
+        warped_S = Lambda(dense_image_warp_3D_lean, output_shape=(24,24,24,1))([img_S, phi])
 
         return Model([img_S, phi], warped_S,  name='transformation_layer')
 
@@ -328,14 +364,8 @@ class GANUnetModel64():
         #return lr
         #
         lr = K.mean(K.binary_crossentropy(y_true, y_pred), axis=-1)
-        # compute the numerical gradient of phi
-        gradients = numerical_gradient_3D(phi)
-        # #if self.DEBUG: gradients = K.print_tensor(gradients, message='gradients are:')
-        #
-        # compute the euclidean norm by squaring ...
-        gradients_sqr = K.square(gradients)
-        #   ... summing over the rows ...
-        gradients_sqr_sum = K.sum(gradients_sqr, axis=np.arange(1, len(gradients_sqr.shape)))
+        # squares of the numerical gradient of phi summed over the voxels, one conv3d pass (see regularizers)
+        gradients_sqr_sum = flow_regularizer(phi, gradient_weight=0., summed_gradient_weight=1.)
         # #   ... and sqrt
         # #gradient_l2_norm = K.sqrt(gradients_sqr_sum)
         # # compute lambda * (1 - ||grad||)^2 still for each single sample
@@ -348,13 +378,10 @@ class GANUnetModel64():
     """
     Training
     """
-    def train(self, epochs, batch_size=1, sample_interval=50):
+    def train(self, epochs, batch_size=1, sample_interval=50, batch_workers=0):
 
         # Adversarial loss ground truths
         disc_patch = self.output_shape_d
-        input_sz = 64
-        output_sz = 24
-        gap = int((input_sz - output_sz)/2)
 
         # hard labels
         validhard = np.ones((self.batch_sz,) + disc_patch)
@@ -373,66 +400,38 @@ class GANUnetModel64():
         fakesoft = np.random.uniform(low=0.0, high=0.3, size=(self.batch_sz,) + disc_patch)
 
 
+        # crop sampling and augmentation of the next batches run while the model trains on this one, the workers
+        # are started again for every epoch but the shared volumes and batch buffers are set up once
+        if batch_workers:
+            # worker processes fill a ring of shared batch buffers, the loop gets views of them
+            prefetcher = SharedBatchRing(self.data_loader, n_workers=batch_workers)
+        else:
+            prefetcher = BatchPrefetcher(self.data_loader.load_batch, queue_depth=4)
+
         start_time = datetime.datetime.now()
         for epoch in range(epochs):
-            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(self.data_loader.load_batch()):
-                # ---------------------
-                #  Train Discriminator
-                # ---------------------
+            for batch_i, (batch_img, batch_img_template, batch_img_golden,
+                          batch_img_center, batch_img_template_center, batch_img_golden_center) in enumerate(prefetcher):
                 #assert not np.any(np.isnan(batch_img))
                 #assert not np.any(np.isnan(batch_img_template))
-                phi = self.generator.predict([batch_img, batch_img_template]) #24x24x24
-                #assert not np.any(np.isnan(phi))
-
-                # deformable transformation
-                transform = self.transformation.predict([batch_img, phi])     #24x24x24
-                #assert not np.any(np.isnan(transform))
-
-                # Create a ref image by perturbing th subject image with the template image
-                perturbation_factor_alpha = 0.1 if epoch > epochs/2 else 0.2
-                batch_ref = perturbation_factor_alpha * batch_img + (1- perturbation_factor_alpha) * batch_img_template #64x64x64
-
-                batch_img_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels), dtype=batch_img.dtype)
-                batch_ref_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels), dtype=batch_ref.dtype)
-                batch_temp_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels), dtype=batch_img_template.dtype)
-                batch_golden_sub = np.zeros((self.batch_sz, output_sz, output_sz, output_sz, self.channels), dtype=batch_img_golden.dtype)
-
-                # take only (24,24,24) from the (64,64,64) size
-                batch_img_sub[:, :, :, :, :] = batch_img[:, 0 + gap:0 + gap + output_sz,
-                                                            0 + gap:0 + gap + output_sz,
-                                                            0 + gap:0 + gap + output_sz, :]
-                batch_ref_sub[:, :, :, :, :] = batch_ref[:, 0 + gap:0 + gap + output_sz,
-                                                            0 + gap:0 + gap + output_sz,
-                                                            0 + gap:0 + gap + output_sz, :]
-                batch_golden_sub[:, :, :, :, :] = batch_img_golden[:, 0 + gap:0 + gap + output_sz,
-                                                            0 + gap:0 + gap + output_sz,
-                                                            0 + gap:0 + gap + output_sz, :]
-                batch_temp_sub[:, :, :, :, :] = batch_img_template[:, 0 + gap:0 + gap + output_sz,
-                                                                      0 + gap:0 + gap + output_sz,
-                                                                      0 + gap:0 + gap + output_sz, :]
-
-                #assert not np.any(np.isnan(batch_img_sub))
-                #assert not np.any(np.isnan(batch_ref_sub))
-                #assert not np.any(np.isnan(batch_temp_sub))
-
-                # Train the discriminator (R -> T is valid, S -> T is fake)
+
+                # the discriminator only sees the center of the crops, the loader yields views of it
+                batch_golden_sub = batch_img_golden_center
+
+                # Labels of the discriminator (R -> T is valid, S -> T is fake)
                 # Noisy and soft labels
-                self.discriminator.trainable = True
                 noisy_prob = 1 - np.sqrt(1 - np.random.random()) # peak near low values and falling off towards high values
                 if noisy_prob < 0.85: # occasionally flip labels to introduce noisy labels
-                    d_loss_real = self.discriminator.train_on_batch([batch_golden_sub, batch_img_template], validhard)
-                    d_loss_fake = self.discriminator.train_on_batch([transform, batch_img_template], fakehard)
+                    real_labels = validhard
+                    fake_labels = fakehard
                 else:
-                    d_loss_real = self.discriminator.train_on_batch([batch_golden_sub, batch_img_template], fakehard)
-                    d_loss_fake = self.discriminator.train_on_batch([transform, batch_img_template], validhard)
+                    real_labels = fakehard
+                    fake_labels = validhard
 
+                # the discriminator (real and warped batch) and then the generator, on one forward pass of the generator
+                d_loss_real, d_loss_fake, g_loss = self.train_step([batch_img, batch_img_template], batch_golden_sub,
+                                                                   real_labels, fake_labels, [validhard])
                 d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
-                self.discriminator.trainable = False
-                # ---------------------
-                #  Train Generator
-                # ---------------------
-                # Train the generator (to fool the discriminator)
-                g_loss = self.combined.train_on_batch([batch_img, batch_img_template], validhard)
 
                 elapsed_time = datetime.datetime.now() - start_time
 
@@ -454,6 +453,9 @@ class GANUnetModel64():
                 if batch_i % sample_interval == 0 and epoch != 0 and epoch % 5 == 0:
                     self.sample_images(epoch, batch_i)
 
+            print(prefetcher.report())
+        prefetcher.close()
+
 
     def write_log(self, callback, names, logs, batch_no):
         #https://github.com/eriklindernoren/Keras-GAN/issues/52
@@ -477,40 +479,9 @@ class GANUnetModel64():
         # imgs_T_mask = self.data_loader.mask_template
         # imgs_S = imgs_S * imgs_T_mask
 
-        predict_img = np.zeros(imgs_S.shape, dtype=imgs_S.dtype)
-        #predict_phi = np.zeros(imgs_S.shape + (3,), dtype=imgs_S.dtype)
-
-        input_sz = (64, 64, 64)
-        step = (24, 24, 24)
-
-        gap = (int((input_sz[0] - step[0]) / 2), int((input_sz[1] - step[1]) / 2), int((input_sz[2] - step[2]) / 2))
-        start_time = datetime.datetime.now()
-        for row in range(0, imgs_S.shape[0] - input_sz[0], step[0]):
-            for col in range(0, imgs_S.shape[1] - input_sz[1], step[1]):
-                for vol in range(0, imgs_S.shape[2] - input_sz[2], step[2]):
-                    patch_sub_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_S.dtype)
-                    patch_templ_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_T.dtype)
-
-                    patch_sub_img[0, :, :, :, 0] = imgs_S[row:row + input_sz[0],
-                                                        col:col + input_sz[1],
-                                                        vol:vol + input_sz[2]]
-                    patch_templ_img[0, :, :, :, 0] = imgs_T[row:row + input_sz[0],
-                                                     col:col + input_sz[1],
-                                                     vol:vol + input_sz[2]]
-
-                    patch_predict_phi = self.generator.predict([patch_sub_img, patch_templ_img])
-                    patch_predict_warped = self.transformation.predict([patch_sub_img, patch_predict_phi])
-
-                    predict_img[row + gap[0]:row + gap[0] + step[0],
-                                col + gap[1]:col + gap[1] + step[1],
-                                vol + gap[2]:vol + gap[2] + step[2]] = patch_predict_warped[0, :, :, :, 0]
-                    # predict_phi[row + gap[0]:row + gap[0] + step[0],
-                    #            col + gap[1]:col + gap[1] + step[1],
-                    #            vol + gap[2]:vol + gap[2] + step[2],:] = patch_predict_phi[0, :, :, :, :]
-
-                    # predict_img[row :row + input_sz[0], col :col + input_sz[1], : ] = patch_predict_warped[0, :, :, :, 0]
-        elapsed_time = datetime.datetime.now() - start_time
-        print(" --- Prediction time: %s" % (elapsed_time))
+        predict_img, _ = predict_tiled(self.generator, self.transformation, imgs_S, imgs_T,
+                                       input_sz=(64, 64, 64), step=(24, 24, 24),
+                                       batch_sz=self.sample_batch_sz)
 
         nrrd.write(path+"generated_ganunet/%d_%d_%d" % (epoch, batch_i, idx), predict_img)
         # self.data_loader._write_nifti(path+"generated_v1_2/phi%d_%d_%d" % (epoch, batch_i, idx), predict_phi)
@@ -27,7 +27,12 @@ import os
 
 
 from data_loader import DataLoader   #To run on the cluster'
-from helpers import dense_image_warp_3D, numerical_gradient_3D #To run on the cluster'
+from prefetch import BatchPrefetcher
+from shared_batches import SharedBatchRing
+from train_step import GANTrainStep
+from tiled_inference import predict_tiled
+from helpers import dense_image_warp_3D_lean #To run on the cluster'
+from regularizers import flow_regularizer
 
 
 __author__ = 'elmalakis'
@@ -35,7 +40,13 @@ __author__ = 'elmalakis'
 
 class GANUnetNoGapFillingModel():
 
-    def __init__(self):
+    def __init__(self, concat_d_batches=False, sum_d_losses=False):
+        """
+        :param concat_d_batches: bool - run the discriminator once on the real and warped batches concatenated, its
+                                 batch normalizations then take their statistics over both batches, so the training
+                                 of the discriminator changes. Needs sum_d_losses (see GANTrainStep)
+        :param sum_d_losses: bool - train the discriminator with one step on the sum of its real and fake losses
+        """
 
         K.set_image_data_format('channels_last')  # set format
         K.set_image_dim_ordering('tf')
@@ -47,6 +58,7 @@ class GANUnetNoGapFillingModel():
         self.img_vols = 192
         self.channels = 1
         self.batch_sz = 1  # for testing locally to avoid memory allocation
+        self.sample_batch_sz = 1 # number of tiles per predict call in sample_images
 
         self.crop_size = (self.img_rows, self.img_cols, self.img_vols)
 
@@ -113,6 +125,12 @@ class GANUnetNoGapFillingModel():
         self.combined.summary()
         self.combined.compile(loss = partial_gp_loss, optimizer=optimizerG)
 
+        # one call per iteration computes the warped image with a single forward pass of the generator and the warp,
+        # then trains the discriminator and the generator with their train_on_batch calls, or the discriminator with
+        # one step on the sum of its losses (sum_d_losses, concat_d_batches)
+        self.train_step = GANTrainStep(self.combined, self.discriminator, warped=warped_S, condition=img_T,
+                                       concat_d_batches=concat_d_batches, sum_d_losses=sum_d_losses)
+
         if self.DEBUG:
             log_path = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/logs_ganunet_nogap/'
             os.makedirs(log_path, exist_ok=True)
@@ -275,7 +293,7 @@ class GANUnetNoGapFillingModel():
         img_S = Input(shape=self.img_shape, name='input_img_S_transform')      # 192
         phi = Input(shape=self.output_shape_g, name='input_phi_transform')     # 192
 
-        warped_S = Lambda(dense_image_warp_3D, output_shape=self.input_shape_d)([img_S, phi])
+        warped_S = Lambda(dense_image_warp_3D_lean, output_shape=self.input_shape_d)([img_S, phi])
 
         return Model([img_S, phi], warped_S,  name='transformation_layer')
 
@@ -288,14 +306,8 @@ class GANUnetNoGapFillingModel():
         Computes gradient penalty on phi to ensure smoothness
         """
         lr = K.mean(K.binary_crossentropy(y_true, y_pred), axis=-1)
-        # compute the numerical gradient of phi
-        gradients = numerical_gradient_3D(phi)
-        # #if self.DEBUG: gradients = K.print_tensor(gradients, message='gradients are:')
-        #
-        # compute the euclidean norm by squaring ...
-        gradients_sqr = K.square(gradients)
-        #   ... summing over the rows ...
-        gradients_sqr_sum = K.sum(gradients_sqr, axis=np.arange(1, len(gradients_sqr.shape)))
+        # squares of the numerical gradient of phi summed over the voxels, one conv3d pass (see regularizers)
+        gradients_sqr_sum = flow_regularizer(phi, gradient_weight=0., summed_gradient_weight=1.)
         # #   ... and sqrt
         gradient_l2_norm = K.sqrt(gradients_sqr_sum)
         # # compute lambda * (1 - ||grad||)^2 still for each single sample
@@ -308,34 +320,36 @@ class GANUnetNoGapFillingModel():
     """
     Training
     """
-    def train(self, epochs, batch_size=1, sample_interval=50):
+    def train(self, epochs, batch_size=1, sample_interval=50, batch_workers=0):
 
         # Adversarial loss ground truths
         # hard labels
         valid = np.ones((self.batch_sz,) + self.output_shape_d)
         fake = np.zeros((self.batch_sz,) + self.output_shape_d)
 
+        # crop sampling and augmentation of the next batches run while the model trains on this one, the workers
+        # are started again for every epoch but the shared volumes and batch buffers are set up once
+        if batch_workers:
+            # worker processes fill a ring of shared batch buffers, the loop gets views of them
+            prefetcher = SharedBatchRing(self.data_loader, n_workers=batch_workers)
+        else:
+            prefetcher = BatchPrefetcher(self.data_loader.load_batch, queue_depth=4)
+
         start_time = datetime.datetime.now()
         for epoch in range(epochs):
-            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(self.data_loader.load_batch()):
-                # ---------------------
-                #  Train Discriminator
-                # ---------------------
+            for batch_i, (batch_img, batch_img_template, batch_img_golden) in enumerate(prefetcher):
                 # Condition on B and generate a translate
-                phi = self.generator.predict([batch_img, batch_img_template])
-                transform = self.transformation.predict([batch_img, phi])  # 256x256x256
                 # Create a ref image by perturbing th subject image with the template image
                 perturbation_factor_alpha = 0.1 if epoch > epochs / 2 else 0.2
                 batch_ref = perturbation_factor_alpha * batch_img + (1 - perturbation_factor_alpha) * batch_img_template
 
-                d_loss_real = self.discriminator.train_on_batch([batch_ref, batch_img_template], valid)
-                d_loss_fake = self.discriminator.train_on_batch([transform, batch_img_template], fake)
-                d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
+                real_labels = valid
+                fake_labels = fake
 
-                # ---------------------
-                #  Train Generator
-                # ---------------------
-                g_loss = self.combined.train_on_batch([batch_img, batch_img_template], valid)
+                # the discriminator (real and warped batch) and then the generator, on one forward pass of the generator
+                d_loss_real, d_loss_fake, g_loss = self.train_step([batch_img, batch_img_template], batch_ref,
+                                                                   real_labels, fake_labels, [valid])
+                d_loss = 0.5 * np.add(d_loss_real, d_loss_fake)
 
                 elapsed_time = datetime.datetime.now() - start_time
 
@@ -357,6 +371,9 @@ class GANUnetNoGapFillingModel():
                 if batch_i % sample_interval == 0 and epoch != 0 and epoch % 5 == 0:
                     self.sample_images(epoch, batch_i)
 
+            print(prefetcher.report())
+        prefetcher.close()
+
 
     def write_log(self, callback, names, logs, batch_no):
         #https://github.com/eriklindernoren/Keras-GAN/issues/52
@@ -376,40 +393,10 @@ class GANUnetNoGapFillingModel():
         idx, imgs_S = self.data_loader.load_data(is_validation=True)
         imgs_T = self.data_loader.img_template
 
-        predict_img = np.zeros(imgs_S.shape, dtype=imgs_S.dtype)
-        predict_phi = np.zeros(imgs_S.shape + (3,), dtype=imgs_S.dtype)
-
-        input_sz = self.crop_size
-        output_sz = (self.output_size, self.output_size, self.output_size)
-        step = (64, 64, 64)
-
-        start_time = datetime.datetime.now()
-
-        for row in range(0, imgs_S.shape[0] - input_sz[0], step[0]):
-            for col in range(0, imgs_S.shape[1] - input_sz[1], step[1]):
-                for vol in range(0, imgs_S.shape[2] - input_sz[2], step[2]):
-                    patch_sub_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_S.dtype)
-                    patch_templ_img = np.zeros((1, input_sz[0], input_sz[1], input_sz[2], 1), dtype=imgs_T.dtype)
-
-                    patch_sub_img[0, :, :, :, 0] = imgs_S[row:row + input_sz[0],
-                                                   col:col + input_sz[1],
-                                                   vol:vol + input_sz[2]]
-                    patch_templ_img[0, :, :, :, 0] = imgs_T[row:row + input_sz[0],
-                                                     col:col + input_sz[1],
-                                                     vol:vol + input_sz[2]]
-
-                    patch_predict_phi = self.generator.predict([patch_sub_img, patch_templ_img])
-                    patch_predict_warped = self.transformation.predict([patch_sub_img, patch_predict_phi])
-
-                    predict_img[row:row + output_sz[0],
-                                col:col + output_sz[1],
-                                vol:vol + output_sz[2]] = patch_predict_warped[0, :, :, :, 0]
-                    predict_phi[row :row  + output_sz[0],
-                               col :col  + output_sz[1],
-                               vol :vol  + output_sz[2],:] = patch_predict_phi[0, :, :, :, :]
-
-        elapsed_time = datetime.datetime.now() - start_time
-        print(" --- Prediction time: %s" % (elapsed_time))
+        # the warped patches are written at the origin of the tiles, not at the center
+        predict_img, predict_phi = predict_tiled(self.generator, self.transformation, imgs_S, imgs_T,
+                                                 input_sz=self.crop_size, step=(64, 64, 64), output_offset=(0, 0, 0),
+                                                 batch_sz=self.sample_batch_sz, with_phi=True)
 
         nrrd.write(path+"generated_unet_nogap/%d_%d_%d" % (epoch, batch_i, idx), predict_img)
         self.data_loader._write_nifti(path+"generated_unet_nogap/phi%d_%d_%d" % (epoch, batch_i, idx), predict_phi)
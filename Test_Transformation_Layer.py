@@ -28,7 +28,7 @@ import os
 
 
 from data_loader import DataLoader   #To run on the cluster'
-from helpers import dense_image_warp_3D, numerical_gradient_3D #To run on the cluster'
+from warp import warp
 
 
 __author__ = 'elmalakis'
@@ -76,9 +76,8 @@ class TestTransformationLayer():
         curr_phi = goldenfilepath + '20161102_32_C1_Scope_1_C1_down/deformationField_noAffine.nrrd'
         curr_phi, phi_header = nrrd.read(curr_phi)
         print('phi size: '+str(curr_phi.shape)) #(3,1121, 546, 334)
-        curr_phi = curr_phi.transpose(1,2,3,0)
-        print('phi size: ' + str(curr_phi.shape))  # (1121, 546, 334, 3)
-        return np.float32(curr_phi)
+        # keep the (3, x, y, z) layout, only the patches are moved to channel last (no full-volume transpose)
+        return np.asarray(curr_phi, dtype=np.float32)
 
 
 
@@ -90,7 +89,8 @@ class TestTransformationLayer():
         phi = Input(shape=self.output_shape_g, name='input_phi_transform')     # 24x24x24
 
         #img_S_cropped = Cropping3D(cropping=20)(img_S)  # 24x24x24
-        warped_S = Lambda(dense_image_warp_3D, output_shape=(64,64,64,1))([img_S, phi])
+        # the graph warp of warp.warp (helpers.dense_image_warp_3D)
+        warped_S = Lambda(lambda tensors: warp(tensors[0], tensors[1], backend='tf'), output_shape=(64,64,64,1))([img_S, phi])
 
         return Model([img_S, phi], warped_S,  name='transformation_layer')
 
@@ -117,11 +117,12 @@ class TestTransformationLayer():
                     patch_sub_img[0, :, :, :, 0] = self.img[row:row + input_sz[0],
                                                           col:col + input_sz[1],
                                                           vol:vol + input_sz[2]]
-                    patch_sub_phi[0, :, :, :, :] = self.phi[row:row + input_sz[0],
-                                                          col:col + input_sz[1],
-                                                          vol:vol + input_sz[2]]
+                    patch_sub_phi[0, :, :, :, :] = np.moveaxis(self.phi[:, row:row + input_sz[0],
+                                                                         col:col + input_sz[1],
+                                                                         vol:vol + input_sz[2]], 0, -1)
 
-                    patch_predict_warped = self.transformation.predict([patch_sub_img, patch_sub_phi])
+                    # the fastest backend for the patch size (see warp.calibrate), the same warp as the transformation layer
+                    patch_predict_warped = warp(patch_sub_img, patch_sub_phi)
 
                     predict_img[row :row + input_sz[0],
                                 col :col + input_sz[1],
@@ -132,6 +133,22 @@ class TestTransformationLayer():
 
         nrrd.write(path+"generated_with_phi/%d_%d_%d" % (epoch, batch_i, idx), predict_img)
 
+    def sample_images_tiled(self, epoch=0, batch_i=0, n_workers=None):
+        """
+        Warp the whole subject with the tiled backend of warp.warp instead of the transformation layer: the tiles read
+        a halo as large as their displacements, so nothing is clamped at the tile borders and the edge strips are
+        warped too
+        """
+        path = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/'
+        os.makedirs(path+'generated_with_phi/' , exist_ok=True)
+
+        idx = 0
+        print('--- start tiled transformation ---')
+        # views with the batch and channel axes, phi keeps its (3, x, y, z) layout in memory
+        predict_img = warp(self.img[None, :, :, :, None], np.moveaxis(self.phi, 0, -1)[None], backend='tiled',
+                           tile_shape=self.crop_size_g, n_workers=n_workers)[0, :, :, :, 0]
+
+        nrrd.write(path+"generated_with_phi/%d_%d_%d_tiled" % (epoch, batch_i, idx), predict_img)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import numpy as np
+
+__author__ = 'elmalakis'
+
+
+"""
+Data augmentation of a whole batch
+Every sample gets a random flip along x, a random flip along z and a random rotation by k*90 degrees in the x-y plane.
+The samples are grouped by their transform so every group is transformed with one gather, one composed view and
+one write back, instead of a full-crop copy per sample and per transform.
+"""
+
+
+def random_transforms(batch_sz):
+    """
+    :param batch_sz: int - size of the batch
+    :return: x_flip, z_flip, rot_angle - one random transform per sample
+    """
+    x_flip = np.random.randint(2, size=batch_sz)
+    z_flip = np.random.randint(2, size=batch_sz)
+    rot_angle = np.random.randint(4, size=batch_sz)
+    return x_flip, z_flip, rot_angle
+
+
+def transform_view(sub_batch, x_flip, z_flip, rot_angle):
+    """
+    Apply one transform to a (b, x, y, z, c) sub-batch, returns a view
+    """
+    if x_flip:
+        sub_batch = np.flip(sub_batch, axis=1)
+    if z_flip:
+        sub_batch = np.flip(sub_batch, axis=3)
+    if rot_angle:
+        sub_batch = np.rot90(sub_batch, rot_angle, axes=(1, 2))
+    return sub_batch
+
+
+def vector_transform(x_flip, z_flip, rot_angle):
+    """
+    Transform of the components of a vector field (e.g. phi, component i along axis i) that matches transform_view:
+    a flip negates the component along the flipped axis and a rotation by k*90 degrees in the x-y plane maps
+    (u0, u1) to (-u1, u0), (-u0, -u1) or (u1, -u0) for k = 1, 2, 3
+    :return: perm, sign - the new components are old[..., perm] * sign
+    """
+    flip_sign = np.array([-1. if x_flip else 1., 1., -1. if z_flip else 1.], dtype=np.float32)
+    perm, rot_sign = {0: ([0, 1, 2], [1., 1., 1.]),
+                      1: ([1, 0, 2], [-1., 1., 1.]),
+                      2: ([0, 1, 2], [-1., -1., 1.]),
+                      3: ([1, 0, 2], [1., -1., 1.])}[rot_angle % 4]
+    return perm, np.array(rot_sign, dtype=np.float32) * flip_sign[perm]
+
+
+def augment_batch(arrays, x_flip, z_flip, rot_angle, vector_arrays=()):
+    """
+    Apply the same random transform in place to all the paired arrays of a batch
+    :param arrays: list of 5-D arrays (batch, x, y, z, channels), e.g. image, template and golden
+    :param x_flip: array of 0/1 - flip the sample along x
+    :param z_flip: array of 0/1 - flip the sample along z
+    :param rot_angle: array of int - rotate the sample by rot_angle*90 degrees in the x-y plane
+    :param vector_arrays: list of 5-D arrays (batch, x, y, z, 3) of vector fields, e.g. phi, whose components are
+                          rotated and flipped with the voxels (see vector_transform)
+    """
+    codes = 8 * np.asarray(x_flip) + 4 * np.asarray(z_flip) + np.asarray(rot_angle)
+    for code in np.unique(codes):
+        if code == 0:
+            continue  # identity
+        idx = np.flatnonzero(codes == code)
+        # a contiguous group is transformed through a slice, anything else needs one gather
+        if idx[-1] - idx[0] + 1 == len(idx):
+            idx = slice(idx[0], idx[-1] + 1)
+        for a in arrays:
+            a[idx] = transform_view(a[idx], code // 8, (code // 4) % 2, code % 4)
+        if len(vector_arrays):
+            perm, sign = vector_transform(code // 8, (code // 4) % 2, code % 4)
+            for a in vector_arrays:
+                a[idx] = transform_view(a[idx], code // 8, (code // 4) % 2, code % 4)[..., perm] * sign
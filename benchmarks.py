@@ -0,0 +1,573 @@
+from __future__ import print_function, division
+
+import sys
+import time
+import numpy as np
+
+from augmentation import random_transforms, augment_batch
+
+__author__ = 'elmalakis'
+
+
+"""
+Benchmarks of the data pipeline, of the warps and of the training step
+Run on the cluster with: python benchmarks.py [loader] [warp] [tf] [train]
+"""
+
+
+def _augment_per_sample(arrays, x_flip, z_flip, rot_angle):
+    """The previous per-sample augmentation of load_batch, kept as the baseline"""
+    for j in range(len(x_flip)):
+        for a in arrays:
+            if x_flip[j]:
+                a[j, :, :, :, 0] = np.flip(a[j, :, :, :, 0], axis=0)
+            if z_flip[j]:
+                a[j, :, :, :, 0] = np.flip(a[j, :, :, :, 0], axis=2)
+            if rot_angle[j]:
+                a[j, :, :, :, 0] = np.rot90(a[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
+
+
+def benchmark_augmentation(batch_sz=16, crop_sz=(64, 64, 64), n_arrays=3, n_repeats=20):
+    """Compare the grouped whole-batch augmentation with the per-sample loop, in samples per second"""
+    arrays = [np.random.rand(batch_sz, crop_sz[0], crop_sz[1], crop_sz[2], 1).astype('float32') for _ in range(n_arrays)]
+    transforms = [random_transforms(batch_sz) for _ in range(n_repeats)]
+
+    results = {}
+    for name, fn in [('per sample', _augment_per_sample), ('grouped', augment_batch)]:
+        start_time = time.time()
+        for x_flip, z_flip, rot_angle in transforms:
+            fn(arrays, x_flip, z_flip, rot_angle)
+        elapsed_time = time.time() - start_time
+        results[name] = batch_sz * n_repeats / elapsed_time
+        print(' --- augmentation %s: %.1f samples/s (%d arrays of %s)' % (name, results[name], n_arrays, str(crop_sz)))
+    print(' --- augmentation speedup: %.2fx' % (results['grouped'] / results['per sample']))
+    return results
+
+
+def benchmark_loader(data_loader, n_batches=20):
+    """Throughput of DataLoader.load_batch in batches and samples per second"""
+    batches = data_loader.load_batch()
+    next(batches)  # the first batch builds the crop origin index
+    start_time = time.time()
+    for i, batch in zip(range(n_batches), batches):
+        pass
+    elapsed_time = time.time() - start_time
+    n = i + 1
+    print(' --- loader: %.2f batches/s, %.1f samples/s' % (n / elapsed_time, n * data_loader.batch_sz / elapsed_time))
+    return n / elapsed_time
+
+
+def validate_trilinear_warp(batch_sz=2, input_sz=(40, 36, 32), output_sz=(24, 20, 16), max_disp=6.):
+    """
+    Compare the vectorized trilinear warp with the per-voxel loops of the dipy port, with displacements that also
+    move points out of the volume, and time both
+    """
+    from image_warping import _warp_3d, dense_image_warp_3D_trilinear
+
+    image = np.random.rand(batch_sz, input_sz[0], input_sz[1], input_sz[2], 1).astype('float32')
+    flow = (max_disp * (2 * np.random.rand(batch_sz, output_sz[0], output_sz[1], output_sz[2], 3) - 1)).astype('float32')
+
+    start_time = time.time()
+    # same as dense_image_warp_3D_dipy, which only supports 64^3 inputs and 24^3 flows
+    expected = np.stack([_warp_3d(np.transpose(image[b, :, :, :, 0], (2, 0, 1)),
+                                  np.transpose(flow[b], (2, 0, 1, 3))).transpose(1, 2, 0) for b in range(batch_sz)])
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    warped = dense_image_warp_3D_trilinear(image, flow)[..., 0]
+    vectorized_time = time.time() - start_time
+
+    max_error = np.max(np.abs(warped - expected))
+    print(' --- trilinear warp: max abs difference %g, loops %.2fs, vectorized %.4fs (%.0fx)'
+          % (max_error, loop_time, vectorized_time, loop_time / vectorized_time))
+    return max_error
+
+
+def benchmark_scipy_warp_scaling(batch_sz=16, input_sz=(64, 64, 64), output_sz=(24, 24, 24), order=3,
+                                 worker_counts=(1, 2, 4, 8), worker_type='thread', n_repeats=5):
+    """Throughput of dense_image_warp_3D_scikit in samples per second for an increasing number of workers"""
+    from image_warping import dense_image_warp_3D_scikit
+
+    image = np.random.rand(batch_sz, input_sz[0], input_sz[1], input_sz[2], 1).astype('float32')
+    flow = (4 * np.random.randn(batch_sz, output_sz[0], output_sz[1], output_sz[2], 3)).astype('float32')
+
+    results = {}
+    for n_workers in worker_counts:
+        dense_image_warp_3D_scikit(image, flow, order=order, n_workers=n_workers, worker_type=worker_type)  # start the pool
+        start_time = time.time()
+        for _ in range(n_repeats):
+            dense_image_warp_3D_scikit(image, flow, order=order, n_workers=n_workers, worker_type=worker_type)
+        results[n_workers] = batch_sz * n_repeats / (time.time() - start_time)
+        print(' --- scipy warp order %d, %d %s workers: %.1f samples/s (%.2fx)'
+              % (order, n_workers, worker_type, results[n_workers], results[n_workers] / results[worker_counts[0]]))
+    return results
+
+
+def benchmark_spline_cache(input_sz=(64, 64, 64), output_sz=(24, 24, 24), order=3, n_phis=10):
+    """Warp one volume with n_phis phis, with and without the spline coefficient cache"""
+    from image_warping import dense_image_warp_3D_scikit, SplineCoefficientCache
+
+    image = np.random.rand(1, input_sz[0], input_sz[1], input_sz[2], 1).astype('float32')
+    flows = [(4 * np.random.randn(1, output_sz[0], output_sz[1], output_sz[2], 3)).astype('float32') for _ in range(n_phis)]
+    spline_cache = SplineCoefficientCache()
+
+    results = {}
+    for name, cache in [('prefilter every warp', None), ('spline cache', spline_cache)]:
+        start_time = time.time()
+        warped = [dense_image_warp_3D_scikit(image, flow, order=order, n_workers=1, spline_cache=cache) for flow in flows]
+        results[name] = (time.time() - start_time, warped)
+        print(' --- %s: %.3fs for %d warps' % (name, results[name][0], n_phis))
+    max_error = max(np.max(np.abs(a - b)) for a, b in zip(results['prefilter every warp'][1], results['spline cache'][1]))
+    print(' --- spline cache speedup: %.2fx, max abs difference %g %s'
+          % (results['prefilter every warp'][0] / results['spline cache'][0], max_error, spline_cache.report()))
+    return results
+
+
+def benchmark_warp_plan(n_volumes=3, batch_sz=4, input_sz=(64, 64, 64), output_sz=(64, 64, 64)):
+    """Warp n_volumes volumes with one phi: one WarpPlan applied to all of them against one warp per volume"""
+    from image_warping import WarpPlan, interpolate_trilinear_3D
+
+    volumes = [np.random.rand(batch_sz, input_sz[0], input_sz[1], input_sz[2], 1).astype('float32') for _ in range(n_volumes)]
+    query_points = np.random.rand(batch_sz, output_sz[0], output_sz[1], output_sz[2], 3) * (np.array(input_sz) - 1)
+
+    start_time = time.time()
+    separate = [interpolate_trilinear_3D(v, query_points) for v in volumes]
+    separate_time = time.time() - start_time
+
+    start_time = time.time()
+    plan = WarpPlan(query_points, input_sz)
+    planned = [plan.apply(volumes[0])]  # the first apply computes the indices and weights
+    first_time = time.time() - start_time
+    planned += plan.apply_many(volumes[1:])
+    planned_time = time.time() - start_time
+
+    max_error = max(np.max(np.abs(a - b)) for a, b in zip(separate, planned))
+    print(' --- %d volumes: separate warps %.3fs, warp plan %.3fs (first %.3fs, then %.3fs per volume), speedup %.2fx, '
+          'max abs difference %g' % (n_volumes, separate_time, planned_time, first_time,
+                                     (planned_time - first_time) / max(n_volumes - 1, 1), separate_time / planned_time, max_error))
+    return separate_time, planned_time
+
+
+def validate_interpolation(batch_sz=2, size=(20, 16, 12), n_points=1000, max_disp=4.):
+    """
+    Compare helpers.interpolate_trilinear, the 8 gathers and the fused single gather, with
+    scipy.ndimage.map_coordinates (order 1, nearest edge, the clamping of the interpolation) on a non-cubic volume,
+    with query points inside and outside of it, and compare the gradients of both paths
+    """
+    import tensorflow as tf
+    from scipy.ndimage import map_coordinates
+    from helpers import interpolate_trilinear
+
+    image = np.random.rand(batch_sz, size[0], size[1], size[2], 2).astype('float32')
+    query_points = (np.random.rand(batch_sz, n_points, 3) * (np.array(size) - 1)
+                    + max_disp * (2 * np.random.rand(batch_sz, n_points, 3) - 1)).astype('float32')
+    expected = np.stack([np.stack([map_coordinates(image[b, ..., c], query_points[b].T, order=1, mode='nearest')
+                                   for c in range(image.shape[-1])], axis=-1) for b in range(batch_sz)])
+
+    outputs = {}
+    for fused in (False, True):
+        with tf.Graph().as_default():
+            image_in = tf.placeholder(tf.float32, shape=image.shape)
+            query_in = tf.placeholder(tf.float32, shape=query_points.shape)
+            interpolated = interpolate_trilinear(image_in, query_in, fused=fused)
+            gradients = tf.gradients(tf.reduce_sum(interpolated ** 2), [image_in, query_in])
+            with tf.Session() as sess:
+                outputs[fused] = sess.run([interpolated] + gradients, feed_dict={image_in: image, query_in: query_points})
+        print(' --- interpolate_trilinear %s %s: max abs difference with map_coordinates %g'
+              % ('fused' if fused else '8 gathers', str(size), np.max(np.abs(outputs[fused][0] - expected))))
+    max_errors = [np.max(np.abs(a - b)) for a, b in zip(outputs[False], outputs[True])]
+    print(' --- fused against 8 gathers: max abs difference values %g, d image %g, d query points %g'
+          % tuple(max_errors))
+    return max_errors
+
+
+def benchmark_interpolation(batch_sz=2, size=64, n_repeats=10):
+    """
+    Forward and forward + backward time on the CPU of helpers.interpolate_trilinear, the fused single gather against
+    the 8 gathers and lerp chain, on a size^3 warp
+    """
+    import tensorflow as tf
+    from helpers import interpolate_trilinear
+
+    image = np.random.rand(batch_sz, size, size, size, 1).astype('float32')
+    grid = np.stack(np.meshgrid(*[np.arange(size)] * 3, indexing='ij'), axis=-1).reshape(1, -1, 3)
+    query_points = (grid + 3 * np.random.randn(batch_sz, size ** 3, 3)).astype('float32')
+
+    results = {}
+    for fused in (False, True):
+        with tf.Graph().as_default(), tf.device('/cpu:0'):
+            image_in = tf.placeholder(tf.float32, shape=image.shape)
+            query_in = tf.placeholder(tf.float32, shape=query_points.shape)
+            interpolated = interpolate_trilinear(image_in, query_in, fused=fused)
+            gradients = tf.gradients(tf.reduce_sum(interpolated ** 2), [image_in, query_in])
+            with tf.Session() as sess:
+                feed = {image_in: image, query_in: query_points}
+                outputs = sess.run([interpolated] + gradients, feed_dict=feed)  # warm up
+                times = []
+                for fetches in ([interpolated], [interpolated] + gradients):
+                    start_time = time.time()
+                    for _ in range(n_repeats):
+                        sess.run(fetches, feed_dict=feed)
+                    times.append((time.time() - start_time) / n_repeats)
+        results[fused] = (times, outputs)
+        print(' --- interpolate_trilinear %s: forward %.3fs, forward + backward %.3fs'
+              % ('fused' if fused else '8 gathers', times[0], times[1]))
+    max_error = max(np.max(np.abs(a - b)) for a, b in zip(results[False][1], results[True][1]))
+    print(' --- fused speedup: forward %.2fx, forward + backward %.2fx, max abs difference %g'
+          % (results[False][0][0] / results[True][0][0], results[False][0][1] / results[True][0][1], max_error))
+    return results
+
+
+def benchmark_identity_grid(sizes=(24, 60, 128), batch_sz=1, n_repeats=20):
+    """
+    Forward time of helpers.dense_image_warp_3D at the sizes of the transformation layers of the models
+    (GANUnetModel64: 24^3, GANUnetModel148: 60^3, the pix2pix models: 128^3), with the identity grid rebuilt by a
+    meshgrid at every step (spatial shape unknown to the graph) against the cached constant grid (static shape)
+    """
+    import tensorflow as tf
+    from helpers import dense_image_warp_3D
+
+    results = {}
+    for size in sizes:
+        image = np.random.rand(batch_sz, size, size, size, 1).astype('float32')
+        flow = (3 * np.random.randn(batch_sz, size, size, size, 3)).astype('float32')
+        for static in (False, True):
+            with tf.Graph().as_default():
+                spatial = (size,) * 3 if static else (None,) * 3
+                image_in = tf.placeholder(tf.float32, shape=(None,) + spatial + (1,))
+                flow_in = tf.placeholder(tf.float32, shape=(None,) + spatial + (3,))
+                warped = dense_image_warp_3D([image_in, flow_in])
+                with tf.Session() as sess:
+                    feed = {image_in: image, flow_in: flow}
+                    output = sess.run(warped, feed_dict=feed)  # warm up
+                    start_time = time.time()
+                    for _ in range(n_repeats):
+                        sess.run(warped, feed_dict=feed)
+                    results[(size, static)] = ((time.time() - start_time) / n_repeats, output)
+        print(' --- dense_image_warp_3D %d^3: meshgrid %.4fs, cached grid %.4fs (%.2fx), max abs difference %g'
+              % (size, results[(size, False)][0], results[(size, True)][0],
+                 results[(size, False)][0] / results[(size, True)][0],
+                 np.max(np.abs(results[(size, False)][1] - results[(size, True)][1]))))
+    return results
+
+
+def validate_flow_regularizer(batch_sz=2, size=(20, 16, 12)):
+    """
+    Compare the penalties of regularizers.flow_regularizer on a non-cubic phi with the penalty of the models before,
+    the squares of helpers.numerical_gradient_3D summed per sample (values and gradients), and the gradient L2 with
+    the one of np.gradient (central differences inside, one-sided on the border)
+    """
+    import tensorflow as tf
+    from helpers import numerical_gradient_3D
+    from regularizers import flow_regularizer
+
+    phi = np.random.randn(batch_sz, size[0], size[1], size[2], 3).astype('float32')
+    expected_l2 = np.array([sum(np.sum(np.square(g)) for c in range(3) for g in np.gradient(phi[b, ..., c].astype('float64')))
+                            for b in range(batch_sz)])
+
+    with tf.Graph().as_default():
+        phi_in = tf.placeholder(tf.float32, shape=phi.shape)
+        numerical = tf.reduce_sum(tf.square(numerical_gradient_3D(phi_in)), axis=[1, 2, 3, 4])
+        summed = flow_regularizer(phi_in, gradient_weight=0., summed_gradient_weight=1.)
+        l2 = flow_regularizer(phi_in)
+        fetches = [numerical, summed, l2, tf.gradients(tf.reduce_sum(numerical), phi_in)[0],
+                   tf.gradients(tf.reduce_sum(summed), phi_in)[0]]
+        with tf.Session() as sess:
+            numerical, summed, l2, d_numerical, d_summed = sess.run(fetches, feed_dict={phi_in: phi})
+
+    max_errors = (np.max(np.abs(summed - numerical) / numerical), np.max(np.abs(d_summed - d_numerical)),
+                  np.max(np.abs(l2 - expected_l2) / expected_l2))
+    print(' --- flow_regularizer %s: summed gradient against numerical_gradient_3D max relative difference %g, '
+          'max abs gradient difference %g, gradient L2 against np.gradient max relative difference %g'
+          % ((str(size),) + max_errors))
+    return max_errors
+
+
+def benchmark_regularizer(sizes=(24, 60, 128), batch_sz=1, n_repeats=10):
+    """
+    Forward + backward time of the gradient penalty of phi: helpers.numerical_gradient_3D (slices and concatenations)
+    against regularizers.flow_regularizer (one conv3d), with the same penalty, the gradient L2 only and with the
+    gradient, bending and folding penalties
+    """
+    import tensorflow as tf
+    from helpers import numerical_gradient_3D
+    from regularizers import flow_regularizer
+
+    penalties = [('numerical_gradient_3D', lambda phi: tf.reduce_sum(tf.square(numerical_gradient_3D(phi)), axis=[1, 2, 3, 4])),
+                 ('conv summed gradient', lambda phi: flow_regularizer(phi, 0., summed_gradient_weight=1.)),
+                 ('conv gradient', flow_regularizer),
+                 ('conv gradient + bending + folding', lambda phi: flow_regularizer(phi, 1., 1., 1.))]
+    results = {}
+    for size in sizes:
+        phi = np.random.randn(batch_sz, size, size, size, 3).astype('float32')
+        for name, penalty in penalties:
+            with tf.Graph().as_default():
+                phi_in = tf.placeholder(tf.float32, shape=phi.shape)
+                loss = tf.reduce_mean(penalty(phi_in))
+                fetches = [loss, tf.gradients(loss, phi_in)[0]]
+                with tf.Session() as sess:
+                    sess.run(fetches, feed_dict={phi_in: phi})  # warm up
+                    start_time = time.time()
+                    for _ in range(n_repeats):
+                        sess.run(fetches, feed_dict={phi_in: phi})
+                    results[(size, name)] = (time.time() - start_time) / n_repeats
+            print(' --- %s %d^3: forward + backward %.4fs' % (name, size, results[(size, name)]))
+    return results
+
+
+TRAIN_STEP_MODELS = [('GAN_unet_model64', 'GANUnetModel64'),
+                     ('GAN_unet_with_ref_model64', 'GANUnetModel64'),
+                     ('GAN_unet_model148', 'GANUnetModel148'),
+                     ('GAN_unet_nogapfilling_model', 'GANUnetNoGapFillingModel'),
+                     ('GAN_pix2pix_model', 'GAN_pix2pix'),
+                     ('GAN_pix2pix_remodel', 'GAN_pix2pix'),
+                     ('GAN_pix2pix_remodel_smooth', 'GAN_pix2pix'),
+                     ('GAN_pix2pix_remodel_noupsample_smooth', 'GAN_pix2pix')]
+
+
+def benchmark_train_step(models=TRAIN_STEP_MODELS, n_steps=10):
+    """
+    Time of a training iteration of every model on random batches: generator.predict, transformation.predict and the
+    three train_on_batch calls against the GANTrainStep call, and against its opt-in modes with one discriminator step
+    on the sum of the losses, with the real and warped batches run separately and concatenated.
+    Before the timings, one iteration of the three calls and one of the GANTrainStep call are run from the same
+    weights and optimizer states, their losses should be the same.
+    """
+    import importlib
+    import keras.backend as K
+    from train_step import GANTrainStep
+
+    results = {}
+    for module_name, class_name in models:
+        K.clear_session()
+        model = getattr(importlib.import_module(module_name), class_name)()
+        batch = lambda tensor: np.random.rand(*((model.batch_sz,) + K.int_shape(tensor)[1:])).astype('float32')
+        inputs = [batch(x) for x in model.combined.inputs]
+        real = batch(model.discriminator.inputs[0])
+        valid = np.ones((model.batch_sz,) + K.int_shape(model.discriminator.outputs[0])[1:])
+        fake = np.zeros_like(valid)
+        targets = [valid] + [batch(o) for o in model.combined.outputs[1:]]
+
+        # the transformation and the discriminator may only take the center of the crops
+        def center(array, tensor):
+            gap = [(n - s) // 2 for n, s in zip(array.shape[1:4], K.int_shape(tensor)[1:4])]
+            return array[:, gap[0]:array.shape[1] - gap[0], gap[1]:array.shape[2] - gap[1], gap[2]:array.shape[3] - gap[2]]
+        subject = center(inputs[0], model.transformation.inputs[0])
+        condition = center(inputs[1], model.discriminator.inputs[1])
+
+        def separate_step():
+            phi = model.generator.predict(inputs)
+            transform = model.transformation.predict([subject, phi])
+            d_loss_real = model.discriminator.train_on_batch([real, condition], valid)
+            d_loss_fake = model.discriminator.train_on_batch([transform, condition], fake)
+            g_loss = model.combined.train_on_batch(inputs, targets if len(targets) > 1 else targets[0])
+            return d_loss_real, d_loss_fake, g_loss
+
+        def train_step():
+            return model.train_step(inputs, real, valid, fake, targets)
+
+        # loss parity, both from the same weights and optimizer states (the step uses the compiled train functions)
+        weights = model.combined.get_weights()
+        optimizer_weights = [m.optimizer.get_weights() for m in (model.discriminator, model.combined)]
+        losses = []
+        for step in (separate_step, train_step):
+            model.combined.set_weights(weights)
+            for m, w in zip((model.discriminator, model.combined), optimizer_weights):
+                m.optimizer.set_weights(w)
+            losses.append([np.ravel(l) for l in step()])
+        max_diff = max(np.max(np.abs(a - b)) for a, b in zip(*losses))
+        print(' --- %s losses of one iteration (3 calls / GANTrainStep): D real %s / %s, D fake %s / %s, G %s / %s, '
+              'max difference %.2e' % ((module_name,) + tuple(str(np.round(l, 4)) for pair in zip(*losses) for l in pair)
+                                       + (max_diff,)))
+
+        # the opt-in modes, one discriminator step on the sum of the losses
+        summed_step = GANTrainStep(model.combined, model.discriminator, model.train_step.warped,
+                                   model.train_step.condition, sum_d_losses=True)
+        concat_step = GANTrainStep(model.combined, model.discriminator, model.train_step.warped,
+                                   model.train_step.condition, concat_d_batches=True, sum_d_losses=True)
+
+        times = []
+        for step in (separate_step, train_step, lambda: summed_step(inputs, real, valid, fake, targets),
+                     lambda: concat_step(inputs, real, valid, fake, targets)):
+            step()  # warm up
+            start_time = time.time()
+            for _ in range(n_steps):
+                step()
+            times.append((time.time() - start_time) / n_steps)
+        results[module_name] = (times, max_diff)
+        print(' --- %s per iteration: 3 calls %.3fs, GANTrainStep %.3fs (%.2fx), summed D losses %.3fs (%.2fx), '
+              'concatenated D batches %.3fs (%.2fx)' % (module_name, times[0], times[1], times[0] / times[1],
+                                                       times[2], times[0] / times[2], times[3], times[0] / times[3]))
+    return results
+
+
+GAP_CROP_MODELS = [('GAN_unet_model64', 'GANUnetModel64'),
+                   ('GAN_unet_with_ref_model64', 'GANUnetModel64'),
+                   ('GAN_unet_model148', 'GANUnetModel148')]
+
+
+def conv_flops(model):
+    """Floating point operations of the Conv3D layers of a model for one sample, 2 per multiply-add"""
+    from keras.layers import Conv3D
+
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, Conv3D):
+            flops += 2 * int(np.prod(layer.output_shape[1:4])) * int(np.prod(layer.get_weights()[0].shape))
+    return flops
+
+
+def benchmark_gap_crop(models=GAP_CROP_MODELS, n_steps=10):
+    """
+    Generators of the U-Net models with the gap filling convolutions run on the whole skip connections then cropped,
+    against cropped before the convolutions (crop_gap_inputs): the FLOPs of the convolutions, the time of a forward
+    pass and of a training step, and the largest difference of the outputs in inference mode (same weights)
+    """
+    import importlib
+    import keras.backend as K
+    from keras.optimizers import Adam
+
+    results = {}
+    for module_name, class_name in models:
+        K.clear_session()
+        model = getattr(importlib.import_module(module_name), class_name)()
+        generators = []
+        for crop_gap_inputs in (False, True):
+            model.crop_gap_inputs = crop_gap_inputs
+            generator = model.build_generator()
+            generator.compile(loss='mean_squared_error', optimizer=Adam(0.001))
+            generators.append(generator)
+        # the layers with weights have the same names in both graphs
+        for layer in generators[0].layers:
+            if layer.weights:
+                generators[1].get_layer(layer.name).set_weights(layer.get_weights())
+
+        inputs = [np.random.rand(*((model.batch_sz,) + K.int_shape(x)[1:])).astype('float32') for x in generators[0].inputs]
+        target = np.random.rand(*((model.batch_sz,) + K.int_shape(generators[0].outputs[0])[1:])).astype('float32')
+        max_diff = np.max(np.abs(generators[0].predict(inputs) - generators[1].predict(inputs)))
+
+        flops, forward_times, step_times = [], [], []
+        for generator in generators:
+            flops.append(conv_flops(generator))
+            generator.train_on_batch(inputs, target)  # warm up
+            start_time = time.time()
+            for _ in range(n_steps):
+                generator.predict(inputs)
+            forward_times.append((time.time() - start_time) / n_steps)
+            start_time = time.time()
+            for _ in range(n_steps):
+                generator.train_on_batch(inputs, target)
+            step_times.append((time.time() - start_time) / n_steps)
+        results[module_name] = (flops, forward_times, step_times, max_diff)
+        print(' --- %s generator GFLOPs per sample %.1f -> %.1f (%.2fx), forward %.3fs -> %.3fs, training step '
+              '%.3fs -> %.3fs, max difference %.2e' % (module_name, flops[0] / 1e9, flops[1] / 1e9, flops[0] / flops[1],
+                                                      forward_times[0], forward_times[1], step_times[0], step_times[1],
+                                                      max_diff))
+    return results
+
+
+def validate_lean_warp_gradient(batch_sz=2, size=(20, 16, 12), max_disp=4.):
+    """
+    Compare the gradients of dense_image_warp_3D_lean with the autodiff gradients of dense_image_warp_3D on a non-cubic
+    volume, with random displacements (some out of the volume, clipped), with integer ones (alpha exactly 0, and 1 on
+    the last voxel of every axis where the floor is clamped) and with the identity
+    """
+    import tensorflow as tf
+    from helpers import dense_image_warp_3D, dense_image_warp_3D_lean
+
+    image = np.random.rand(batch_sz, size[0], size[1], size[2], 1).astype('float32')
+    random_flow = max_disp * (2 * np.random.rand(batch_sz, size[0], size[1], size[2], 3) - 1)
+    flows = [('random', random_flow), ('integer', np.round(random_flow)), ('identity', np.zeros_like(random_flow))]
+
+    max_errors = {}
+    for name, flow in flows:
+        with tf.Graph().as_default():
+            image_in = tf.placeholder(tf.float32, shape=image.shape)
+            flow_in = tf.placeholder(tf.float32, shape=flow.shape)
+            # a loss that is not linear in the warped image, so the incoming gradient differs between voxels
+            fetches = []
+            for warp in (dense_image_warp_3D, dense_image_warp_3D_lean):
+                warped = warp([image_in, flow_in])
+                fetches.append([warped] + tf.gradients(tf.reduce_sum(warped ** 2), [image_in, flow_in]))
+            with tf.Session() as sess:
+                autodiff, lean = sess.run(fetches, feed_dict={image_in: image, flow_in: flow.astype('float32')})
+        max_errors[name] = [np.max(np.abs(a - b)) for a, b in zip(autodiff, lean)]
+        print(' --- lean warp, %s flow %s: max abs difference warped %g, d image %g, d flow %g'
+              % ((name, str(size)) + tuple(max_errors[name])))
+    return max_errors
+
+
+def _warp_step_memory(lean, batch_sz, size, results):
+    import tensorflow as tf
+    from helpers import dense_image_warp_3D, dense_image_warp_3D_lean
+
+    np.random.seed(0)
+    image = np.random.rand(batch_sz, size, size, size, 1).astype('float32')
+    flow = (3 * np.random.randn(batch_sz, size, size, size, 3)).astype('float32')
+    image_in = tf.placeholder(tf.float32, shape=image.shape)
+    flow_in = tf.Variable(flow)
+    warped = (dense_image_warp_3D_lean if lean else dense_image_warp_3D)([image_in, flow_in])
+    gradients = tf.gradients(tf.reduce_sum(warped ** 2), [image_in, flow_in])
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        run_metadata = tf.RunMetadata()
+        values = sess.run(gradients, feed_dict={image_in: image},
+                          options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+        try:
+            peak_bytes = sess.run(tf.contrib.memory_stats.MaxBytesInUse())
+        except Exception:
+            # no GPU: the peak of the allocators recorded in the trace
+            peak_bytes = max([m.peak_bytes for d in run_metadata.step_stats.dev_stats
+                              for n in d.node_stats for m in n.memory] or [0])
+    results.put((lean, peak_bytes, values))
+
+
+def benchmark_warp_memory(batch_sz=2, size=64):
+    """
+    Peak memory of a forward + backward pass through dense_image_warp_3D and dense_image_warp_3D_lean, each in its own
+    process so the allocator peaks are not shared, and the difference between their gradients
+    """
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    peaks, gradients = {}, {}
+    for lean in (False, True):
+        p = ctx.Process(target=_warp_step_memory, args=(lean, batch_sz, size, results))
+        p.start()
+        lean, peaks[lean], gradients[lean] = results.get()
+        p.join()
+        print(' --- %s warp, %d x %d^3: peak memory %.1f MB'
+              % ('lean' if lean else 'autodiff', batch_sz, size, peaks[lean] / 2. ** 20))
+    print(' --- lean warp: %.2fx less peak memory, max abs gradient difference image %g, flow %g'
+          % (peaks[False] / max(peaks[True], 1), np.max(np.abs(gradients[False][0] - gradients[True][0])),
+             np.max(np.abs(gradients[False][1] - gradients[True][1]))))
+    return peaks
+
+
+if __name__ == '__main__':
+    # any combination of the modes, the augmentation benchmark alone without one
+    modes = sys.argv[1:]
+    if 'loader' in modes:
+        from data_loader import DataLoader
+        loader = DataLoader(batch_sz=16, dataset_name='fly', use_golden=True)
+        benchmark_loader(loader)
+        benchmark_augmentation(batch_sz=loader.batch_sz, crop_sz=loader.crop_sz)
+    if 'warp' in modes:
+        validate_trilinear_warp()
+        benchmark_scipy_warp_scaling()
+        benchmark_scipy_warp_scaling(worker_type='process')
+        benchmark_spline_cache()
+        benchmark_warp_plan()
+    if 'train' in modes:
+        benchmark_train_step()
+        benchmark_gap_crop()
+    if 'tf' in modes:
+        validate_lean_warp_gradient()
+        validate_interpolation()
+        benchmark_interpolation()
+        benchmark_identity_grid()
+        validate_flow_regularizer()
+        benchmark_regularizer()
+        benchmark_warp_memory()
+    if not set(modes) & {'loader', 'warp', 'train', 'tf'}:
+        benchmark_augmentation()
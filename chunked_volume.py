@@ -0,0 +1,230 @@
+import os
+import json
+import zlib
+import itertools
+import threading
+import numpy as np
+from collections import OrderedDict
+
+__author__ = 'elmalakis'
+
+
+"""
+Chunked, compressed volume format (a local N5/zarr-like directory)
+
+    <root>/attributes.json              {"levels": n}
+    <root>/s<level>/attributes.json     {"shape", "chunk_shape", "dtype", "downsampling_factor", "compression"}
+    <root>/s<level>/<i>/<j>/<k>         zlib compressed C-order chunk
+
+Only the three spatial (last) dimensions are chunked, leading dimensions such as the 3 components of a
+deformation field are stored whole inside every chunk. Chunks at the border keep their truncated size.
+A crop therefore only decodes the chunks it overlaps, and with chunk_shape == crop_size that is at most 8.
+"""
+
+
+def _chunk_path(level_path, chunk_idx):
+    return os.path.join(level_path, *[str(c) for c in chunk_idx])
+
+
+def _write_level(source, level_path, chunk_shape, downsampling_factor, compression_level):
+    """Write one resolution level, streaming the source one slab of chunks (along x) at a time"""
+    shape = source.shape
+    os.makedirs(level_path, exist_ok=True)
+    attributes = {'shape': list(shape),
+                  'chunk_shape': list(chunk_shape),
+                  'dtype': np.dtype(source.dtype).str,
+                  'downsampling_factor': downsampling_factor,
+                  'compression': 'zlib'}
+    with open(os.path.join(level_path, 'attributes.json'), 'w') as f:
+        json.dump(attributes, f)
+
+    n_chunks = [int(np.ceil(s / c)) for s, c in zip(shape[-3:], chunk_shape)]
+    for i in range(n_chunks[0]):
+        x0 = i * chunk_shape[0]
+        slab = np.asarray(source[..., x0:x0 + chunk_shape[0], :, :])
+        for j, k in itertools.product(range(n_chunks[1]), range(n_chunks[2])):
+            y0, z0 = j * chunk_shape[1], k * chunk_shape[2]
+            chunk = np.ascontiguousarray(slab[..., y0:y0 + chunk_shape[1], z0:z0 + chunk_shape[2]])
+            path = _chunk_path(level_path, (i, j, k))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(zlib.compress(chunk.tobytes(), compression_level))
+
+
+def _downsample(volume):
+    """2x block average over the spatial dimensions, odd trailing voxels are dropped"""
+    spatial = [s // 2 * 2 for s in volume.shape[-3:]]
+    volume = np.asarray(volume[..., :spatial[0], :spatial[1], :spatial[2]], dtype=np.float32)
+    lead = volume.shape[:-3]
+    volume = volume.reshape(lead + (spatial[0] // 2, 2, spatial[1] // 2, 2, spatial[2] // 2, 2))
+    n = len(lead)
+    return volume.mean(axis=(n + 1, n + 3, n + 5))
+
+
+class _Downsampled():
+    """Lazily 2x downsampled view of a volume, read slab by slab by _write_level"""
+
+    def __init__(self, source, dtype):
+        self.source = source
+        self.dtype = dtype
+        self.shape = tuple(source.shape[:-3]) + tuple(s // 2 for s in source.shape[-3:])
+
+    def __getitem__(self, key):
+        # _write_level only asks for (..., x-slice, :, :)
+        x = key[1]
+        return _downsample(self.source[..., 2 * x.start:2 * min(x.stop, self.shape[-3]), :, :]).astype(self.dtype)
+
+
+def write_chunked_volume(volume, path, chunk_shape=(64, 64, 64), levels=1, compression_level=1):
+    """
+    Convert a volume into the chunked format
+    :param volume: ndarray, np.memmap or any array-like that supports slicing - (..., x, y, z)
+    :param path: string - root directory of the chunked volume
+    :param chunk_shape: tuple - spatial chunk shape, use the training crop size
+    :param levels: int - number of resolution levels, each one is 2x downsampled from the previous
+    :param compression_level: int - zlib compression level
+    :return: ChunkedVolume of the full resolution level
+    """
+    chunk_shape = tuple(int(c) for c in chunk_shape)
+    os.makedirs(path, exist_ok=True)
+    source = volume
+    for level in range(levels):
+        if level > 0:
+            source = _Downsampled(ChunkedVolume(path, level=level - 1), volume.dtype)
+        _write_level(source, os.path.join(path, 's%d' % level), chunk_shape, 2 ** level, compression_level)
+    with open(os.path.join(path, 'attributes.json'), 'w') as f:
+        json.dump({'levels': levels}, f)
+    return ChunkedVolume(path)
+
+
+def is_chunked_volume(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'attributes.json'))
+
+
+class ChunkedVolume():
+    """
+    Read-only array-like view of one level of a chunked volume.
+    Slicing with steps of 1 over the spatial dimensions decodes only the overlapping chunks and returns an ndarray.
+    The chunk cache is shared by the threads reading the volume (e.g. the prefetch thread and sample_images), it is
+    guarded by a lock, the chunks are decoded outside of it.
+    """
+
+    def __init__(self, path, level=0, cache_chunks=64):
+        """
+        :param path: string - root directory of the chunked volume
+        :param level: int - resolution level, 0 is the full resolution
+        :param cache_chunks: int - number of decoded chunks kept in memory
+        """
+        self.path = path
+        self.level = level
+        self.level_path = os.path.join(path, 's%d' % level)
+        with open(os.path.join(self.level_path, 'attributes.json')) as f:
+            attributes = json.load(f)
+        self.shape = tuple(attributes['shape'])
+        self.chunk_shape = tuple(attributes['chunk_shape'])
+        self.dtype = np.dtype(attributes['dtype'])
+        self.downsampling_factor = attributes['downsampling_factor']
+        self.ndim = len(self.shape)
+        self.cache_chunks = cache_chunks
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock cannot be pickled, the copy starts with an empty cache
+        state = self.__dict__.copy()
+        state['_chunks'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def levels(self):
+        with open(os.path.join(self.path, 'attributes.json')) as f:
+            return json.load(f)['levels']
+
+    def _chunk(self, chunk_idx):
+        with self._lock:
+            chunk = self._chunks.get(chunk_idx)
+            if chunk is not None:
+                self._chunks.move_to_end(chunk_idx)
+                return chunk
+        lead = self.shape[:-3]
+        chunk_shape = lead + tuple(min(c, s - i * c) for i, c, s in zip(chunk_idx, self.chunk_shape, self.shape[-3:]))
+        path = _chunk_path(self.level_path, chunk_idx)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                chunk = np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(chunk_shape)
+        else:
+            chunk = np.zeros(chunk_shape, dtype=self.dtype)
+        with self._lock:
+            self._chunks[chunk_idx] = chunk
+            if len(self._chunks) > self.cache_chunks:
+                self._chunks.popitem(last=False)
+        return chunk
+
+    def _spatial_slices(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        n_lead = self.ndim - 3
+        if any(k != slice(None) for k in key[:n_lead]):
+            raise ValueError('Only the spatial dimensions of a chunked volume can be sliced')
+        slices = []
+        for k, s in zip(key[n_lead:], self.shape[-3:]):
+            if not isinstance(k, slice):
+                raise ValueError('Chunked volumes only support slicing, received: ' + str(k))
+            start, stop, step = k.indices(s)
+            if step != 1:
+                raise ValueError('Chunked volumes only support slicing with step 1')
+            slices.append((start, max(start, stop)))
+        return slices
+
+    def __getitem__(self, key):
+        slices = self._spatial_slices(key)
+        out = np.zeros(self.shape[:-3] + tuple(b - a for a, b in slices), dtype=self.dtype)
+        ranges = [range(a // c, (b - 1) // c + 1) if b > a else range(0)
+                  for (a, b), c in zip(slices, self.chunk_shape)]
+        for chunk_idx in itertools.product(*ranges):
+            chunk = self._chunk(chunk_idx)
+            src, dst = [], []
+            for (a, b), i, c in zip(slices, chunk_idx, self.chunk_shape):
+                lo, hi = max(a, i * c), min(b, (i + 1) * c)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - a, hi - a))
+            out[(Ellipsis,) + tuple(dst)] = chunk[(Ellipsis,) + tuple(src)]
+        return out
+
+    def __array__(self, dtype=None):
+        volume = self[...]
+        return volume if dtype is None else volume.astype(dtype)
+
+
+def convert_nrrd(nrrd_path, path, chunk_shape=(64, 64, 64), levels=1, dtype=None):
+    """
+    Convert a NRRD file into the chunked format
+    :param nrrd_path: string - NRRD file
+    :param path: string - root directory of the chunked volume
+    :param chunk_shape: tuple - spatial chunk shape, use the training crop size
+    :param levels: int - number of resolution levels
+    :param dtype: dtype of the stored volume, None keeps the dtype of the file
+    """
+    import nrrd
+    volume, header = nrrd.read(nrrd_path)
+    if dtype is not None:
+        volume = volume.astype(dtype)
+    return write_chunked_volume(volume, path, chunk_shape=chunk_shape, levels=levels)
+
+
+if __name__ == '__main__':
+    import sys
+    # python chunked_volume.py <in.nrrd> <out directory> [chunk size] [levels]
+    chunk = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    n_levels = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+    convert_nrrd(sys.argv[1], sys.argv[2], chunk_shape=(chunk, chunk, chunk), levels=n_levels)
+    print('--- Done ---')
@@ -1,4 +1,5 @@
 import os
+import mmap
 import nrrd
 import scipy
 import random
@@ -11,12 +12,27 @@ from skimage.transform import resize
 
 # on cluster
 import preprocessing as pp
+from volume_cache import VolumeCache
+from volume_store import VolumeStore, AffineVolume, PackedMask, affine_volume, compact_volume, compact_mask, restore_volume
+from volume_stats import masked_stats, normalization_affine
+from augmentation import random_transforms, augment_batch
 
 __author__ = 'elmalakis'
 
 
 DEBUG = 1
 
+
+def _in_shared_memory(array):
+    """True if the array is backed by a memory mapping (np.memmap or a view of a shared mmap.mmap buffer)"""
+    base = array
+    while base is not None:
+        if isinstance(base, mmap.mmap):
+            return True
+        base = base.obj if isinstance(base, memoryview) else getattr(base, 'base', None)
+    return False
+
+
 class DataLoader():
 
     def __init__(self,
@@ -28,13 +44,29 @@ class DataLoader():
                  restricted_mask=False,
                  use_golden=False,
                  use_sharpen=False,
-                 use_phi=False):
+                 use_phi=False,
+                 cache_dir=None,
+                 chunk_size=None,
+                 chunk_levels=1,
+                 volume_storage='float32',
+                 mask_storage='float32',
+                 center_size=None):
         """
         :param batch_sz: int - size of the batch
         :param sampletype: string - 'fly' or 'fish'
+        :param cache_dir: string - directory of the preprocessed-volume cache, None to disable caching
+        :param chunk_size: tuple - store the cached volumes in the chunked format with this chunk shape (use crop_size),
+                           None to store memory-mapped .npy files
+        :param chunk_levels: int - resolution levels of the chunked format
+        :param volume_storage: string - storage of the normalized images and the phis: 'float32', 'float16' or 'uint16'
+                               (scale/offset), the crops are widened to float32 when they are copied into the batch
+        :param mask_storage: string - storage of the template mask: 'float32', 'uint8' or 'bits' (bit-packed along z)
+        :param center_size: tuple - load_batch also yields the center views of this size of the crops (the region the
+                            discriminator and the warp see, e.g. (24, 24, 24) for 64^3 crops), None to skip them
         """
         self.batch_sz = batch_sz
         self.crop_sz = crop_size
+        self.center_sz = center_size
 
         self.imgs = []
         self.masks = []
@@ -50,6 +82,13 @@ class DataLoader():
         self.use_sharpen = use_sharpen
         self.use_phi = use_phi
 
+        self.volume_storage = volume_storage
+        self.mask_storage = mask_storage
+        self.storage_errors = {}
+
+        self.volume_cache = None
+        if cache_dir is not None:
+            self.volume_cache = VolumeCache(cache_dir, chunk_shape=chunk_size, levels=chunk_levels)
 
         if dataset_name is 'fly':
             self.imgs, self.masks, self.img_template, self.mask_template, self.imgs_test, self.masks_test, self.golden_imgs, self.n_batches, self.phis = self.prepare_fly_data(batch_sz,
@@ -176,9 +215,10 @@ class DataLoader():
         self.n_gpus = 1
         self.mask_sz = self.crop_sz
 
-        imgs = []
+        # the subject, golden and phi volumes are memory-mapped from the cache when one is configured
+        imgs = VolumeStore()
         masks = []
-        golden_imgs = []
+        golden_imgs = VolumeStore()
         #preprocess = pp.PreProcessing()
 
         img_template = None
@@ -187,7 +227,7 @@ class DataLoader():
         imgs_test = []
         masks_test = []
 
-        phis = []
+        phis = VolumeStore()
 
         filepath = '/nrs/scicompsoft/elmalakis/GAN_Registration_Data/flydata/forSalma/lo_res/'
         goldenfilepath = '/nrs/saalfeld/john/public/forSalma/lo_res/proc/'
@@ -350,126 +390,48 @@ class DataLoader():
 
 
         # --- Template Preparation ---
-        # The original template
-        img_template, templ_header = nrrd.read(filepath + 'JRC2018_lo.nrrd')
-        mask_template, templ_header = nrrd.read(filepath + 'preprocessed_convexhull/JRC2018_lo_dilated_mask.nrrd')
-
-        # Use the sharpened version as a template
+        # The original template, use the sharpened or the histogram equalized version instead if requested
+        template_path = filepath + 'JRC2018_lo.nrrd'
         if use_sharpen:
-            img_template, templ_header =  nrrd.read(filepath + 'preprocessed_convexhull/JRC2018_lo_sharp.nrrd')
-            img_template_diff, templ_header = nrrd.read(filepath + 'preprocessed_convexhull/JRC2018_lo_sharp_diff.nrrd')
-
-        img_template = np.float32(img_template)
-        mask_template = np.float32(mask_template)
+            template_path = filepath + 'preprocessed_convexhull/JRC2018_lo_sharp.nrrd'
+        if use_hist_equilized_data:
+            template_path = filepath + 'preprocessed_convexhull/' + 'JRC2018_lo_histogram_normalized.nrrd'
+        mask_path = filepath + 'preprocessed_convexhull/JRC2018_lo_dilated_mask.nrrd'
 
-        # Apply the template mask before the standardization
-        mask = 1 - mask_template
-        mask = np.uint8(mask)
+        mask_template = self._load_volume(mask_path, lambda: self._read_float32(mask_path),
+                                          storage=self.mask_storage, compact_fn=compact_mask)
 
-        img_template_masked = np.ma.array(img_template, mask=mask)
-        img_template = (img_template - np.mean(img_template_masked)) / np.std(img_template_masked)
-        if min_max:
-            img_template = (2 * (img_template - np.min(img_template_masked)) / (
-                    np.max(img_template_masked) - np.min(img_template_masked))) - 1
+        # The volumes are kept as they are read, the standardization with the statistics of the voxels under the
+        # template mask is applied to the crops (see _load_normalized)
+        img_template = self._load_normalized(template_path, mask_template, mask_path, min_max)
 
         if use_golden:
-
             for g in golden:
-                g_img, g_header = nrrd.read(g)
-                g_img = np.float32(g_img)
-
-                # image standardization
-                img_masked = np.ma.array(g_img, mask=mask)
-                g_img = (g_img - img_masked.mean())/img_masked.std()
-
-                # image normalization
-                if min_max:
-                    g_img = (2 * (g_img - np.min(img_masked)) / (np.max(img_masked) - np.min(img_masked))) - 1
-
-                golden_imgs.append(g_img)
-
+                golden_imgs.append(self._load_normalized(g, mask_template, mask_path, min_max))
 
         if use_hist_equilized_data:
-            # histogram equalized template
-            img_template, templ_header = nrrd.read(filepath + 'preprocessed_convexhull/' +'JRC2018_lo_histogram_normalized.nrrd')
-            #mask_template, templ_header = nrrd.read(filepath + 'preprocessed_convexhull/' + 'JRC2018_lo_dilated_mask.nrrd')
-            #if restricted_mask:
-            #    mask_template, templ_header = nrrd.read(filepath + 'JRC2018_lo_mask_restricted.nrrd')
-
-            img_template = np.float32(img_template)
-            #mask_template = np.float32(mask_template)
-
-            # Apply the template mask before the normalization
-            img_template_masked = np.ma.array(img_template, mask=mask)
-            img_template = (img_template - np.mean(img_template_masked)) / np.std(img_template_masked)
-            if min_max:
-                img_template = (2 * (img_template - np.min(img_template_masked)) / (np.max(img_template_masked) - np.min(img_template_masked))) - 1
-
-
             print('----- loading histogram equalized data files -----')
-            for inorm in img_pp_normalized:
-                # images normalize
-                curr_img, img_header = nrrd.read(inorm)
-                curr_img = np.float32(curr_img)
-
-                # Apply the template mask before standardization
-                mask = 1-mask_template
-                mask = np.uint8(mask)
-                img_masked = np.ma.array(curr_img, mask=mask)
-                curr_img = (curr_img - img_masked.mean())/img_masked.std()
-
-                # image normalization
-                if min_max:
-                    curr_img = (2 * (curr_img - np.min(img_masked)) / (np.max(img_masked) - np.min(img_masked))) - 1
-
-                imgs.append(curr_img)
-
-
+            subjects = img_pp_normalized
         elif use_sharpen:
             print('----- loading sharpened files -----')
-            for ish in sharpen:
-                curr_img, img_header = nrrd.read(ish)
-                curr_img = np.float32(curr_img)
-
-                mask = 1-mask_template
-                mask = np.uint8(mask)
-                img_masked = np.ma.array(curr_img, mask=mask)
-
-                # image standardization
-                curr_img = (curr_img - img_masked.mean()) / img_masked.std()
-
-                # image normalization
-                if min_max:
-                    curr_img = (2 * (curr_img - np.min(img_masked)) / (np.max(img_masked) - np.min(img_masked))) - 1
-
-                imgs.append(curr_img)
-
-
+            subjects = sharpen
         else:
             print('----- loading normal data files -----')
-            for ipp in img_pp:
-                curr_img, img_header = nrrd.read(ipp)
-                curr_img = np.float32(curr_img)
-                # denoise
-                #den, _ = preprocess.denoise_image(image=curr_img, mask=mask_template)
-                #sharp, _ = preprocess.sharpening(image=den)
-                # Apply the template mask before the standardization
-                mask = 1 - mask_template
-                mask = np.uint8(mask)
-                img_masked = np.ma.array(curr_img, mask=mask)
-                curr_img = (curr_img - np.mean(img_masked)) / np.std(img_masked)
-                # image normalization
-                if min_max:
-                    curr_img = (2* (curr_img - np.min(img_masked))/(np.max(img_masked)-np.min(img_masked))) -1
-
-                imgs.append(curr_img)
+            subjects = img_pp
+            # denoise
+            #den, _ = preprocess.denoise_image(image=curr_img, mask=mask_template)
+            #sharp, _ = preprocess.sharpening(image=den)
+
+        for isub in subjects:
+            imgs.append(self._load_normalized(isub, mask_template, mask_path, min_max))
+        self._print_storage_errors([template_path] + subjects + (golden if use_golden else []), 'images')
 
         if use_phi:
             print('---- load true phi -----')
+            # each phi is (3, 1121, 546, 334), ~2.4 GB as float32, so with a cache they are only memory-mapped
             for iphi in true_phi:
-                curr_phi, phi_header = nrrd.read(iphi)
-                curr_phi = np.float32(curr_phi)
-                phis.append(curr_phi)
+                phis.append(self._load_volume(iphi, lambda: self._read_float32(iphi), storage=self.volume_storage))
+            self._print_storage_errors(true_phi, 'phis')
 
 
         # TODO: save test images
@@ -502,6 +464,66 @@ class DataLoader():
         return imgs, template, n_batches
 
 
+    def _load_volume(self, path, create_fn, dependencies=(), storage='float32', compact_fn=compact_volume, **params):
+        """
+        Run create_fn, or memory-map its result from the volume cache if one is configured.
+        With a reduced-precision storage the float32 result is converted by compact_fn (compact_volume or compact_mask)
+        and the stored array is wrapped so that slicing it gives float32 (uint16) or uint8 (bits) voxels.
+        """
+        if storage == 'float32':
+            if self.volume_cache is None:
+                return create_fn()
+            return self.volume_cache.get_or_create(path, create_fn, dependencies=dependencies, **params)
+
+        def create():
+            return compact_fn(create_fn(), storage)
+        if self.volume_cache is None:
+            stored, attributes = create()
+        else:
+            stored, attributes = self.volume_cache.get_or_create(path, create, dependencies=dependencies,
+                                                                 with_attributes=True, storage=storage, **params)
+        if 'max_abs_error' in attributes:
+            self.storage_errors[path] = attributes
+        return restore_volume(stored, attributes)
+
+
+    def _print_storage_errors(self, paths, name):
+        errors = [self.storage_errors[p] for p in paths if p in self.storage_errors]
+        if errors:
+            print('----- %s stored as %s: max abs error %g, rms error %g -----'
+                  % (name, self.volume_storage, max(e['max_abs_error'] for e in errors), max(e['rms_error'] for e in errors)))
+
+
+    def _read_float32(self, path):
+        curr_img, img_header = nrrd.read(path)
+        return np.float32(curr_img)
+
+
+    def _load_normalized(self, path, mask_template, mask_path, min_max=False):
+        """
+        Load the volume as it is read and standardize it lazily: the mean, std, min and max of the voxels under the
+        template mask are computed in one pass (and kept next to the cached volume), the normalization is then an
+        affine transform applied to every crop that is read
+        :param mask_template: template mask, the voxels where np.uint8(1 - mask_template) is 0 are used
+        :param min_max: boolean - scale the standardized image to [-1, 1]
+        """
+        volume = self._load_volume(path, lambda: self._read_float32(path), storage=self.volume_storage)
+        if self.volume_cache is None:
+            stats = masked_stats(volume, mask_template)
+        else:
+            # the stats are computed on the stored volume, they depend on its storage
+            stats = self.volume_cache.get_or_create_attributes(path, lambda: masked_stats(volume, mask_template),
+                                                               dependencies=[mask_path], stats='masked',
+                                                               storage=self.volume_storage)
+        scale, offset = normalization_affine(stats, min_max)
+        if path in self.storage_errors:
+            # report the storage precision loss in normalized units
+            self.storage_errors[path] = dict(self.storage_errors[path],
+                                             max_abs_error=self.storage_errors[path]['max_abs_error'] * abs(scale),
+                                             rms_error=self.storage_errors[path]['rms_error'] * abs(scale))
+        return affine_volume(volume, scale, offset)
+
+
     def get_template(self):
         return self.img_template
 
@@ -529,6 +551,56 @@ class DataLoader():
         return idx, test_image#, test_mask
 
 
+    def get_valid_crop_origins(self, dataset_name='fly', threshold=0.90, slab_sz=32):
+        """
+        Index of all the crop origins where more than threshold of the crop is under the template mask.
+        The number of mask voxels of every crop is read from a 3D summed-area table (integral image) of the mask,
+        which is built one slab of origins (along x) at a time to bound the memory.
+        The index is computed once per crop size and cached.
+        :param dataset_name: string - for 'fish' the crops always start at z = 0
+        :param threshold: float - fraction of the crop voxels that have to be under the mask
+        :param slab_sz: int - number of x origins processed at once
+        :return: (flat indices of the valid origins, shape of the origin grid)
+        """
+        if not hasattr(self, '_valid_crop_origins'):
+            self._valid_crop_origins = {}
+        key = (tuple(self.crop_sz), dataset_name == 'fish', threshold)
+        if key in self._valid_crop_origins:
+            return self._valid_crop_origins[key]
+
+        cx, cy, cz = self.crop_sz
+        shape = self.mask_template.shape
+        # same range as np.random.randint(0, shape - crop_sz)
+        origin_grid = (shape[0] - cx, shape[1] - cy, 1 if dataset_name == 'fish' else shape[2] - cz)
+        min_vox = threshold * cx * cy * cz
+
+        valid = []
+        for x0 in range(0, origin_grid[0], slab_sz):
+            nx = min(slab_sz, origin_grid[0] - x0)
+            region = np.asarray(self.mask_template[x0:x0 + nx + cx - 1]) == 1
+            sat = np.zeros((region.shape[0] + 1, region.shape[1] + 1, region.shape[2] + 1), dtype=np.int32)
+            sat[1:, 1:, 1:] = region.cumsum(axis=0, dtype=np.int32).cumsum(axis=1).cumsum(axis=2)
+            del region
+            # box sums by inclusion-exclusion of the 8 corners of every crop
+            x0s, x1s = slice(0, nx), slice(cx, cx + nx)
+            y0s, y1s = slice(0, origin_grid[1]), slice(cy, cy + origin_grid[1])
+            z0s, z1s = slice(0, origin_grid[2]), slice(cz, cz + origin_grid[2])
+            num_vox = sat[x1s, y1s, z1s] - sat[x0s, y1s, z1s] - sat[x1s, y0s, z1s] - sat[x1s, y1s, z0s] \
+                      + sat[x0s, y0s, z1s] + sat[x0s, y1s, z0s] + sat[x1s, y0s, z0s] - sat[x0s, y0s, z0s]
+            valid.append(np.flatnonzero(num_vox > min_vox) + x0 * origin_grid[1] * origin_grid[2])
+
+        valid = np.concatenate(valid) if valid else np.zeros(0, dtype=np.int64)
+        if len(valid) == 0:
+            raise ValueError('No crop of size %s has more than %d%% of its voxels under the template mask'
+                             % (str(self.crop_sz), 100 * threshold))
+        if np.prod(origin_grid) < np.iinfo(np.int32).max:
+            valid = valid.astype(np.int32)
+
+        if DEBUG: print('%d valid crop origins out of %d' % (len(valid), np.prod(origin_grid)))
+        self._valid_crop_origins[key] = (valid, origin_grid)
+        return self._valid_crop_origins[key]
+
+
     def load_batch_toy(self):
         for i in range(self.n_batches - 1):
             batch_img = np.zeros((self.batch_sz, self.crop_sz[0], self.crop_sz[1], self.crop_sz[2], 1), dtype='float32')
@@ -546,23 +618,55 @@ class DataLoader():
 
                 num_imgs += 1
 
-            x_flip = np.random.randint(2, size=self.batch_sz)
-            z_flip = np.random.randint(2, size=self.batch_sz)
-            rot_angle = np.random.randint(4, size=self.batch_sz)
-            for j in range(self.batch_sz):
-                if x_flip[j]:
-                    batch_img[j, :, :, :, 0] = np.flip(batch_img[j, :, :, :, 0], axis=0)
-                    batch_img_template[j, :, :, :, 0] = np.flip(batch_img_template[j, :, :, :, 0], axis=0)
-                if z_flip[j]:
-                    batch_img[j, :, :, :, 0] = np.flip(batch_img[j, :, :, :, 0], axis=2)
-                    batch_img_template[j, :, :, :, 0] = np.flip(batch_img_template[j, :, :, :, 0], axis=2)
-                if rot_angle[j]:
-                    batch_img[j, :, :, :, 0] = np.rot90(batch_img[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
-                    batch_img_template[j, :, :, :, 0] = np.rot90(batch_img_template[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
+            x_flip, z_flip, rot_angle = random_transforms(self.batch_sz)
+            augment_batch([batch_img, batch_img_template], x_flip, z_flip, rot_angle)
             yield batch_img, batch_img_template, id
 
 
 
+    def share_volumes(self):
+        """
+        Move the volumes that are held in the process heap into shared memory, before worker processes are forked
+        (see shared_batches.py). Memory-mapped and chunked volumes are already shared through the page cache, and the
+        volumes moved by a previous call are left as they are, so it can be called again.
+        """
+        def to_shared(volume):
+            if isinstance(volume, (AffineVolume, PackedMask)):
+                volume.data = to_shared(volume.data)
+                return volume
+            if not isinstance(volume, np.ndarray) or _in_shared_memory(volume):
+                return volume
+            buffer = mmap.mmap(-1, max(volume.nbytes, 1))  # anonymous mappings are MAP_SHARED, forked children see them
+            shared = np.frombuffer(buffer, dtype=volume.dtype, count=volume.size).reshape(volume.shape)
+            shared[...] = volume
+            return shared
+
+        for volumes in (self.imgs, getattr(self, 'golden_imgs', []), self.phis):
+            for i in range(len(volumes)):
+                volumes[i] = to_shared(volumes[i])
+        self.img_template = to_shared(self.img_template)
+        self.mask_template = to_shared(self.mask_template)
+
+
+    def batch_shapes(self):
+        """(shape, dtype) of every array yielded by load_batch"""
+        shape = (self.batch_sz, self.crop_sz[0], self.crop_sz[1], self.crop_sz[2], 1)
+        shapes = [(shape, 'float32'), (shape, 'float32'), (shape, 'float32')]
+        if self.use_phi:
+            shapes.append((shape[:-1] + (3,), 'float32'))
+        return shapes
+
+
+    def center_views(self, arrays):
+        """
+        :param arrays: list of arrays (batch, x, y, z, c) of the crop size
+        :return: list of views of the center_sz center of every array, nothing is copied
+        """
+        gap = [(c - s) // 2 for c, s in zip(self.crop_sz, self.center_sz)]
+        center = tuple(slice(g, g + s) for g, s in zip(gap, self.center_sz))
+        return [a[(slice(None),) + center] for a in arrays]
+
+
     def load_batch(self, dataset_name ='fly'):
 
         for i in range(self.n_batches - 1):
@@ -575,79 +679,70 @@ class DataLoader():
 
             batch_img_golden = np.zeros((self.batch_sz, self.crop_sz[0], self.crop_sz[1], self.crop_sz[2], 1), dtype='float32')
 
-            # randomly crop an image from imgs list
-            idx = np.random.randint(0, len(self.imgs))
-            img_for_crop = self.imgs[idx]
-            if self.use_golden: golden_for_crop = self.golden_imgs[idx]
-            #mask_for_crop = self.masks[idx]
-
-            num_crop = 0
-            while num_crop < self.batch_sz:
-                x = np.random.randint(0, img_for_crop.shape[0] - self.crop_sz[0])
-                y = np.random.randint(0, img_for_crop.shape[1] - self.crop_sz[1])
-                if dataset_name is 'fish': z = 0 # take the whole dimension of Z
-                else: z = np.random.randint(0, img_for_crop.shape[2] - self.crop_sz[2])
-                # crop in the x-y dimension only and use the all the slices for fish
-                cropped_img = img_for_crop[x:x+self.crop_sz[0], y:y+self.crop_sz[1], z:z+self.crop_sz[2]]
-                cropped_img_template = self.img_template[x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z+self.crop_sz[2]]
-                if self.use_golden: cropped_img_golden = golden_for_crop[x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z+self.crop_sz[2]]
-                #cropped_mask = mask_for_crop[x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z+self.crop_sz[2]]
-                cropped_mask_template = self.mask_template[x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z+self.crop_sz[2]]
-                # if include the random crop in training
-                is_include = False
-                #num_vox = len(cropped_mask[cropped_mask == 1])
-                num_vox = len(cropped_mask_template[cropped_mask_template == 1]) # Use the template mask instead for all the files
-
-                if (num_vox/len(cropped_mask_template)) > 0.90: # 75% of the crop is under the mask
-                    is_include = True
-
-                #accept_prob = np.random.random()
-                # if num_vox > 500: #and accept_prob > 0.98:
-                #     is_include = True
-
-                if is_include:
-                    #if DEBUG: print('include this batch %d, %d, %d' %(x, y, z))
-                    batch_img[num_crop,:,:,:,0] = cropped_img
-                    #batch_mask[num_crop,:,:,:,0] = cropped_mask
-
-                    # filter the image with the mask
-                    # batch_img = batch_img * batch_mask
-
-                    batch_img_template[num_crop,:,:,:,0] = cropped_img_template
-                    #batch_mask_template[num_crop,:,:,:,0] = cropped_mask_template
-
-                    # filter the template with the mask
-                    #batch_img_template = batch_img_template * batch_mask_template
-
-                    if self.use_golden: batch_img_golden[num_crop,:,:,:,0] = cropped_img_golden
-
-                    num_crop += 1
-
-            # data augmentation
-            x_flip = np.random.randint(2, size=self.batch_sz)
-            z_flip = np.random.randint(2, size=self.batch_sz)
-            rot_angle = np.random.randint(4, size=self.batch_sz)
-            for j in range(self.batch_sz):
-                if x_flip[j]:
-                    batch_img[j, :, :, :, 0] = np.flip(batch_img[j, :, :, :, 0], axis=0)
-                    #batch_mask[j, :, :, :, 0] = np.flip(batch_mask[j, :, :, :, 0], axis=0)
-                    batch_img_template[j, :, :, :, 0] = np.flip(batch_img_template[j, :, :, :, 0], axis=0)
-                    #batch_mask_template[j, :, :, :, 0] = np.flip(batch_mask_template[j, :, :, :, 0], axis=0)
-                    if self.use_golden: batch_img_golden[j, :, :, :, 0] = np.flip(batch_img_golden[j, :, :, :, 0], axis=0)
-                if z_flip[j]:
-                    batch_img[j, :, :, :, 0] = np.flip(batch_img[j, :, :, :, 0], axis=2)
-                    #batch_mask[j, :, :, :, 0] = np.flip(batch_mask[j, :, :, :, 0], axis=2)
-                    batch_img_template[j, :, :, :, 0] = np.flip(batch_img_template[j, :, :, :, 0], axis=2)
-                    #batch_mask_template[j, :, :, :, 0] = np.flip(batch_mask_template[j, :, :, :, 0], axis=2)
-                    if self.use_golden: batch_img_golden[j, :, :, :, 0] = np.flip(batch_img_golden[j, :, :, :, 0], axis=2)
-                if rot_angle[j]:
-                    batch_img[j, :, :, :, 0] = np.rot90(batch_img[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
-                    #batch_mask[j, :, :, :, 0] = np.rot90(batch_mask[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
-                    batch_img_template[j, :, :, :, 0] = np.rot90(batch_img_template[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
-                    #batch_mask_template[j, :, :, :, 0] = np.rot90(batch_mask_template[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
-                    if self.use_golden: batch_img_golden[j, :, :, :, 0] = np.rot90(batch_img_golden[j, :, :, :, 0], rot_angle[j], axes=(0, 1))
-
-            yield batch_img, batch_img_template, batch_img_golden
+            if self.use_phi:
+                # the true phi of every crop, channel last
+                batch_phi = np.zeros((self.batch_sz, self.crop_sz[0], self.crop_sz[1], self.crop_sz[2], 3), dtype='float32')
+                self.fill_batch(batch_img, batch_img_template, batch_img_golden, batch_phi, dataset_name=dataset_name)
+                batch = (batch_img, batch_img_template, batch_img_golden, batch_phi)
+            else:
+                self.fill_batch(batch_img, batch_img_template, batch_img_golden, dataset_name=dataset_name)
+                batch = (batch_img, batch_img_template, batch_img_golden)
+            if self.center_sz is not None:
+                # followed by the center views of the subject, template and golden crops
+                batch += tuple(self.center_views(batch[:3]))
+            yield batch
+
+
+    def fill_batch(self, batch_img, batch_img_template, batch_img_golden, batch_phi=None, dataset_name='fly'):
+        """
+        Crop and augment one batch in place, into preallocated buffers
+        :param batch_img: float32 array (batch, x, y, z, 1) - subject crops
+        :param batch_img_template: float32 array (batch, x, y, z, 1) - template crops
+        :param batch_img_golden: float32 array (batch, x, y, z, 1) - golden crops, left untouched without use_golden
+        :param batch_phi: float32 array (batch, x, y, z, 3) - true phi crops, None to skip them. The phis are stored
+                          as (3, X, Y, Z), only the crop is moved to channel last while it is copied into the batch.
+        """
+        # randomly crop an image from imgs list
+        idx = np.random.randint(0, len(self.imgs))
+        img_for_crop = self.imgs[idx]
+        if self.use_golden: golden_for_crop = self.golden_imgs[idx]
+        if batch_phi is not None: phi_for_crop = self.phis[idx]
+        #mask_for_crop = self.masks[idx]
+
+        # only crops where more than 90% of the voxels are under the template mask are used for training,
+        # the origins of all of them are precomputed so a crop is a single draw without rejection
+        valid_origins, origin_grid = self.get_valid_crop_origins(dataset_name)
+        for num_crop in range(self.batch_sz):
+            x, y, z = np.unravel_index(valid_origins[np.random.randint(len(valid_origins))], origin_grid)
+            # crop in the x-y dimension only and use the all the slices for fish (z = 0)
+            cropped_img = img_for_crop[x:x+self.crop_sz[0], y:y+self.crop_sz[1], z:z+self.crop_sz[2]]
+            cropped_img_template = self.img_template[x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z+self.crop_sz[2]]
+            if self.use_golden: cropped_img_golden = golden_for_crop[x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z+self.crop_sz[2]]
+            #cropped_mask = mask_for_crop[x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z+self.crop_sz[2]]
+
+            #if DEBUG: print('include this batch %d, %d, %d' %(x, y, z))
+            batch_img[num_crop,:,:,:,0] = cropped_img
+            #batch_mask[num_crop,:,:,:,0] = cropped_mask
+
+            # filter the image with the mask
+            # batch_img = batch_img * batch_mask
+
+            batch_img_template[num_crop,:,:,:,0] = cropped_img_template
+
+            # filter the template with the mask
+            #batch_img_template = batch_img_template * batch_mask_template
+
+            if self.use_golden: batch_img_golden[num_crop,:,:,:,0] = cropped_img_golden
+
+            if batch_phi is not None:
+                cropped_phi = phi_for_crop[:, x:x + self.crop_sz[0], y:y + self.crop_sz[1], z:z + self.crop_sz[2]]
+                batch_phi[num_crop] = np.moveaxis(np.asarray(cropped_phi), 0, -1)
+
+        # data augmentation, the same random transform for the image, the template and the golden image
+        x_flip, z_flip, rot_angle = random_transforms(self.batch_sz)
+        augment_batch([batch_img, batch_img_template, batch_img_golden] if self.use_golden else [batch_img, batch_img_template],
+                      x_flip, z_flip, rot_angle,
+                      vector_arrays=[batch_phi] if batch_phi is not None else [])
 
 
     def _read_nifti(self,path, meta_dict={}):
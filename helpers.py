@@ -1,5 +1,7 @@
 from __future__ import print_function, division
 
+import weakref
+import numpy as np
 import keras.backend as K
 
 from tensorflow.python.framework import constant_op
@@ -19,11 +21,43 @@ import tensorflow as tf
 
 __author__ = 'elmalakis'
 
+
+# offsets of the 8 corners of a trilinear interpolation cell (000, 001, ..., 111)
+_TRILINEAR_CORNERS = [[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1], [1, 0, 0], [1, 0, 1], [1, 1, 0], [1, 1, 1]]
+
+# identity grids of the warps, one constant per graph, spatial shape and dtype
+_identity_grids = weakref.WeakKeyDictionary()
+
+
+def _static_shape(tensor):
+    """The dims of tensor, as python ints where they are statically known (so the reshapes using them fold) and as
+    scalar tensors where they are not (e.g. the batch size of a keras input)"""
+    static = tensor.get_shape().as_list()
+    dynamic = array_ops.shape(tensor)
+    return [dim if dim is not None else dynamic[i] for i, dim in enumerate(static)]
+
+
+def _identity_grid(height, width, depth, dtype):
+    """The (i, j, k) coordinates of every voxel of a height x width x depth grid, flattened to [height*width*depth, 3].
+    With a static shape it is built once with numpy and kept as a constant of the graph, otherwise it is computed
+    with a meshgrid at every step."""
+    if not all(isinstance(dim, int) for dim in (height, width, depth)):
+        grid_i, grid_j, grid_k = array_ops.meshgrid(math_ops.range(height), math_ops.range(width), math_ops.range(depth), indexing='ij')
+        return math_ops.cast(array_ops.reshape(array_ops.stack([grid_i, grid_j, grid_k], axis=3), [-1, 3]), dtype)
+    grids = _identity_grids.setdefault(ops.get_default_graph(), {})
+    key = (height, width, depth, dtypes.as_dtype(dtype).name)
+    if key not in grids:
+        grid = np.mgrid[:height, :width, :depth].reshape(3, -1).T
+        # created outside of any name scope, control dependency or control flow context it may be built in first
+        with ops.name_scope(None), ops.control_dependencies(None):
+            grids[key] = constant_op.constant(grid, dtype=dtype, name='identity_grid_%dx%dx%d' % (height, width, depth))
+    return grids[key]
+
 """
 Define trilinear interpolation
 It uses tensorflow array operations so this function has to be wrapped in a lambda layer before being used in keras
 """
-def interpolate_trilinear(grid, query_points, name='interpolate_trilinear', indexing='ijk'):
+def interpolate_trilinear(grid, query_points, name='interpolate_trilinear', indexing='ijk', fused=False):
     """Similar to Matlab's interp2 function but for 3D.
     Finds values for query points on a grid using trilinear interpolation.
     Args:
@@ -32,6 +66,10 @@ def interpolate_trilinear(grid, query_points, name='interpolate_trilinear', inde
         name: a name for the operation (optional).
         indexing: whether the query points are specified as row and column (ijk),
             or Cartesian coordinates (xyz).
+        fused: gather the 8 corners with a single gather of [batch, N, 8] linear
+            indices and combine them with the trilinear weights in one reduction,
+            instead of 8 gathers and a chain of 7 lerps (see validate_interpolation
+            in benchmarks.py).
     Returns:
         values: a 3-D `Tensor` with shape `[batch, N, channels]`
     Raises:
@@ -45,7 +83,7 @@ def interpolate_trilinear(grid, query_points, name='interpolate_trilinear', inde
     with ops.name_scope(name):
         grid = ops.convert_to_tensor(grid)
         query_points = ops.convert_to_tensor(query_points)
-        shape = array_ops.unstack(array_ops.shape(grid))
+        shape = _static_shape(grid)
         if len(shape) != 5:
             msg = 'Grid must be 5 dimensional. Received: '
             raise ValueError(msg + str(shape))
@@ -54,7 +92,7 @@ def interpolate_trilinear(grid, query_points, name='interpolate_trilinear', inde
         grid_type = grid.dtype
 
         query_type = query_points.dtype
-        query_shape = array_ops.unstack(array_ops.shape(query_points))
+        query_shape = _static_shape(query_points)
 
         if len(query_shape) != 3:
             msg = ('Query points must be 3 dimensional. Received: ')
@@ -106,6 +144,22 @@ def interpolate_trilinear(grid, query_points, name='interpolate_trilinear', inde
         batch_offsets = array_ops.reshape(
             math_ops.range(batch_size) * height * width * depth, [batch_size, 1])
 
+        if fused:
+            with ops.name_scope('fused'):
+                # linear index of the floor corner, then the offsets of the 8 corners (000, 001, ..., 111)
+                corners = constant_op.constant(_TRILINEAR_CORNERS, dtype=dtypes.int32)
+                strides = array_ops.stack([width * depth, depth, 1])
+                base = math_ops.reduce_sum(array_ops.stack(floors, axis=2) * strides, axis=2) + batch_offsets
+                offsets = math_ops.reduce_sum(corners * strides, axis=1)
+                linear_coordinates = array_ops.expand_dims(base, 2) + offsets               # [b, n, 8]
+                gathered_values = array_ops.gather(flattened_grid, linear_coordinates)      # [b, n, 8, c]
+
+                # weight of every corner: the product over the 3 dims of alpha (ceil) or 1 - alpha (floor)
+                alpha = array_ops.expand_dims(array_ops.concat(alphas, axis=2), 2)          # [b, n, 1, 3]
+                corners = math_ops.cast(corners, grid_type)
+                weights = math_ops.reduce_prod(alpha * corners + (1 - alpha) * (1 - corners), axis=3)
+                return math_ops.reduce_sum(gathered_values * array_ops.expand_dims(weights, 3), axis=2)
+
         # This wraps array_ops.gather. We reshape the image data such that the
         # batch, y, x and z coordinates are pulled into the first dimension.
         # Then we gather. Finally, we reshape the output back. It's possible this
@@ -124,7 +178,8 @@ def interpolate_trilinear(grid, query_points, name='interpolate_trilinear', inde
             with ops.name_scope('gather-' + name):
                 # map the indices of a matrix to a 1-dim array
                 #https://stackoverflow.com/questions/14015556/how-to-map-the-indexes-of-a-matrix-to-a-1-dimensional-array-c/27084843
-                linear_coordinates = batch_offsets + i_coords*(width*height) + j_coords*(width) +  k_coords
+                # row-major [batch, height, width, depth]: the strides of i and j are width * depth and depth
+                linear_coordinates = batch_offsets + i_coords*(width*depth) + j_coords*(depth) +  k_coords
                 gathered_values = array_ops.gather(flattened_grid, linear_coordinates)
                 return array_ops.reshape(gathered_values,
                                          [batch_size, num_queries, channels])
@@ -258,29 +313,18 @@ def dense_image_warp_3D(tensors, name='dense_image_warp'):
     image = tensors[0]
     flow = tensors[1]
 
-    batch_size, height, width, depth, channels = (array_ops.shape(image)[0],
-                                                array_ops.shape(image)[1],
-                                                array_ops.shape(image)[2],
-                                                array_ops.shape(image)[3],
-                                                array_ops.shape(image)[4])
+    batch_size, height, width, depth, channels = _static_shape(image)
 
     # The flow is defined on the image grid. Turn the flow into a list of query
     # points in the grid space.
     #grid_x, grid_y, grid_z = array_ops.meshgrid(math_ops.range(width), math_ops.range(height), math_ops.range(depth))
     #stacked_grid = math_ops.cast(array_ops.stack([grid_y, grid_x, grid_z], axis=3), flow.dtype)
 
-    grid_i, grid_j, grid_k = array_ops.meshgrid(math_ops.range(height), math_ops.range(width), math_ops.range(depth), indexing='ij')
-    stacked_grid = math_ops.cast(array_ops.stack([grid_i, grid_j, grid_k], axis=3), flow.dtype)
-
-    batched_grid = array_ops.expand_dims(stacked_grid, axis=0) #add the batch dim on axis 0
-
-    query_points_on_grid = batched_grid - flow
-    if DEBUG: query_points_on_grid= K.print_tensor(query_points_on_grid, message="query_points_on_grid is:")
-
-    query_points_flattened = array_ops.reshape(query_points_on_grid,
-                                               [batch_size, height * width * depth, 3])
-
+    # the identity grid [height*width*depth, 3] is a constant built once for a static shape,
+    # the batch dim is added by broadcasting
+    flattened_grid = _identity_grid(height, width, depth, flow.dtype)
 
+    query_points_flattened = flattened_grid - array_ops.reshape(flow, [batch_size, height * width * depth, 3])
     if DEBUG: query_points_flattened = K.print_tensor(query_points_flattened, message="query_points_flattened is:")
     # Compute values at the query points, then reshape the result back to the
     # image grid.
@@ -292,6 +336,100 @@ def dense_image_warp_3D(tensors, name='dense_image_warp'):
 
 
 
+
+def _warp_corners(image, flow):
+    """Corners and weights of the trilinear interpolation of dense_image_warp_3D, clamped like interpolate_trilinear
+    Args:
+      image: 5-D float `Tensor` with shape `[batch, height, width, depth, channels]`.
+      flow: A 5-D float `Tensor` with shape `[batch, height, width, depth, 3]`.
+    Returns:
+      linear: int32 `Tensor` `[batch, N, 8]` - indices of the 8 corners in the flattened image
+      factors: `Tensor` `[batch, N, 8, 3]` - alpha or 1 - alpha of every corner along every dim,
+        the weight of a corner is the product of its 3 factors
+      alpha_valid: `Tensor` `[batch, N, 3]` - 1 where the autodiff of the clipping passes the gradient to alpha
+    """
+    batch_size, height, width, depth, _ = _static_shape(image)
+
+    query_points = _identity_grid(height, width, depth, flow.dtype) - array_ops.reshape(flow, [batch_size, height * width * depth, 3])
+
+    max_floor = math_ops.cast(array_ops.stack([height, width, depth]) - 2, flow.dtype)
+    floor = math_ops.minimum(math_ops.maximum(0., math_ops.floor(query_points)), max_floor)
+    alpha = math_ops.cast(query_points - floor, image.dtype)
+    # the gradient of the clipping of interpolate_trilinear, minimum(maximum(0, alpha), 1), reaches alpha where
+    # 0 < alpha <= 1: maximum passes it to its first argument (the 0) on ties and minimum to its first argument (alpha)
+    alpha_valid = math_ops.cast(math_ops.logical_and(alpha > 0., alpha <= 1.), image.dtype)
+    alpha = math_ops.minimum(math_ops.maximum(0., alpha), 1.)
+
+    corners = constant_op.constant(_TRILINEAR_CORNERS, dtype=dtypes.int32)
+    strides = array_ops.stack([width * depth, depth, 1])
+    batch_offsets = array_ops.reshape(math_ops.range(batch_size) * height * width * depth, [batch_size, 1])
+    base = math_ops.reduce_sum(math_ops.cast(floor, dtypes.int32) * strides, axis=2) + batch_offsets
+    linear = array_ops.expand_dims(base, 2) + math_ops.reduce_sum(corners * strides, axis=1)
+
+    corners = math_ops.cast(corners, image.dtype)
+    alpha = array_ops.expand_dims(alpha, 2)
+    factors = alpha * corners + (1 - alpha) * (1 - corners)
+    return linear, factors, alpha_valid
+
+
+# This use tf and will be wrapped to be used in Lambda layer in Keras
+def dense_image_warp_3D_lean(tensors, name='dense_image_warp_lean'):
+    """Same warp as dense_image_warp_3D with a hand-written gradient.
+    The backward pass only keeps the image and the flow: the corner indices and weights
+    are recomputed from them instead of keeping floors, alphas, the gathered corners and
+    the interpolation intermediates of the forward pass alive until the backward pass.
+      d warped / d image: the incoming gradient times the weight, summed into every corner
+      d warped / d flow: - sum over the corners of value * d weight / d alpha, where alpha was not clipped
+    Args:
+      tensors: [image, flow] - see dense_image_warp_3D
+      name: A name for the operation (optional).
+    Returns:
+      A 5-D float `Tensor` with shape`[batch, height, width, depth, channels]`
+    """
+
+    @tf.custom_gradient
+    def warp(image, flow):
+        shape = array_ops.shape(image)
+        flattened_grid = array_ops.reshape(image, [-1, shape[4]])
+        linear, factors, _ = _warp_corners(image, flow)
+        weights = math_ops.reduce_prod(factors, axis=3)
+        interpolated = math_ops.reduce_sum(array_ops.gather(flattened_grid, linear) * array_ops.expand_dims(weights, 3), axis=2)
+        interpolated = array_ops.reshape(interpolated, shape)
+
+        def grad(d_warped):
+            # the recomputation depends on the incoming gradient so it runs in the backward pass and
+            # is not merged with the forward ops, which would keep them alive
+            with ops.control_dependencies([d_warped]):
+                image_r = array_ops.identity(image)
+                flow_r = array_ops.identity(flow)
+            flattened_grid_r = array_ops.reshape(image_r, [-1, shape[4]])
+            linear_r, factors_r, alpha_valid = _warp_corners(image_r, flow_r)
+            weights_r = math_ops.reduce_prod(factors_r, axis=3)
+            d_interpolated = array_ops.expand_dims(array_ops.reshape(d_warped, [shape[0], -1, shape[4]]), 2)  # [b, n, 1, c]
+
+            d_image = math_ops.unsorted_segment_sum(array_ops.reshape(array_ops.expand_dims(weights_r, 3) * d_interpolated, [-1, shape[4]]),
+                                                    array_ops.reshape(linear_r, [-1]),
+                                                    num_segments=array_ops.shape(flattened_grid_r)[0])
+            d_image = array_ops.reshape(d_image, shape)
+
+            d_weights = math_ops.reduce_sum(array_ops.gather(flattened_grid_r, linear_r) * d_interpolated, axis=3)  # [b, n, 8]
+            sign = 2 * math_ops.cast(constant_op.constant(_TRILINEAR_CORNERS), image.dtype) - 1  # + ceil, - floor
+            d_alpha = []
+            for dim in range(3):
+                others = [d for d in range(3) if d != dim]
+                d_factor = factors_r[:, :, :, others[0]] * factors_r[:, :, :, others[1]] * sign[:, dim]
+                d_alpha.append(math_ops.reduce_sum(d_weights * d_factor, axis=2))
+            # query = grid - flow
+            d_flow = -array_ops.stack(d_alpha, axis=2) * alpha_valid
+            d_flow = math_ops.cast(array_ops.reshape(d_flow, array_ops.shape(flow)), flow.dtype)
+            return d_image, d_flow
+
+        return interpolated, grad
+
+    with ops.name_scope(name):
+        return warp(tensors[0], tensors[1])
+
+
 #https://github.com/kuza55/keras-extras/blob/master/utils/multi_gpu.py
 def make_parallel(model, gpu_count):
     def get_slice(data, idx, parts):
@@ -1,7 +1,10 @@
+import os
+import threading
 import numpy as np
-import multiprocessing
-from skimage.transform import warp
-from joblib import Parallel, delayed
+from functools import lru_cache
+from collections import OrderedDict
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 
@@ -193,48 +196,275 @@ def _interpolate_scalar_3d(volume, dkk, dii, djj):
     return out
 
 
-def dense_image_warp_3D_scikit(image, flow):
-    batch_size, height, width, depth, channels = (np.shape(image)[0],
-                                                  np.shape(image)[1],
-                                                  np.shape(image)[2],
-                                                  np.shape(image)[3],
-                                                  np.shape(image)[4])
+class WarpPlan():
+    """
+    Interpolation indices and weights of one set of query points (one phi), computed once and applied to any number
+    of volumes or channels: every apply is 8 gathers (1 in nearest mode) instead of a new index computation
+    """
 
+    _corners = [(0, 0, 0), (0, 0, 1), (0, 1, 0), (0, 1, 1), (1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]
+
+    def __init__(self, query_points, shape, boundary='zero'):
+        """
+        :param query_points: float array (b, ..., 3) - positions in voxels along x, y and z
+        :param shape: tuple - (x, y, z) shape of the volumes the plan is applied to
+        :param boundary: string - 'zero': the semantics of _interpolate_scalar_3d, a point is 0 unless -1 < q < n along
+                         every axis and the corners outside the volume contribute 0.
+                         'clamp': the points are clamped to the volume (helpers.dense_image_warp_3D)
+        """
+        if boundary not in ('zero', 'clamp'):
+            raise ValueError('Boundary %s is not available' % (boundary))
+        self.batch_size = query_points.shape[0]
+        self.output_shape = query_points.shape[:-1]
+        self.shape = np.array(shape)
+        self.boundary = boundary
+
+        query = query_points.reshape(self.batch_size, -1, 3)
+        if boundary == 'clamp':
+            query = np.clip(query, 0, self.shape - 1)
+            self.inside = None
+        else:
+            self.inside = np.all((query > -1) & (query < self.shape), axis=-1)
+        self.query = query
+        self._strides = np.array([self.shape[1] * self.shape[2], self.shape[2], 1])
+        # the whole batch is gathered from one flat (b * x * y * z, c) view
+        self._batch_offset = (np.arange(self.batch_size) * np.prod(self.shape))[:, None]
+        self._linear = None
+        self._nearest = None
+
+    def _linear_plan(self):
+        if self._linear is None:
+            base = np.floor(self.query)
+            if self.boundary == 'clamp':
+                base = np.clip(base, 0, np.maximum(self.shape - 2, 0))
+            frac = (self.query - base).astype(np.float32)
+            base = base.astype(np.int64)
+            indices, weights = [], []
+            for corner in self._corners:
+                idx = base + corner
+                weight = np.prod(np.where(corner, frac, 1 - frac), axis=-1)
+                if self.boundary == 'zero':
+                    weight *= self.inside & np.all((idx >= 0) & (idx < self.shape), axis=-1)
+                indices.append(np.dot(np.clip(idx, 0, self.shape - 1), self._strides) + self._batch_offset)
+                weights.append(weight)
+            self._linear = (indices, weights)
+        return self._linear
+
+    def _nearest_plan(self):
+        if self._nearest is None:
+            idx = np.floor(self.query + 0.5).astype(np.int64)
+            valid = None
+            if self.boundary == 'zero':
+                valid = self.inside & np.all((idx >= 0) & (idx < self.shape), axis=-1)
+            self._nearest = (np.dot(np.clip(idx, 0, self.shape - 1), self._strides) + self._batch_offset, valid)
+        return self._nearest
+
+    def apply(self, volume, mode='linear'):
+        """
+        :param volume: array (b, x, y, z, c)
+        :param mode: string - 'linear' (trilinear) or 'nearest' for labels and masks (keeps the dtype of the volume)
+        :return: array (b, ..., c)
+        """
+        channels = volume.shape[-1]
+        flat_volume = volume.reshape(-1, channels)
+        if mode == 'linear':
+            indices, weights = self._linear_plan()
+            warped = np.zeros(indices[0].shape + (channels,), dtype=np.float32)
+            for idx, weight in zip(indices, weights):
+                warped += weight[..., None] * flat_volume[idx]
+            warped = warped.astype(volume.dtype) if np.issubdtype(volume.dtype, np.floating) else warped
+        elif mode == 'nearest':
+            idx, valid = self._nearest_plan()
+            warped = flat_volume[idx]
+            if valid is not None:
+                warped[~valid] = 0
+        else:
+            raise ValueError('Interpolation %s is not available' % (mode))
+        return warped.reshape(self.output_shape + (channels,))
+
+    def apply_many(self, volumes, modes='linear'):
+        """
+        :param volumes: list of arrays (b, x, y, z, c) of the shape of the plan
+        :param modes: string or list of strings - interpolation of every volume
+        :return: list of the warped volumes
+        """
+        if isinstance(modes, str):
+            modes = [modes] * len(volumes)
+        return [self.apply(v, m) for v, m in zip(volumes, modes)]
+
+
+def interpolate_trilinear_3D(image, query_points):
+    """
+    Vectorized trilinear interpolation of a batch of volumes, with the zero-outside semantics of
+    _interpolate_scalar_3d: a point is 0 unless -1 < q < n along every axis and the corners of its cell that fall
+    outside the volume contribute 0
+    :param image: array (b, x, y, z, c)
+    :param query_points: float array (b, ..., 3) - positions in voxels along x, y and z
+    :return: array (b, ..., c) of the dtype of the image
+    """
+    return WarpPlan(query_points, image.shape[1:4]).apply(image)
 
-    input_sz = 64
-    output_sz = 24
-    gap = int((input_sz - output_sz) / 2)
-    batch_img_sub = np.zeros((batch_size, output_sz, output_sz, output_sz, channels), dtype=image.dtype)
-    batch_img_sub[:, :, :, :, :] = image[:, 0 + gap:0 + gap + output_sz,
-                                   0 + gap:0 + gap + output_sz,
-                                   0 + gap:0 + gap + output_sz, :]
 
-    warped_img = np.zeros(shape=np.shape(batch_img_sub), dtype=image.dtype)
+def dense_image_warp_3D_trilinear(image, flow):
+    """
+    Vectorized replacement of dense_image_warp_3D_dipy (same result without the per-voxel loops) for any shape
+    warped[b, i, j, k] = image[b, i + flow[..., 1], j + flow[..., 2], k + flow[..., 0]] (trilinear, zero outside)
+    The component order is the one of the dipy port, which transposes the image axes to (k, i, j) but not the flow
+    components. The output grid is the one of the flow, in the coordinates of the image (no offset).
+    :param image: array (b, x, y, z, c)
+    :param flow: array (b, x', y', z', 3)
+    :return: array (b, x', y', z', c)
+    """
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in flow.shape[1:4]], indexing='ij'), axis=-1)
+    query_points = grid + flow[..., [1, 2, 0]]
+    return interpolate_trilinear_3D(image, query_points)
 
-    grid_i, grid_j, grid_k = np.mgrid[:output_sz, :output_sz, :output_sz]
-    coords = np.array([grid_i, grid_j, grid_k]) # (3, 24, 24, 24)
-    batched_coord = np.expand_dims(coords, axis=0)  #add the batch dim on axis 0 # b, 3, 24, 24, 24
-    flow_perm = np.transpose(flow, axes=[0, 4, 1, 2, 3]) # b, 3, i, j, k
-    # subtraction because we are specifying where in the original image each pixel in the new image comes from
-    query_points_on_grid = batched_coord - flow_perm
 
+@lru_cache(maxsize=8)
+def _identity_grid(shape):
+    """(3, x, y, z) voxel coordinates of a grid, built once per shape"""
+    grid = np.mgrid[:shape[0], :shape[1], :shape[2]].astype(np.float32)
+    grid.flags.writeable = False
+    return grid
 
-    for b in range(batch_size):
-        volume = image[b, :,:,:, 0]
-        warped_img[b, :,:,:, 0] = warp(volume, query_points_on_grid[b,:,:,:,:], order=3, mode='edge')
+
+_pools = {}
 
 
+def _get_pool(worker_type, n_workers):
+    """The pools are kept between calls, starting worker processes for every batch would cost more than the warp"""
+    if (worker_type, n_workers) not in _pools:
+        if worker_type == 'thread':
+            _pools[(worker_type, n_workers)] = ThreadPoolExecutor(max_workers=n_workers)
+        elif worker_type == 'process':
+            _pools[(worker_type, n_workers)] = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            raise ValueError('Worker type %s is not available' % (worker_type))
+    return _pools[(worker_type, n_workers)]
 
-    # def _warp_batch(b):
-    #     volume = image[b, :, :, :, 0]
-    #     warped_batch_image = warp(volume, query_points_on_grid[b, :, :, :, :])
-    #     return warped_batch_image
-    #
-    # returns =  Parallel(n_jobs=batch_size)(delayed(_warp_batch)(b) for b in range(batch_size))
-    #
-    # for b in returns:
-    #     warped_img[b, :, :, :, 0] = returns(b)
 
-    #warped_img[b, :, :, :, 0] = result
+# map_coordinates(mode='nearest') pads the input with 12 edge voxels before the prefilter, the cached coefficients are
+# padded the same way so the prefiltered path gives the same result
+_SPLINE_PAD = 12
 
+
+class SplineCoefficientCache():
+    """
+    LRU cache of the B-spline coefficients of the volumes warped with order > 1, bounded in bytes.
+    Warping the same volume with many phis (checkpoints, sweeps) then runs the spline prefilter over the volume once.
+    A volume is identified by an explicit key (e.g. the subject index) or else by its buffer (data pointer, shape,
+    strides, dtype); the cache keeps a reference to such a volume so its buffer cannot be reused by another array while
+    the entry lives. A volume that is modified in place (e.g. a reused batch buffer) needs an explicit key.
+    """
+
+    def __init__(self, max_bytes=2 ** 30):
+        """
+        :param max_bytes: int - maximum size of the cached coefficients
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, volume, order=3, key=None):
+        """
+        :param volume: 3-D array
+        :param order: int - spline order, 2 to 5
+        :param key: hashable - identity of the volume, None to use its buffer
+        :return: coefficients (float64, padded by _SPLINE_PAD), (min, max) of the volume
+        """
+        if key is None:
+            key = (volume.__array_interface__['data'][0], volume.shape, volume.strides, volume.dtype.str)
+            reference = volume
+        else:
+            reference = None
+        key = (key, order)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][:2]
+            self.misses += 1
+
+        coefficients = ndimage.spline_filter(np.pad(volume, _SPLINE_PAD, mode='edge'), order=order,
+                                             output=np.float64, mode='nearest')
+        value_range = (volume.min(), volume.max())
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (coefficients, value_range, reference)
+                self.nbytes += coefficients.nbytes
+                while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                    evicted = self._entries.popitem(last=False)[1]
+                    self.nbytes -= evicted[0].nbytes
+        return coefficients, value_range
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def report(self):
+        return ('[Spline cache %d volumes, %.1f MB: %d hits, %d misses]'
+                % (len(self._entries), self.nbytes / 2. ** 20, self.hits, self.misses))
+
+
+def _map_coordinates(volume, coords, order, prefilter=True, value_range=None):
+    if not prefilter:
+        coords = coords + _SPLINE_PAD  # the volume is the padded coefficients of the spline cache
+    warped = ndimage.map_coordinates(volume, coords, order=order, mode='nearest', prefilter=prefilter,
+                                     output=np.float32)
+    # clip to the range of the input as skimage.transform.warp(clip=True) did
+    if value_range is None:
+        value_range = (volume.min(), volume.max())
+    return np.clip(warped, value_range[0], value_range[1], out=warped)
+
+
+def dense_image_warp_3D_scikit(image, flow, order=3, n_workers=None, worker_type='thread', spline_cache=None,
+                               cache_keys=None):
+    """
+    Warp with scipy.ndimage.map_coordinates (same result as the skimage.transform.warp(order=3, mode='edge') it replaces)
+    warped[b, p] = image[b, p - flow[b, p]], the points outside the image take the value of the nearest edge voxel
+    :param image: array (b, x, y, z, c)
+    :param flow: array (b, x', y', z', 3) - the output grid is the one of the flow, in the coordinates of the image
+    :param order: int - spline order of the interpolation, 0 to 5
+    :param n_workers: int - number of workers the batch elements and channels are spread over, 1 to run serially,
+                      None for one per core
+    :param worker_type: string - 'thread' or 'process'
+    :param spline_cache: SplineCoefficientCache - reuse the prefiltered coefficients of volumes warped before (order > 1)
+    :param cache_keys: list - identity of every batch element in the spline cache, None to use the image buffers
+    :return: array (b, x', y', z', c)
+    """
+    batch_size, channels = image.shape[0], image.shape[4]
+    output_shape = tuple(flow.shape[1:4])
+
+    # subtraction because we are specifying where in the original image each pixel in the new image comes from
+    query_points_on_grid = _identity_grid(output_shape)[None] - np.moveaxis(flow, -1, 1)  # b, 3, x', y', z'
+
+    tasks = [(b, c) for b in range(batch_size) for c in range(channels)]
+    volumes = [image[b, :, :, :, c] for b, c in tasks]
+    prefilter, value_ranges = True, [None] * len(tasks)
+    if spline_cache is not None and order > 1:
+        cached = [spline_cache.get(image[b, :, :, :, c], order, key=None if cache_keys is None else (cache_keys[b], c))
+                  for b, c in tasks]
+        volumes, value_ranges = [v for v, _ in cached], [r for _, r in cached]
+        prefilter = False
+
+    n_workers = min(n_workers or os.cpu_count() or 1, len(tasks))
+    if n_workers <= 1:
+        results = [_map_coordinates(volumes[t], query_points_on_grid[b], order, prefilter, value_ranges[t])
+                   for t, (b, c) in enumerate(tasks)]
+    else:
+        pool = _get_pool(worker_type, n_workers)
+        results = pool.map(_map_coordinates,
+                           volumes,
+                           [query_points_on_grid[b] for b, c in tasks],
+                           [order] * len(tasks),
+                           [prefilter] * len(tasks),
+                           value_ranges)
+
+    warped_img = np.zeros(shape=(batch_size,) + output_shape + (channels,), dtype=image.dtype)
+    for (b, c), warped in zip(tasks, results):
+        warped_img[b, :, :, :, c] = warped
     return warped_img
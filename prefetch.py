@@ -0,0 +1,151 @@
+from __future__ import print_function, division
+
+import os
+import time
+import queue
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+
+__author__ = 'elmalakis'
+
+
+_DONE = '__done__'
+_ERROR = '__error__'
+
+
+class BatchPrefetcher():
+    """
+    Produce the batches of DataLoader.load_batch / load_batch_toy in the background while the model trains.
+    Iterating over the prefetcher yields the same tuples as the wrapped generator.
+    The counters tell whether the trainer is data-bound:
+        starved     - number of batches the trainer had to wait for (the queue was empty)
+        wait_time   - seconds the trainer spent waiting for batches
+        full        - number of batches a worker could not queue right away (the trainer is the bottleneck)
+    """
+
+    def __init__(self, batch_fn, queue_depth=4, n_workers=1, worker_type='thread', n_batches=None):
+        """
+        :param batch_fn: callable that returns a batch generator, e.g. data_loader.load_batch
+        :param queue_depth: int - number of batches kept ready
+        :param n_workers: int - number of producers, each one runs its own batch_fn() generator
+        :param worker_type: string - 'thread' or 'process' (forked, the DataLoader volumes are shared copy-on-write)
+        :param n_batches: int - total number of batches of an epoch, None for one pass over every worker generator.
+                          With several workers set it to the length of one generator (data_loader.n_batches - 1)
+                          to keep the epoch length unchanged.
+        """
+        if worker_type not in ('thread', 'process'):
+            raise ValueError('Worker type %s is not available' % (worker_type))
+        self.batch_fn = batch_fn
+        self.queue_depth = queue_depth
+        self.n_workers = n_workers
+        self.worker_type = worker_type
+        self.n_batches = n_batches
+
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.
+        self.full = 0
+
+    def _produce(self, worker_id, batch_queue, tickets, stop):
+        if self.worker_type == 'process':
+            # forked workers inherit the random state of the parent, reseed so they do not draw the same crops
+            np.random.seed((os.getpid() * 7919 + worker_id) % (2 ** 32))
+        full = 0
+        try:
+            batches = self.batch_fn()
+            while not stop.is_set():
+                if tickets is not None:
+                    with tickets.get_lock():
+                        if tickets.value <= 0:
+                            break
+                        tickets.value -= 1
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    if tickets is None:
+                        break
+                    # keep producing until the epoch has all its batches
+                    batches = self.batch_fn()
+                    batch = next(batches)
+                try:
+                    batch_queue.put(batch, block=False)
+                except queue.Full:
+                    full += 1
+                    while not stop.is_set():
+                        try:
+                            batch_queue.put(batch, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+            batch_queue.put((_DONE, full))
+        except Exception:
+            batch_queue.put((_ERROR, traceback.format_exc()))
+
+    def __iter__(self):
+        if self.worker_type == 'thread':
+            batch_queue = queue.Queue(maxsize=self.queue_depth)
+            stop = threading.Event()
+            tickets = _Counter(self.n_batches) if self.n_batches is not None else None
+            workers = [threading.Thread(target=self._produce, args=(i, batch_queue, tickets, stop))
+                       for i in range(self.n_workers)]
+        else:
+            ctx = multiprocessing.get_context('fork')
+            batch_queue = ctx.Queue(maxsize=self.queue_depth)
+            stop = ctx.Event()
+            tickets = ctx.Value('l', self.n_batches) if self.n_batches is not None else None
+            workers = [ctx.Process(target=self._produce, args=(i, batch_queue, tickets, stop))
+                       for i in range(self.n_workers)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        running = len(workers)
+        try:
+            while running > 0:
+                waited = None
+                try:
+                    batch = batch_queue.get(block=False)
+                except queue.Empty:
+                    start_time = time.time()
+                    batch = batch_queue.get()
+                    waited = time.time() - start_time
+                if isinstance(batch, tuple) and len(batch) == 2 and isinstance(batch[0], str):
+                    if batch[0] == _DONE:
+                        running -= 1
+                        self.full += batch[1]
+                        continue
+                    if batch[0] == _ERROR:
+                        raise RuntimeError('Batch worker failed:\n' + batch[1])
+                # only the waits for a batch count, not the ones for the end of a worker
+                if waited is not None:
+                    self.starved += 1
+                    self.wait_time += waited
+                self.batches += 1
+                yield batch
+        finally:
+            stop.set()
+            for w in workers:
+                w.join(timeout=1)
+                if self.worker_type == 'process' and w.is_alive():
+                    w.terminate()
+
+    def close(self):
+        """Nothing is held between two iterations, the workers are joined at the end of every one (see SharedBatchRing)"""
+        pass
+
+    def report(self):
+        return ('[Prefetch %d batches: starved %d (%.1f%%), waited %.2fs, queue full %d]'
+                % (self.batches, self.starved, 100. * self.starved / max(self.batches, 1), self.wait_time, self.full))
+
+
+class _Counter():
+    """threading stand-in for multiprocessing.Value"""
+
+    def __init__(self, value):
+        self.value = value
+        self._lock = threading.Lock()
+
+    def get_lock(self):
+        return self._lock
@@ -0,0 +1,134 @@
+from __future__ import print_function, division
+
+import numpy as np
+import tensorflow as tf
+
+__author__ = 'elmalakis'
+
+
+"""
+Regularizers of the deformation field phi (b, x, y, z, 3), component i of phi is the displacement along axis i.
+The derivatives are finite differences computed with one conv3d of fixed kernels: the 3 components are moved to the
+batch dim so a single-channel kernel serves all of them, and the border is padded by extrapolating linearly,
+phi[-1] = 2 phi[0] - phi[1], so the first derivatives on the border are the one-sided differences of
+numerical_gradient_3D (and of Matlab gradient(F)) and the second derivatives along the axis are 0 there.
+    first derivatives       d_a phi_c = 0.5 * (phi_c[p + e_a] - phi_c[p - e_a])
+    second derivatives      d_aa phi_c = phi_c[p + e_a] - 2 phi_c[p] + phi_c[p - e_a]
+                            d_ab phi_c = 0.25 * (phi_c[p + e_a + e_b] - phi_c[p + e_a - e_b] - phi_c[p - e_a + e_b] + phi_c[p - e_a - e_b])
+The penalties are summed over the voxels of every sample, like the gradient penalty of the models:
+    gradient L2             sum of (d_a phi_c)^2
+    summed gradient         sum of (d_0 phi_c + d_1 phi_c + d_2 phi_c)^2, the squares of numerical_gradient_3D summed
+    bending energy          sum of (d_aa phi_c)^2 + 2 (d_ab phi_c)^2
+    folding                 sum of max(0, -det J), J = I - grad phi the jacobian of p -> p - phi(p) (see dense_image_warp_3D)
+"""
+
+
+_SECOND_ORDER = [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]
+
+
+def _difference_kernels(second_order=False):
+    """Kernels (3, 3, 3, 1, n): the 3 first derivatives, then the 6 second derivatives (00, 11, 22, 01, 02, 12)"""
+    kernels = []
+    for a in range(3):
+        k = np.zeros((3, 3, 3))
+        k[tuple(2 if d == a else 1 for d in range(3))] = 0.5
+        k[tuple(0 if d == a else 1 for d in range(3))] = -0.5
+        kernels.append(k)
+    if second_order:
+        for a, b in _SECOND_ORDER:
+            k = np.zeros((3, 3, 3))
+            if a == b:
+                k[1, 1, 1] = -2.
+                k[tuple(2 if d == a else 1 for d in range(3))] = 1.
+                k[tuple(0 if d == a else 1 for d in range(3))] = 1.
+            else:
+                for sa in (0, 2):
+                    for sb in (0, 2):
+                        idx = [1, 1, 1]
+                        idx[a], idx[b] = sa, sb
+                        k[tuple(idx)] = 0.25 if sa == sb else -0.25
+            kernels.append(k)
+    return np.stack(kernels, axis=-1)[:, :, :, None, :].astype('float32')
+
+
+def _pad_linear(x):
+    """Pad the spatial dims of (n, x, y, z, c) by 1 on both sides, extrapolating linearly: x[-1] = 2 x[0] - x[1]"""
+    for axis in (1, 2, 3):
+        paddings = [[0, 0]] * 5
+        paddings[axis] = [1, 1]
+        # the symmetric pad repeats x[0], the reflect pad takes x[1]
+        x = 2. * tf.pad(x, paddings, mode='SYMMETRIC') - tf.pad(x, paddings, mode='REFLECT')
+    return x
+
+
+def flow_derivatives(phi, second_order=False):
+    """
+    Finite differences of every component of phi, in one conv3d
+    Args:
+        phi: 5-D float `Tensor` with shape `[batch, height, width, depth, 3]`.
+        second_order: also compute the second derivatives.
+    Returns:
+        D: 6-D `Tensor` with shape `[batch, height, width, depth, 3, n]`, D[..., c, a] = d_a phi_c for a < 3, then the
+        second derivatives in the order of _SECOND_ORDER when second_order.
+    """
+    shape = tf.shape(phi)
+    kernels = _difference_kernels(second_order)
+    # the components go to the batch dim: (b, x, y, z, 3) -> (b * 3, x, y, z, 1)
+    channels_first = tf.transpose(phi, [0, 4, 1, 2, 3])
+    stacked = tf.expand_dims(tf.reshape(channels_first, [-1, shape[1], shape[2], shape[3]]), -1)
+    padded = _pad_linear(stacked)
+    derivatives = tf.nn.conv3d(padded, tf.constant(kernels, dtype=phi.dtype), strides=[1, 1, 1, 1, 1], padding='VALID')
+    # back to (b, x, y, z, 3, n)
+    derivatives = tf.reshape(derivatives, [shape[0], 3, shape[1], shape[2], shape[3], kernels.shape[-1]])
+    return tf.transpose(derivatives, [0, 2, 3, 4, 1, 5])
+
+
+def _determinant(J):
+    """Determinant of [..., 3, 3] matrices"""
+    return (J[..., 0, 0] * (J[..., 1, 1] * J[..., 2, 2] - J[..., 1, 2] * J[..., 2, 1])
+            - J[..., 0, 1] * (J[..., 1, 0] * J[..., 2, 2] - J[..., 1, 2] * J[..., 2, 0])
+            + J[..., 0, 2] * (J[..., 1, 0] * J[..., 2, 1] - J[..., 1, 1] * J[..., 2, 0]))
+
+
+def flow_regularizer(phi, gradient_weight=1., bending_weight=0., folding_weight=0., summed_gradient_weight=0.):
+    """
+    Weighted sum of the gradient L2, bending energy, folding and summed gradient penalties of phi, from a single pass
+    of derivatives (the second derivatives are only computed when the bending energy is used)
+    Args:
+        phi: 5-D float `Tensor` with shape `[batch, height, width, depth, 3]`.
+        gradient_weight, bending_weight, folding_weight, summed_gradient_weight: weights of the penalties.
+    Returns:
+        1-D `Tensor` with shape `[batch]`, the penalty of every sample.
+    """
+    derivatives = flow_derivatives(phi, second_order=bending_weight != 0)
+    gradient = derivatives[..., :3]
+    penalty = 0.
+    if gradient_weight:
+        penalty += gradient_weight * tf.reduce_sum(tf.square(gradient), axis=[1, 2, 3, 4, 5])
+    if summed_gradient_weight:
+        # the penalty of the models: numerical_gradient_3D adds the 3 partial derivatives of every component
+        penalty += summed_gradient_weight * tf.reduce_sum(tf.square(tf.reduce_sum(gradient, axis=5)), axis=[1, 2, 3, 4])
+    if bending_weight:
+        # the mixed derivatives count twice in the sum over all the pairs of axes
+        pair_weights = tf.constant([1., 1., 1., 2., 2., 2.], dtype=phi.dtype)
+        penalty += bending_weight * tf.reduce_sum(tf.square(derivatives[..., 3:]) * pair_weights, axis=[1, 2, 3, 4, 5])
+    if folding_weight:
+        J = tf.eye(3, dtype=phi.dtype) - gradient
+        penalty += folding_weight * tf.reduce_sum(tf.nn.relu(-_determinant(J)), axis=[1, 2, 3])
+    return penalty
+
+
+def gradient_l2(phi):
+    return flow_regularizer(phi, gradient_weight=1.)
+
+
+def bending_energy(phi):
+    return flow_regularizer(phi, gradient_weight=0., bending_weight=1.)
+
+
+def jacobian_folding(phi):
+    return flow_regularizer(phi, gradient_weight=0., folding_weight=1.)
+
+
+def summed_gradient(phi):
+    return flow_regularizer(phi, gradient_weight=0., summed_gradient_weight=1.)
@@ -0,0 +1,136 @@
+from __future__ import print_function, division
+
+import os
+import mmap
+import time
+import traceback
+import multiprocessing
+import numpy as np
+
+__author__ = 'elmalakis'
+
+
+class SharedBatchRing():
+    """
+    Multi-process crop workers that write finished batches into a ring of preallocated shared batch buffers.
+    The DataLoader volumes are placed in shared memory once (DataLoader.share_volumes) and inherited by the forked
+    workers, so no worker holds its own copy of the volumes. A worker takes a free slot, fills it in place with
+    DataLoader.fill_batch and hands the slot index back. The trainer gets numpy views of the slot, nothing is
+    pickled or copied. The views stay valid until the next batch is requested, then the slot is recycled.
+    The batches are the same tuples as the ones of DataLoader.load_batch, including the center views.
+    The counters are the same as the ones of prefetch.BatchPrefetcher (starved, wait_time).
+    The ring can be iterated once per epoch, the workers are started for every iteration. close() releases it.
+    """
+
+    def __init__(self, data_loader, n_workers=4, n_slots=None, dataset_name='fly', n_batches=None):
+        """
+        :param data_loader: DataLoader
+        :param n_workers: int - number of worker processes
+        :param n_slots: int - number of batch buffers in the ring, at least n_workers + 1 (default 2 * n_workers)
+        :param dataset_name: string - passed to DataLoader.fill_batch
+        :param n_batches: int - number of batches of an epoch (default data_loader.n_batches - 1 like load_batch)
+        """
+        self.data_loader = data_loader
+        self.n_workers = n_workers
+        self.n_slots = max(n_slots or 2 * n_workers, n_workers + 1)
+        self.dataset_name = dataset_name
+        self.n_batches = n_batches if n_batches is not None else data_loader.n_batches - 1
+
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.
+
+        data_loader.share_volumes()
+
+        # one anonymous shared mapping holds every array of every slot
+        shapes = data_loader.batch_shapes()
+        sizes = [int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in shapes]
+        self._buffer = mmap.mmap(-1, sum(sizes) * self.n_slots)
+        self.slots = []
+        offset = 0
+        for s in range(self.n_slots):
+            arrays = []
+            for (shape, dtype), size in zip(shapes, sizes):
+                arrays.append(np.frombuffer(self._buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape))
+                offset += size
+            self.slots.append(arrays)
+
+    def _work(self, worker_id, free_slots, filled_slots, tickets):
+        np.random.seed((os.getpid() * 7919 + worker_id) % (2 ** 32))
+        try:
+            while True:
+                with tickets.get_lock():
+                    if tickets.value <= 0:
+                        break
+                    tickets.value -= 1
+                slot = free_slots.get()
+                if slot is None:
+                    break
+                self.data_loader.fill_batch(*self.slots[slot], dataset_name=self.dataset_name)
+                filled_slots.put(slot)
+            filled_slots.put(('done', None))
+        except Exception:
+            filled_slots.put(('error', traceback.format_exc()))
+
+    def __iter__(self):
+        ctx = multiprocessing.get_context('fork')
+        free_slots = ctx.SimpleQueue()
+        filled_slots = ctx.Queue()
+        tickets = ctx.Value('l', self.n_batches)
+        for s in range(self.n_slots):
+            free_slots.put(s)
+        workers = [ctx.Process(target=self._work, args=(i, free_slots, filled_slots, tickets)) for i in range(self.n_workers)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        running = len(workers)
+        previous = None
+        try:
+            while running > 0:
+                if previous is not None:
+                    # the trainer is done with the previous batch, recycle its slot
+                    free_slots.put(previous)
+                    previous = None
+                waited = None
+                if filled_slots.empty():
+                    start_time = time.time()
+                    slot = filled_slots.get()
+                    waited = time.time() - start_time
+                else:
+                    slot = filled_slots.get()
+                if isinstance(slot, tuple):
+                    if slot[0] == 'error':
+                        raise RuntimeError('Batch worker failed:\n' + slot[1])
+                    running -= 1
+                    continue
+                # only the waits for a batch count, not the ones for the end of a worker
+                if waited is not None:
+                    self.starved += 1
+                    self.wait_time += waited
+                self.batches += 1
+                previous = slot
+                batch = tuple(self.slots[slot])
+                if self.data_loader.center_sz is not None:
+                    batch += tuple(self.data_loader.center_views(batch[:3]))
+                yield batch
+        finally:
+            for w in workers:
+                free_slots.put(None)
+            for w in workers:
+                w.join(timeout=1)
+                if w.is_alive():
+                    w.terminate()
+
+    def close(self):
+        """Release the ring of batch buffers, the batches yielded before are not valid anymore"""
+        self.slots = []
+        try:
+            self._buffer.close()
+        except BufferError:
+            # the trainer still holds views of its last batch, the mapping is released with them
+            pass
+
+    def report(self):
+        return ('[Shared batches %d: starved %d (%.1f%%), waited %.2fs]'
+                % (self.batches, self.starved, 100. * self.starved / max(self.batches, 1), self.wait_time))
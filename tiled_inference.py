@@ -0,0 +1,75 @@
+from __future__ import print_function, division
+
+import time
+import itertools
+import numpy as np
+
+__author__ = 'elmalakis'
+
+
+"""
+Sliding-window registration of whole volumes with a generator and a transformation model
+The patches of the subject and of the template at every tile origin are copied into preallocated batches, the
+generator and the transformation are run once per batch and the warped patches (and phi) are scattered into volumes of
+the size of the subject. The tile origins are the ones of the loops of sample_images, range(0, n - input_sz, step)
+along every axis.
+"""
+
+
+def tile_origins(shape, input_sz, step):
+    """Origins of the patches of input_sz every step voxels in a volume of shape, as an array (n, 3)"""
+    ranges = [range(0, n - i, s) for n, i, s in zip(shape, input_sz, step)]
+    return np.array(list(itertools.product(*ranges)), dtype=int).reshape(-1, 3)
+
+
+def predict_tiled(generator, transformation, img_S, img_T, input_sz, step, output_offset=None, batch_sz=8,
+                  with_phi=False):
+    """
+    :param generator: model [S, T] -> phi
+    :param transformation: model [S, phi] -> warped S, its subject input may be the center of the patch of the generator
+    :param img_S: array (x, y, z) - subject volume
+    :param img_T: array (x, y, z) - template volume
+    :param input_sz: tuple - size of the patches of the generator
+    :param step: tuple - distance between the tile origins
+    :param output_offset: tuple - position of the warped patch in the patch of the generator, None for the center
+    :param batch_sz: int - number of tiles per predict call, the last batch is padded with the tiles of the previous one
+    :param with_phi: bool - also scatter phi
+    :return: warped volume (x, y, z), phi volume (x, y, z, 3) or None
+    """
+    input_sz = tuple(input_sz)
+    output_sz = tuple(transformation.output_shape[1:4])
+    phi_sz = tuple(generator.output_shape[1:4])
+    # the transformation takes the center of the patch when its input is smaller than the patch
+    warp_input_sz = tuple(transformation.input_shape[0][1:4])
+    warp_gap = [(i - w) // 2 for i, w in zip(input_sz, warp_input_sz)]
+    warp_input = tuple(slice(g, g + w) for g, w in zip(warp_gap, warp_input_sz))
+    if output_offset is None:
+        output_offset = tuple((i - o) // 2 for i, o in zip(input_sz, output_sz))
+
+    predict_img = np.zeros(img_S.shape, dtype=img_S.dtype)
+    predict_phi = np.zeros(img_S.shape + (3,), dtype=img_S.dtype) if with_phi else None
+
+    origins = tile_origins(img_S.shape, input_sz, step)
+    batch_sub_img = np.zeros((batch_sz,) + input_sz + (1,), dtype=img_S.dtype)
+    batch_templ_img = np.zeros((batch_sz,) + input_sz + (1,), dtype=img_T.dtype)
+
+    start_time = time.time()
+    for start in range(0, len(origins), batch_sz):
+        batch_origins = origins[start:start + batch_sz]
+        for j, (row, col, vol) in enumerate(batch_origins):
+            batch_sub_img[j, :, :, :, 0] = img_S[row:row + input_sz[0], col:col + input_sz[1], vol:vol + input_sz[2]]
+            batch_templ_img[j, :, :, :, 0] = img_T[row:row + input_sz[0], col:col + input_sz[1], vol:vol + input_sz[2]]
+
+        batch_phi = generator.predict_on_batch([batch_sub_img, batch_templ_img])
+        batch_warped = transformation.predict_on_batch([batch_sub_img[(slice(None),) + warp_input], batch_phi])
+
+        for j, origin in enumerate(batch_origins):
+            row, col, vol = origin + output_offset
+            predict_img[row:row + output_sz[0], col:col + output_sz[1], vol:vol + output_sz[2]] = batch_warped[j, :, :, :, 0]
+            if with_phi:
+                predict_phi[row:row + phi_sz[0], col:col + phi_sz[1], vol:vol + phi_sz[2], :] = batch_phi[j]
+    elapsed_time = time.time() - start_time
+    n_voxels = len(origins) * int(np.prod(output_sz))
+    print(' --- Tiled inference of %s: %d tiles in batches of %d, %.2fs (%.2f Mvoxels/s)'
+          % (str(img_S.shape), len(origins), batch_sz, elapsed_time, n_voxels / max(elapsed_time, 1e-9) / 1e6))
+    return predict_img, predict_phi
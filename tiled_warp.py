@@ -0,0 +1,123 @@
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from image_warping import WarpPlan
+
+__author__ = 'elmalakis'
+
+
+"""
+Out-of-core warp of a whole volume with a deformation field
+warped[p] = image[p - phi[:, p]] with trilinear interpolation, the points outside the image are clamped to its border
+(the convention of helpers.dense_image_warp_3D). The volume is processed in tiles: a tile of phi is read, the part of
+the image its displaced points fall in (the tile plus a halo as large as the displacements of this tile) is read and
+the result is written straight into the output. The image, phi and output can be memory-mapped (.npy) so the peak
+memory is bounded by the tiles in flight, whatever the size of the volume.
+Several volumes (e.g. the image, its mask and a label volume) are warped with one WarpPlan per tile.
+"""
+
+
+def _open(volume, opened, mode='r'):
+    """Arrays are used as they are, .npy paths are memory-mapped once per cache (one cache per warp_volume_tiled call)"""
+    if not isinstance(volume, str):
+        return volume
+    if (volume, mode) not in opened:
+        opened[(volume, mode)] = np.load(volume, mmap_mode=mode)
+    return opened[(volume, mode)]
+
+
+def _warp_tile(images, phi, outputs, modes, origin, tile_shape, opened):
+    images, phi = [_open(i, opened) for i in images], _open(phi, opened)
+    outputs = [_open(o, opened, 'r+') for o in outputs]
+    shape = np.array(images[0].shape)
+    tile = tuple(slice(o, min(o + t, n)) for o, t, n in zip(origin, tile_shape, shape))
+
+    # positions in the image of every point of the tile, clamped to the image
+    tile_phi = np.asarray(phi[(slice(None),) + tile], dtype=np.float64)
+    grid = np.mgrid[tile].astype(np.float64)
+    query = np.clip(grid - tile_phi, 0, (shape - 1).reshape(3, 1, 1, 1))
+    del grid, tile_phi
+
+    # the halo: only the region covered by the displaced points of this tile is read
+    lo = np.floor(query.reshape(3, -1).min(axis=1)).astype(int)
+    hi = np.minimum(np.floor(query.reshape(3, -1).max(axis=1)).astype(int) + 2, shape)
+    query -= lo.reshape(3, 1, 1, 1)
+
+    plan = WarpPlan(np.moveaxis(query, 0, -1)[None], hi - lo, boundary='clamp')
+    del query
+    for image, output, mode in zip(images, outputs, modes):
+        region = np.asarray(image[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+        output[tile] = plan.apply(region[None, :, :, :, None], mode)[0, :, :, :, 0]
+    return int(np.prod([t.stop - t.start for t in tile]))
+
+
+def warp_volume_tiled(image, phi, output, tile_shape=(64, 64, 64), n_workers=None, worker_type='thread', mode='linear'):
+    """
+    :param image: array (x, y, z) or path of a .npy file - the volume to warp, or a list of volumes of the same shape
+    :param phi: array (3, x, y, z) or path of a .npy file - the displacement of every voxel along x, y and z
+    :param output: array (x, y, z) or path of a .npy file, created if it does not exist (with the dtype of the image),
+                   or a list with one output per volume
+    :param tile_shape: tuple - shape of the tiles of the output, the edge tiles are smaller
+    :param n_workers: int - number of tiles warped in parallel, None for one per core
+    :param worker_type: string - 'thread' or 'process' (the image, phi and output have to be paths)
+    :param mode: string or list of strings - 'linear' or 'nearest' (labels and masks), per volume
+    :return: the output (memory-mapped if given as a path), or the list of outputs
+    """
+    several = isinstance(image, (list, tuple))
+    images = list(image) if several else [image]
+    outputs = list(output) if several else [output]
+    modes = [mode] * len(images) if isinstance(mode, str) else list(mode)
+    if len(outputs) != len(images) or len(modes) != len(images):
+        raise ValueError('Every volume needs an output and an interpolation mode')
+    if worker_type not in ('thread', 'process'):
+        raise ValueError('Worker type %s is not available' % (worker_type))
+    if worker_type == 'process' and not all(isinstance(v, str) for v in images + [phi] + outputs):
+        raise ValueError('The process workers need the image, phi and output as .npy paths')
+
+    # the memory maps of this call, shared by its threads, so concurrent calls do not see each other's handles (the
+    # files may have been rewritten since another call). The process workers get a copy of the empty cache per tile.
+    opened = {}
+    shape = _open(images[0], opened).shape
+    for v in images + [phi]:
+        if _open(v, opened).shape[-3:] != tuple(shape):
+            raise ValueError('Volume of shape %s does not match the image of shape %s'
+                             % (str(_open(v, opened).shape), str(shape)))
+    for i, o in zip(images, outputs):
+        if isinstance(o, str) and not os.path.exists(o):
+            np.lib.format.open_memmap(o, mode='w+', dtype=_open(i, opened).dtype, shape=shape).flush()
+
+    origins = [(x, y, z) for x in range(0, shape[0], tile_shape[0])
+                         for y in range(0, shape[1], tile_shape[1])
+                         for z in range(0, shape[2], tile_shape[2])]
+    n_workers = min(n_workers or os.cpu_count() or 1, len(origins))
+
+    start_time = time.time()
+    if n_workers <= 1:
+        n_voxels = sum(_warp_tile(images, phi, outputs, modes, origin, tile_shape, opened) for origin in origins)
+    else:
+        executor = ThreadPoolExecutor if worker_type == 'thread' else ProcessPoolExecutor
+        worker_opened = opened if worker_type == 'thread' else {}
+        with executor(max_workers=n_workers) as pool:
+            n_voxels = sum(pool.map(_warp_tile, [images] * len(origins), [phi] * len(origins), [outputs] * len(origins),
+                                    [modes] * len(origins), origins, [tile_shape] * len(origins),
+                                    [worker_opened] * len(origins)))
+    elapsed_time = time.time() - start_time
+    print(' --- Tiled warp of %d volume(s) of %s: %d tiles in %.2fs (%.1f Mvoxels/s)'
+          % (len(images), str(tuple(shape)), len(origins), elapsed_time, n_voxels / elapsed_time / 1e6))
+
+    outputs = [_open(o, opened, 'r+') for o in outputs]
+    for o in outputs:
+        if isinstance(o, np.memmap):
+            o.flush()
+    return outputs if several else outputs[0]
+
+
+if __name__ == '__main__':
+    # python tiled_warp.py image.npy phi.npy output.npy [n_workers]
+    warp_volume_tiled(sys.argv[1], sys.argv[2], sys.argv[3],
+                      n_workers=int(sys.argv[4]) if len(sys.argv) > 4 else None, worker_type='process')
@@ -0,0 +1,122 @@
+from __future__ import print_function, division
+
+import numpy as np
+import keras.backend as K
+from keras import metrics
+
+__author__ = 'elmalakis'
+
+
+class GANTrainStep():
+    """
+    One training iteration of the discriminator and the generator.
+    The models used to run generator.predict, transformation.predict on its output, the two train_on_batch calls of
+    the discriminator and combined.train_on_batch. Here the warped image (and the condition of the discriminator) is
+    computed by one call of the graph of the combined model in inference mode, like the two predict calls, and the
+    discriminator and the generator are trained with the train_on_batch calls of the compiled models, so the losses,
+    optimizers (one set of Adam moments per model) and iteration counts are the ones of the three calls.
+    The generator is trained after the discriminator, in its own call, so it is trained against the updated
+    discriminator like before.
+
+    With sum_d_losses the two train_on_batch calls of the discriminator are replaced by one optimizer step on the sum
+    of the real and fake losses, in the same call as the warp (one set of Adam moments, the iteration count advances
+    once per iteration). It changes the training of the discriminator, see __init__.
+    """
+
+    def __init__(self, combined, discriminator, warped, condition, concat_d_batches=False, sum_d_losses=False):
+        """
+        :param combined: compiled combined model, inputs [img_S, img_T], outputs [validity] or [validity, warped_S]
+        :param discriminator: compiled discriminator, inputs [warped or real image, condition]
+        :param warped: tensor - the warped image of the combined model, the fake input of the discriminator
+        :param condition: tensor - the second input of the discriminator in the combined model (img_T or its center)
+        :param concat_d_batches: bool - run the discriminator once on the real and the warped batches concatenated
+                                 along the batch axis, instead of once per batch. The batch normalizations of the
+                                 discriminator then take their statistics over both batches together, so the training
+                                 differs from the separate batches (the outputs only match in inference mode).
+                                 It needs sum_d_losses.
+        :param sum_d_losses: bool - one discriminator step on the sum of the real and fake losses instead of one step
+                             per batch. With Adam a step moves the weights by about the learning rate whatever the
+                             scale of the loss, so the discriminator moves about half as far per iteration, and its
+                             iteration count (and so the learning rate decay) advances once per iteration instead of
+                             twice. The fake batch is produced by the generator in training mode.
+        """
+        if concat_d_batches and not sum_d_losses:
+            raise ValueError('The concatenated discriminator batches are trained with one step on the sum of the '
+                             'losses, set sum_d_losses')
+        self.combined = combined
+        self.discriminator = discriminator
+        self.warped = warped
+        self.condition = condition
+        self.concat_d_batches = concat_d_batches
+        self.sum_d_losses = sum_d_losses
+
+        # the train functions are built now with the discriminator frozen in the combined model, so the generator
+        # update only collects the updates of the generator (e.g. its batch normalizations), not the discriminator's
+        trainable = discriminator.trainable
+        discriminator.trainable = True
+        discriminator._make_train_function()
+        d_weights = discriminator.trainable_weights
+        discriminator.trainable = False
+        combined._make_train_function()
+        discriminator.trainable = trainable
+
+        learning_phase = [] if isinstance(K.learning_phase(), int) else [K.learning_phase()]
+        if not sum_d_losses:
+            # the fake batch of the two train_on_batch calls, in inference mode like generator.predict
+            self._warp = K.function(list(combined.inputs) + learning_phase, [warped, condition], name='gan_warp')
+            return
+
+        real = K.placeholder(shape=K.int_shape(discriminator.inputs[0]), name='real')
+        real_labels = K.placeholder(shape=K.int_shape(discriminator.outputs[0]), name='real_labels')
+        fake_labels = K.placeholder(shape=K.int_shape(discriminator.outputs[0]), name='fake_labels')
+
+        d_loss_fn = discriminator.loss_functions[0]
+        fake = K.stop_gradient(warped)
+        if concat_d_batches:
+            # real and warped samples in one batch, the labels are per sample so the flips work the same
+            n_real = K.shape(real)[0]
+            labels = K.concatenate([real_labels, fake_labels], axis=0)
+            d_calls = [[K.concatenate([real, fake], axis=0), K.concatenate([condition, condition], axis=0)]]
+            validity = discriminator(d_calls[0])
+            losses = d_loss_fn(labels, validity)
+            accuracies = metrics.binary_accuracy(labels, validity)
+            d_loss_real, d_loss_fake = K.mean(losses[:n_real]), K.mean(losses[n_real:])
+            d_acc_real, d_acc_fake = K.mean(accuracies[:n_real]), K.mean(accuracies[n_real:])
+        else:
+            d_calls = [[real, condition], [fake, condition]]
+            validity_real = discriminator(d_calls[0])
+            validity_fake = discriminator(d_calls[1])
+            d_loss_real = K.mean(d_loss_fn(real_labels, validity_real))
+            d_loss_fake = K.mean(d_loss_fn(fake_labels, validity_fake))
+            d_acc_real = K.mean(metrics.binary_accuracy(real_labels, validity_real))
+            d_acc_fake = K.mean(metrics.binary_accuracy(fake_labels, validity_fake))
+        # one get_updates call, so one set of moments for both losses
+        d_updates = discriminator.optimizer.get_updates(loss=d_loss_real + d_loss_fake, params=d_weights)
+        # the moving averages of the batch normalizations of every call of the discriminator
+        d_updates += sum([discriminator.get_updates_for(inputs) for inputs in d_calls], [])
+
+        inputs = list(combined.inputs) + [real, real_labels, fake_labels] + learning_phase
+        self._d_step = K.function(inputs, [d_loss_real, d_acc_real, d_loss_fake, d_acc_fake], updates=d_updates,
+                                  name='gan_d_step')
+
+    def __call__(self, inputs, real, real_labels, fake_labels, g_targets):
+        """
+        :param inputs: list of arrays - [batch_img, batch_img_template], the inputs of the combined model
+        :param real: array - the real input of the discriminator (reference or golden image)
+        :param real_labels: array - targets of the discriminator for the real batch
+        :param fake_labels: array - targets of the discriminator for the warped batch
+        :param g_targets: list of arrays - targets of the combined model, e.g. [valid] or [valid, batch_img_golden]
+        :return: d_loss_real [loss, acc], d_loss_fake [loss, acc], g_loss like combined.train_on_batch
+        """
+        inputs = list(inputs)
+        with_learning_phase = not isinstance(K.learning_phase(), int)
+        if self.sum_d_losses:
+            values = self._d_step(inputs + [real, real_labels, fake_labels] + ([1] if with_learning_phase else []))
+            d_loss_real = np.array(values[0:2])
+            d_loss_fake = np.array(values[2:4])
+        else:
+            fake, condition = self._warp(inputs + ([0] if with_learning_phase else []))
+            d_loss_real = np.array(self.discriminator.train_on_batch([real, condition], real_labels))
+            d_loss_fake = np.array(self.discriminator.train_on_batch([fake, condition], fake_labels))
+        g_loss = self.combined.train_on_batch(inputs, g_targets if len(g_targets) > 1 else g_targets[0])
+        return d_loss_real, d_loss_fake, g_loss
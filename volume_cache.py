@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import shutil
+import numpy as np
+
+from chunked_volume import ChunkedVolume, write_chunked_volume, is_chunked_volume
+
+__author__ = 'elmalakis'
+
+
+class VolumeCache():
+    """
+    Content-addressed on-disk cache of preprocessed volumes.
+    Every entry is stored as a plain .npy file so a warm start only memory-maps it (np.load(mmap_mode='r'))
+    instead of parsing the NRRD and redoing the normalization.
+    The key covers the source file (path, mtime, size), every file the result depends on (e.g. the mask)
+    and the preprocessing flags, so touching any input or changing a flag gives a new entry.
+    With a chunk_shape the entries are written in the chunked format of chunked_volume.py instead, so a crop
+    only decodes the chunks it overlaps and volumes larger than the RAM can be trained on.
+    """
+
+    def __init__(self, cache_dir, chunk_shape=None, levels=1):
+        """
+        :param cache_dir: string - directory that holds the cached volumes
+        :param chunk_shape: tuple - spatial chunk shape of the chunked format, None to store .npy files
+        :param levels: int - resolution levels of the chunked format
+        """
+        self.cache_dir = cache_dir
+        self.chunk_shape = tuple(chunk_shape) if chunk_shape is not None else None
+        self.levels = levels
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file_signature(self, path):
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_mtime_ns, st.st_size]
+
+    def key(self, path, dependencies=(), **params):
+        """
+        :param path: string - source file of the volume
+        :param dependencies: list of strings - other files the cached result depends on (e.g. the mask)
+        :param params: preprocessing flags that change the result
+        :return: string - hex digest that identifies the cached volume
+        """
+        if self.chunk_shape is not None:
+            params = dict(params, chunk_shape=self.chunk_shape, levels=self.levels)
+        signature = {'source': self._file_signature(path),
+                     'dependencies': [self._file_signature(d) for d in dependencies],
+                     'params': params}
+        signature = json.dumps(signature, sort_keys=True, default=str)
+        return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        if self.chunk_shape is not None:
+            return os.path.join(self.cache_dir, key + '.chunks')
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """Memory-map (or open the chunked) cached volume, or return None if it is not in the cache"""
+        cache_path = self.path(key)
+        if self.chunk_shape is not None:
+            return ChunkedVolume(cache_path) if is_chunked_volume(cache_path) else None
+        if not os.path.exists(cache_path):
+            return None
+        return np.load(cache_path, mmap_mode='r')
+
+    def attributes(self, key):
+        """Attributes stored next to a cached volume (e.g. the scale/offset of a quantized volume), {} if there are none"""
+        attributes_path = self.path(key) + '.json'
+        if not os.path.exists(attributes_path):
+            return {}
+        with open(attributes_path) as f:
+            return json.load(f)
+
+    def put(self, key, volume, attributes=None):
+        """Write a volume (and its attributes) to the cache and return the memory-mapped (or chunked) copy"""
+        cache_path = self.path(key)
+        # write to a temporary file first so an interrupted run never leaves a truncated entry behind
+        tmp_path = cache_path + '.%d.tmp' % os.getpid()
+        if attributes is not None:
+            # the attributes go first, an entry is only visible once its volume is in place
+            with open(tmp_path, 'w') as f:
+                json.dump(attributes, f)
+            os.replace(tmp_path, cache_path + '.json')
+        if self.chunk_shape is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            write_chunked_volume(volume, tmp_path, chunk_shape=self.chunk_shape, levels=self.levels)
+            os.replace(tmp_path, cache_path)
+            return ChunkedVolume(cache_path)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(volume))
+        os.replace(tmp_path, cache_path)
+        return np.load(cache_path, mmap_mode='r')
+
+    def get_or_create_attributes(self, path, create_fn, dependencies=(), **params):
+        """
+        Cache a small result without a volume, e.g. the masked statistics of a volume, as a JSON file
+        :param path: string - source file of the volume
+        :param create_fn: callable - computes the attributes (a JSON serializable dict) on a cache miss
+        :param dependencies: list of strings - other files the result depends on
+        :param params: flags that change the result
+        :return: dict
+        """
+        attributes_path = os.path.join(self.cache_dir, self.key(path, dependencies=dependencies, **params) + '.json')
+        if os.path.exists(attributes_path):
+            with open(attributes_path) as f:
+                return json.load(f)
+        attributes = create_fn()
+        tmp_path = attributes_path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump(attributes, f)
+        os.replace(tmp_path, attributes_path)
+        return attributes
+
+    def get_or_create(self, path, create_fn, dependencies=(), with_attributes=False, **params):
+        """
+        :param path: string - source file of the volume
+        :param create_fn: callable - computes the volume on a cache miss, or (volume, attributes) with with_attributes
+        :param dependencies: list of strings - other files the result depends on
+        :param with_attributes: boolean - also store and return the attributes of the volume
+        :param params: preprocessing flags that change the result
+        :return: memory-mapped volume, or (memory-mapped volume, attributes) with with_attributes
+        """
+        key = self.key(path, dependencies=dependencies, **params)
+        volume = self.get(key)
+        if volume is not None:
+            return (volume, self.attributes(key)) if with_attributes else volume
+        if not with_attributes:
+            return self.put(key, create_fn())
+        volume, attributes = create_fn()
+        return self.put(key, volume, attributes), attributes
@@ -0,0 +1,63 @@
+import numpy as np
+
+__author__ = 'elmalakis'
+
+
+"""
+Masked statistics of a volume in a single pass, for the standardization of the images
+The volume is read one slab (along x) at a time, so it works on memory-mapped and chunked volumes without
+full-size temporaries. The slabs are combined with the parallel form of Welford's algorithm (Chan et al.).
+"""
+
+
+def masked_stats(volume, mask=None, slab_sz=16):
+    """
+    Same numbers as np.mean, np.std (ddof=0), np.min and np.max of np.ma.array(volume, mask=np.uint8(1 - mask)),
+    accumulated in float64
+    :param volume: array-like (x, y, z) - ndarray, memmap, ChunkedVolume or AffineVolume
+    :param mask: array-like (x, y, z) - template mask, the voxels where np.uint8(1 - mask) is 0 are used. None for all.
+    :param slab_sz: int - number of x slices read at once
+    :return: dict - count, mean, std, min, max
+    """
+    count, mean, m2 = 0, 0., 0.
+    vmin, vmax = np.inf, -np.inf
+    for x0 in range(0, volume.shape[0], slab_sz):
+        slab = np.asarray(volume[x0:x0 + slab_sz], dtype=np.float64)
+        if mask is not None:
+            slab = slab[np.uint8(1 - np.asarray(mask[x0:x0 + slab_sz])) == 0]
+        else:
+            slab = slab.reshape(-1)
+        n = slab.size
+        if n == 0:
+            continue
+        slab_mean = slab.mean()
+        slab -= slab_mean
+        slab_m2 = np.dot(slab, slab)
+        # merge the slab into the running accumulators
+        delta = slab_mean - mean
+        total = count + n
+        mean += delta * n / total
+        m2 += slab_m2 + delta * delta * count * n / total
+        count = total
+        vmin = min(vmin, slab.min() + slab_mean)
+        vmax = max(vmax, slab.max() + slab_mean)
+    if count == 0:
+        raise ValueError('No voxel of the volume is under the mask')
+    return {'count': int(count), 'mean': float(mean), 'std': float(np.sqrt(m2 / count)),
+            'min': float(vmin), 'max': float(vmax)}
+
+
+def normalization_affine(stats, min_max=False):
+    """
+    The standardization (x - mean) / std, followed with min_max by 2 * (x_std - min) / (max - min) - 1 where min and
+    max are the ones of the masked image before the standardization (as the normalization always did)
+    :param stats: dict - result of masked_stats
+    :param min_max: boolean - scale the standardized image to [-1, 1]
+    :return: scale, offset - the normalized image is x * scale + offset
+    """
+    scale = 1. / stats['std']
+    offset = -stats['mean'] / stats['std']
+    if min_max:
+        r = 2. / (stats['max'] - stats['min'])
+        scale, offset = scale * r, (offset - stats['min']) * r - 1.
+    return scale, offset
@@ -0,0 +1,194 @@
+import numpy as np
+
+__author__ = 'elmalakis'
+
+
+class VolumeStore():
+    """
+    List-like collection of volumes that load_batch can index like the plain python lists it used before.
+    A volume is either kept in memory (an ndarray) or given as the path of a .npy file, in which case it is
+    only memory-mapped the first time it is indexed. Cropping a memory-mapped volume is a view, so only the
+    pages under the crops that are actually copied into a batch are read from disk, and they stay in the
+    page cache where the kernel can reclaim them instead of in the process heap.
+    """
+
+    def __init__(self, volumes=()):
+        """
+        :param volumes: list of ndarrays or .npy file paths
+        """
+        self._volumes = []
+        for v in volumes:
+            self.append(v)
+
+    def append(self, volume):
+        # a memory-mapped array is stored by its file name so it can be reopened lazily, e.g. in a worker process
+        if isinstance(volume, np.memmap) and volume.filename is not None:
+            volume = volume.filename
+        self._volumes.append(volume)
+
+    def _open(self, idx):
+        volume = self._volumes[idx]
+        if isinstance(volume, str):
+            volume = np.load(volume, mmap_mode='r')
+            self._volumes[idx] = volume
+        return volume
+
+    def __len__(self):
+        return len(self._volumes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._open(i) for i in range(len(self))[idx]]
+        return self._open(idx)
+
+    def __setitem__(self, idx, volume):
+        if isinstance(volume, np.memmap) and volume.filename is not None:
+            volume = volume.filename
+        self._volumes[idx] = volume
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._open(i)
+
+    def pop(self, idx=-1):
+        volume = self._open(idx)
+        del self._volumes[idx]
+        return volume
+
+    def crop(self, idx, origin, size):
+        """
+        :param idx: int - index of the volume
+        :param origin: tuple - (x, y, z) of the first voxel of the crop
+        :param size: tuple - (x, y, z) size of the crop
+        :return: a view of the crop, the data is paged in when the view is copied
+        """
+        volume = self._open(idx)
+        x, y, z = origin
+        return volume[..., x:x + size[0], y:y + size[1], z:z + size[2]]
+
+
+class AffineVolume():
+    """
+    Volume read as data * scale + offset in float32, the transform is only applied to the crops that are read.
+    Used for the uint16 storage (scale/offset of the quantization) and for the lazy standardization of the images.
+    """
+
+    def __init__(self, data, scale, offset):
+        self.data = data
+        self.scale = scale
+        self.offset = offset
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = np.dtype('float32')
+
+    def __getitem__(self, key):
+        return np.asarray(self.data[key], dtype=np.float32) * self.scale + self.offset
+
+    def __array__(self, dtype=None):
+        volume = self[...]
+        return volume if dtype is None else volume.astype(dtype)
+
+
+def affine_volume(volume, scale, offset):
+    """volume * scale + offset, an AffineVolume is composed with the new transform instead of being wrapped again"""
+    if isinstance(volume, AffineVolume):
+        return AffineVolume(volume.data, volume.scale * scale, volume.offset * scale + offset)
+    return AffineVolume(volume, scale, offset)
+
+
+class PackedMask():
+    """
+    Binary mask bit-packed along the last (z) axis, 8 voxels per byte. A crop only unpacks the bytes it overlaps.
+    """
+
+    def __init__(self, data, shape):
+        """
+        :param data: uint8 array (x, y, ceil(z / 8)) - np.packbits(mask, axis=-1)
+        :param shape: tuple - shape of the unpacked mask
+        """
+        self.data = data
+        self.shape = tuple(shape)
+        self.ndim = len(shape)
+        self.dtype = np.dtype('uint8')
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if key and key[0] is Ellipsis:
+            key = (slice(None),) * (self.ndim - len(key) + 1) + key[1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if not isinstance(key[-1], slice) or key[-1].step not in (None, 1):
+            raise ValueError('Packed masks only support slicing with step 1 along z')
+        z0, z1, _ = key[-1].indices(self.shape[-1])
+        z1 = max(z0, z1)
+        b0, b1 = z0 // 8, (z1 + 7) // 8
+        bits = np.unpackbits(self.data[key[:-1] + (slice(b0, b1),)], axis=-1)
+        return bits[..., z0 - 8 * b0:z1 - 8 * b0]
+
+    def __array__(self, dtype=None):
+        mask = self[...]
+        return mask if dtype is None else mask.astype(dtype)
+
+
+def compact_volume(volume, storage='float32', block_sz=2 ** 24):
+    """
+    Convert a float32 intensity or phi volume to a reduced-precision storage
+    :param volume: float32 array
+    :param storage: string - 'float32', 'float16' or 'uint16' (with scale/offset)
+    :param block_sz: int - number of voxels converted at once, bounds the temporaries
+    :return: stored array, attributes (storage, scale/offset and the precision loss: max_abs_error, rms_error)
+    """
+    if storage == 'float32':
+        return volume, {'storage': storage, 'max_abs_error': 0., 'rms_error': 0.}
+    if storage not in ('float16', 'uint16'):
+        raise ValueError('Volume storage %s is not available' % (storage))
+
+    flat = np.asarray(volume).reshape(-1)
+    attributes = {'storage': storage}
+    if storage == 'uint16':
+        vmin, vmax = float(np.min(flat)), float(np.max(flat))
+        attributes['scale'] = (vmax - vmin) / 65535. if vmax > vmin else 1.
+        attributes['offset'] = vmin
+    stored = np.empty(flat.shape, dtype=storage)
+    max_abs_error, sum_sq_error = 0., 0.
+    for start in range(0, flat.size, block_sz):
+        block = flat[start:start + block_sz]
+        if storage == 'uint16':
+            q = np.rint((block - attributes['offset']) / attributes['scale'])
+            stored[start:start + block_sz] = np.clip(q, 0, 65535)
+            decoded = stored[start:start + block_sz] * attributes['scale'] + attributes['offset']
+        else:
+            stored[start:start + block_sz] = block
+            decoded = stored[start:start + block_sz].astype(np.float32)
+        error = np.abs(decoded - block, dtype=np.float64)
+        if error.size:
+            max_abs_error = max(max_abs_error, float(error.max()))
+            sum_sq_error += float(np.dot(error, error))
+    attributes['max_abs_error'] = max_abs_error
+    attributes['rms_error'] = float(np.sqrt(sum_sq_error / max(flat.size, 1)))
+    return stored.reshape(volume.shape), attributes
+
+
+def compact_mask(mask, storage='float32'):
+    """
+    :param mask: float32 binary mask
+    :param storage: string - 'float32', 'uint8' or 'bits'
+    :return: stored array, attributes
+    """
+    if storage == 'float32':
+        return mask, {'storage': storage}
+    if storage == 'uint8':
+        return np.uint8(mask), {'storage': storage}
+    if storage == 'bits':
+        return np.packbits(np.asarray(mask) == 1, axis=-1), {'storage': storage, 'shape': list(mask.shape)}
+    raise ValueError('Mask storage %s is not available' % (storage))
+
+
+def restore_volume(stored, attributes):
+    """Wrap a stored array according to its storage attributes, see compact_volume and compact_mask"""
+    storage = attributes.get('storage', 'float32')
+    if storage == 'uint16':
+        return AffineVolume(stored, attributes['scale'], attributes['offset'])
+    if storage == 'bits':
+        return PackedMask(stored, attributes['shape'])
+    return stored
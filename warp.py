@@ -0,0 +1,215 @@
+from __future__ import print_function, division
+
+import os
+import json
+import time
+import numpy as np
+
+from image_warping import WarpPlan, dense_image_warp_3D_scikit
+from tiled_warp import warp_volume_tiled
+
+__author__ = 'elmalakis'
+
+
+"""
+One entry point for all the warps
+    warped[b, p, c] = image[b, p - flow[b, p], c]
+p runs over the grid of the flow, in the voxel coordinates of the image, and component i of the flow is the
+displacement along axis i (the convention of helpers.dense_image_warp_3D).
+The dipy port (image_warping.dense_image_warp_3D_dipy) adds the flow with its components in (k, i, j) order, it is
+warp(image, -flow[..., [1, 2, 0]], boundary='zero').
+
+boundary:       'clamp' - the points outside the image take the value of the nearest border voxel
+                'zero'  - the points outside are 0 (the corners outside the image contribute 0)
+interpolation:  'linear', 'nearest' (labels and masks) or 'cubic'
+backend:        'tf'     - helpers.dense_image_warp_3D, the graph op used for training (tensors are warped in the graph)
+                'numpy'  - image_warping.WarpPlan, vectorized
+                'scipy'  - image_warping.dense_image_warp_3D_scikit, map_coordinates on a thread pool
+                'tiled'  - tiled_warp.warp_volume_tiled, whole volumes in bounded memory
+                'auto'   - the fastest one for the size of the input according to the calibration (see calibrate)
+"""
+
+
+_capabilities = {
+    'tf':    {'boundary': ('clamp',), 'interpolation': ('linear',), 'same_grid': True},
+    'numpy': {'boundary': ('clamp', 'zero'), 'interpolation': ('linear', 'nearest'), 'same_grid': False},
+    'scipy': {'boundary': ('clamp',), 'interpolation': ('linear', 'nearest', 'cubic'), 'same_grid': False},
+    'tiled': {'boundary': ('clamp',), 'interpolation': ('linear', 'nearest'), 'same_grid': True},
+}
+
+_spline_order = {'nearest': 0, 'linear': 1, 'cubic': 3}
+
+DEFAULT_CALIBRATION = os.path.join(os.path.expanduser('~'), '.warp_calibration.json')
+
+_calibrations = {}
+_tf_functions = {}
+_tf_usable = {}
+
+
+def _is_tensor(x):
+    return type(x).__module__.startswith('tensorflow')
+
+
+def _tf_available():
+    """True if the graph warp can run: helpers imports, Keras runs on TensorFlow and its session can be opened"""
+    if 'available' not in _tf_usable:
+        try:
+            import keras.backend as K
+            import helpers
+            _tf_usable['available'] = K.backend() == 'tensorflow' and K.get_session() is not None
+        except Exception:
+            _tf_usable['available'] = False
+    return _tf_usable['available']
+
+
+def _check_options(backend, boundary, interpolation):
+    """The backends are also called directly, they do not silently ignore the options they do not support"""
+    capability = _capabilities[backend]
+    if boundary not in capability['boundary'] or interpolation not in capability['interpolation']:
+        raise ValueError('Warp backend %s does not support boundary %s with %s interpolation'
+                         % (backend, boundary, interpolation))
+
+
+def _warp_tf(image, flow, boundary, interpolation):
+    _check_options('tf', boundary, interpolation)
+    import keras.backend as K
+    from helpers import dense_image_warp_3D
+    if _is_tensor(image) or _is_tensor(flow):
+        return dense_image_warp_3D([image, flow])
+    # numpy inputs are run through one compiled function per shape
+    key = (image.shape, flow.shape, str(image.dtype))
+    if key not in _tf_functions:
+        image_in = K.placeholder(shape=image.shape, dtype=str(image.dtype))
+        flow_in = K.placeholder(shape=flow.shape, dtype=str(flow.dtype))
+        _tf_functions[key] = K.function([image_in, flow_in], [dense_image_warp_3D([image_in, flow_in])])
+    return _tf_functions[key]([image, flow])[0]
+
+
+def _warp_numpy(image, flow, boundary, interpolation):
+    _check_options('numpy', boundary, interpolation)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in flow.shape[1:4]], indexing='ij'), axis=-1)
+    plan = WarpPlan(grid - flow, image.shape[1:4], boundary=boundary)
+    return plan.apply(image, interpolation)
+
+
+def _warp_scipy(image, flow, boundary, interpolation):
+    _check_options('scipy', boundary, interpolation)
+    return dense_image_warp_3D_scikit(image, flow, order=_spline_order[interpolation])
+
+
+def _warp_tiled(image, flow, boundary, interpolation, tile_shape=(64, 64, 64), n_workers=None):
+    _check_options('tiled', boundary, interpolation)
+    warped = np.zeros(image.shape, dtype=image.dtype)
+    for b in range(image.shape[0]):
+        # views, the flow goes back to the (3, x, y, z) layout and every channel is warped straight into the output
+        phi = np.moveaxis(flow[b], -1, 0)
+        for c in range(image.shape[4]):
+            warp_volume_tiled(image[b, :, :, :, c], phi, warped[b, :, :, :, c], tile_shape=tile_shape,
+                              n_workers=n_workers, mode=interpolation)
+    return warped
+
+
+_backends = {'tf': _warp_tf, 'numpy': _warp_numpy, 'scipy': _warp_scipy, 'tiled': _warp_tiled}
+
+
+def available_backends(image_shape, flow_shape, boundary='clamp', interpolation='linear'):
+    """Backends that can warp an image of image_shape with a flow of flow_shape with these options"""
+    backends = []
+    for name, capability in sorted(_capabilities.items()):
+        if boundary not in capability['boundary'] or interpolation not in capability['interpolation']:
+            continue
+        if capability['same_grid'] and tuple(image_shape[1:4]) != tuple(flow_shape[1:4]):
+            continue
+        if name == 'tf' and not _tf_available():
+            continue
+        backends.append(name)
+    return backends
+
+
+def load_calibration(path=DEFAULT_CALIBRATION):
+    """The calibration saved by calibrate, None if there is none"""
+    if path not in _calibrations:
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            _calibrations[path] = json.load(f)
+    return _calibrations[path]
+
+
+def select_backend(image_shape, flow_shape, boundary='clamp', interpolation='linear', calibration_path=DEFAULT_CALIBRATION):
+    """
+    The fastest available backend for the number of voxels of the output, from the calibration measured at the
+    closest size. Without a calibration: numpy up to 2^24 voxels, tiled above (bounded memory).
+    """
+    candidates = available_backends(image_shape, flow_shape, boundary, interpolation)
+    if not candidates:
+        raise ValueError('No warp backend supports boundary %s with %s interpolation for an image of shape %s and a '
+                         'flow of shape %s' % (boundary, interpolation, str(image_shape), str(flow_shape)))
+    n_voxels = int(np.prod(flow_shape[:4]))
+    calibration = load_calibration(calibration_path)
+    if calibration is not None:
+        measured = [b for b in candidates if b in calibration['seconds_per_voxel']]
+        if measured:
+            sizes = np.log(calibration['voxels'])
+            closest = int(np.argmin(np.abs(sizes - np.log(n_voxels))))
+            return min(measured, key=lambda b: calibration['seconds_per_voxel'][b][closest])
+    for preferred in (['numpy', 'scipy'] if n_voxels <= 2 ** 24 else ['tiled', 'scipy']):
+        if preferred in candidates:
+            return preferred
+    return candidates[0]
+
+
+def warp(image, flow, boundary='clamp', interpolation='linear', backend='auto', calibration_path=DEFAULT_CALIBRATION,
+         **backend_options):
+    """
+    :param image: array or tensor (b, x, y, z, c)
+    :param flow: array or tensor (b, x', y', z', 3)
+    :param boundary: string - 'clamp' or 'zero'
+    :param interpolation: string - 'linear', 'nearest' or 'cubic'
+    :param backend: string - 'tf', 'numpy', 'scipy', 'tiled' or 'auto'
+    :param calibration_path: string - calibration used by the 'auto' backend
+    :param backend_options: passed to the backend, tile_shape and n_workers of the tiled backend
+    :return: array or tensor (b, x', y', z', c)
+    """
+    if _is_tensor(image) or _is_tensor(flow):
+        # tensors are warped in the graph, e.g. in a Lambda layer
+        if backend not in ('auto', 'tf') or boundary != 'clamp' or interpolation != 'linear':
+            raise ValueError('Tensors can only be warped by the tf backend, with clamp boundary and linear interpolation')
+        return _warp_tf(image, flow, boundary, interpolation)
+    if backend == 'auto':
+        backend = select_backend(image.shape, flow.shape, boundary, interpolation, calibration_path)
+    elif backend not in available_backends(image.shape, flow.shape, boundary, interpolation):
+        raise ValueError('Warp backend %s is not available for boundary %s with %s interpolation for an image of shape '
+                         '%s and a flow of shape %s' % (backend, boundary, interpolation, str(image.shape), str(flow.shape)))
+    return _backends[backend](image, flow, boundary, interpolation, **backend_options)
+
+
+def calibrate(sizes=(16, 32, 64, 128), backends=None, path=DEFAULT_CALIBRATION, n_repeats=3):
+    """
+    Time every backend on cubes of the given sizes (batch 1, clamp, linear) and save the seconds per voxel for warp's
+    automatic selection
+    :param sizes: list of int - side of the cubes
+    :param backends: list of strings - backends to time, None for all the available ones
+    :param path: string - where the calibration is saved
+    """
+    backends = backends or available_backends((1, 2, 2, 2, 1), (1, 2, 2, 2, 3))
+    calibration = {'voxels': [int(s) ** 3 for s in sizes], 'seconds_per_voxel': {b: [] for b in backends}}
+    for s in sizes:
+        image = np.random.rand(1, s, s, s, 1).astype('float32')
+        flow = (4 * np.random.randn(1, s, s, s, 3)).astype('float32')
+        for b in backends:
+            warp(image, flow, backend=b)  # warm up, e.g. the tf graph and the pools
+            start_time = time.time()
+            for _ in range(n_repeats):
+                warp(image, flow, backend=b)
+            seconds = (time.time() - start_time) / n_repeats
+            calibration['seconds_per_voxel'][b].append(seconds / s ** 3)
+            print(' --- warp calibration %s %d^3: %.4fs' % (b, s, seconds))
+    with open(path, 'w') as f:
+        json.dump(calibration, f, indent=1)
+    _calibrations[path] = calibration
+    return calibration
+
+
+if __name__ == '__main__':
+    calibrate()